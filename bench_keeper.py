@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+import keeper
+
+# Default directories, as archive member names
+DIRECTORIES = [
+    "/var/lib/rundeck/data",
+    "/var/lib/rundeck/logs",
+    "/var/lib/rundeck/.ssh",
+    "/var/lib/rundeck/var/storage",
+    "/var/rundeck/projects"
+]
+
+
+def _synthetic_names(members):
+    """Yield member names shaped like a Rundeck server's files
+
+    Most members are execution logs, and a few live in a sibling of the
+    data directory, which must not be matched when restoring data.
+    """
+    for index in range(members):
+        if index % 100 == 0:
+            yield "var/lib/rundeck/data2/file{}".format(index)
+        elif index % 10 == 0:
+            yield "var/rundeck/projects/p{}/etc/project.properties".format(
+                index % 50)
+        else:
+            yield ("var/lib/rundeck/logs/rundeck/p{}/job/{}/logs/{}.rdlog"
+                   .format(index % 50, index % 1000, index))
+
+
+def create_archive(path, members):
+    """Write a gzipped tar file with empty synthetic members"""
+    with gzip.open(path, "wb", compresslevel=1) as fileobj, \
+            tarfile.open(fileobj=fileobj, mode="w|") as archive:
+        for name in _synthetic_names(members):
+            archive.addfile(tarfile.TarInfo(name))
+
+
+def startswith_filter(directories):
+    """The member filter restore used before the path trie
+
+    Like the original loop, every directory is checked for every member,
+    also after one matched.
+    """
+    def _match(name):
+        matched = False
+        for path in directories:
+            # Remove any '/' from the start of the path
+            if path.startswith('/'):
+                path = path[1:]
+            if name.startswith(path):
+                matched = True
+        return matched
+    return _match
+
+
+def trie_filter(directories):
+    """The member filter restore uses now"""
+    return keeper._PathTrie(directories).match
+
+
+def read_names(path):
+    """Return (seconds, names) for one streamed pass over the archive"""
+    start = time.perf_counter()
+    with keeper._open_backup_file(path) as archive:
+        names = [tarinfo.name for tarinfo in keeper._iter_stream(archive)]
+    return time.perf_counter() - start, names
+
+
+def time_filter(names, build_filter, directories):
+    """Return (seconds, matches) for filtering all names"""
+    start = time.perf_counter()
+    match = build_filter(directories)
+    matches = sum(1 for name in names if match(name))
+    return time.perf_counter() - start, matches
+
+
+def bench_filter(members):
+    """Compare restore member filters on a synthetic archive"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "synthetic.tar.gz")
+        create_archive(path, members)
+        seconds, names = read_names(path)
+    results = {"members": len(names), "stream_seconds": seconds}
+    # The default directories, and a long --dirs list of projects that
+    # do not match, ahead of the ones that do
+    many = [
+        "/var/rundeck/other/p{}".format(index) for index in range(100)
+    ] + DIRECTORIES
+    for label, directories in [("default_dirs", DIRECTORIES),
+                               ("many_dirs", many)]:
+        results[label] = {}
+        for name, build_filter in [("startswith", startswith_filter),
+                                   ("trie", trie_filter)]:
+            seconds, matches = time_filter(names, build_filter, directories)
+            results[label][name] = {"seconds": seconds, "matches": matches}
+    return results
+
+
+# Synthetic trees: many small execution logs, a few large database files,
+# key storage and project definitions
+SCALES = {
+    "small": {"projects": 2, "jobs": 5, "logs": 20, "log_size": 4096,
+              "databases": 1, "database_size": 4 * 1024 * 1024, "keys": 10},
+    "medium": {"projects": 10, "jobs": 20, "logs": 50, "log_size": 8192,
+               "databases": 2, "database_size": 64 * 1024 * 1024,
+               "keys": 100},
+    "large": {"projects": 20, "jobs": 50, "logs": 100, "log_size": 16384,
+              "databases": 3, "database_size": 512 * 1024 * 1024,
+              "keys": 1000},
+}
+
+_LOG_LINE = (
+    "^^^{0}|stepctx={1}|node=node{2}.example.com|user=rundeck"
+    "|level=NORMAL|Running step {1} of job, exit code 0^^^\n"
+)
+_JOB_XML = """<joblist>
+  <job>
+    <name>job{0}</name>
+    <group>project{1}</group>
+    <sequence keepgoing="false" strategy="node-first">
+      <command><exec>/usr/local/bin/task --id {0}</exec></command>
+    </sequence>
+  </job>
+</joblist>
+"""
+
+
+class _BenchKeeper(keeper.Keeper):
+    """Keeper that does not look for rundeckd on the benchmark machine"""
+
+    def _rundeck_is_running(self):
+        return False
+
+
+def _write_log(path, size, rng):
+    lines = []
+    length = 0
+    while length < size:
+        line = _LOG_LINE.format(
+            rng.randint(0, 1 << 40), rng.randint(1, 20), rng.randint(1, 99))
+        lines.append(line)
+        length += len(line)
+    with open(path, "w") as fileobj:
+        fileobj.write("".join(lines)[:size])
+
+
+def _write_database(path, size, rng):
+    """Write pages that are half zeroes and half random, like a database"""
+    page = 4096
+    with open(path, "wb") as fileobj:
+        for _ in range(size // page):
+            fileobj.write(rng.getrandbits(page * 4).to_bytes(page // 2, "big"))
+            fileobj.write(bytes(page // 2))
+
+
+def create_tree(root, scale):
+    """Create a synthetic Rundeck server below root, return its size"""
+    rng = random.Random(0)
+    options = SCALES[scale]
+    prefix = os.path.join(root, "var/lib/rundeck")
+    for index in range(options["databases"]):
+        os.makedirs(prefix + "/data", exist_ok=True)
+        _write_database(
+            prefix + "/data/grailsdb{}.h2.db".format(index),
+            options["database_size"], rng)
+    os.makedirs(prefix + "/.ssh", exist_ok=True)
+    with open(prefix + "/.ssh/id_rsa", "wb") as fileobj:
+        fileobj.write(os.urandom(1679))
+    for index in range(options["keys"]):
+        directory = prefix + "/var/storage/content/keys/node{}".format(
+            index % 10)
+        os.makedirs(directory, exist_ok=True)
+        with open(directory + "/key{}.pem".format(index), "wb") as fileobj:
+            fileobj.write(os.urandom(rng.randint(400, 3000)))
+    for project in range(options["projects"]):
+        directory = os.path.join(
+            root, "var/rundeck/projects/p{}/etc".format(project))
+        os.makedirs(directory, exist_ok=True)
+        with open(directory + "/project.properties", "w") as fileobj:
+            fileobj.write("project.name=p{}\n".format(project))
+        for job in range(options["jobs"]):
+            with open(directory + "/job{}.xml".format(job), "w") as fileobj:
+                fileobj.write(_JOB_XML.format(job, project))
+            logs = prefix + "/logs/rundeck/p{}/job/{}/logs".format(
+                project, job)
+            os.makedirs(logs, exist_ok=True)
+            for log in range(options["logs"]):
+                _write_log(logs + "/{}.rdlog".format(log),
+                           rng.randint(1, 2 * options["log_size"]), rng)
+    return tree_size(root)
+
+
+def tree_size(root):
+    """Return the number of files and bytes below root"""
+    files = size = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(directory, name))
+    return files, size
+
+
+def tree_directories(root):
+    """Return the default directories, moved below root"""
+    return [os.path.join(root, path.lstrip("/")) for path in DIRECTORIES]
+
+
+def run_backup(root, archive, jobs):
+    _BenchKeeper(system_directories=tree_directories(root)).backup(
+        destination_path=os.path.dirname(archive),
+        filename=os.path.basename(archive), jobs=jobs)
+
+
+def run_restore(root, archive, jobs):
+    _BenchKeeper(system_directories=tree_directories(root)).restore(
+        archive, jobs=jobs)
+
+
+def run_list(root, archive, jobs):
+    for _ in keeper.list_backup(archive):
+        pass
+
+
+def run_verify(root, archive, jobs):
+    problems = keeper.verify_backup(archive, jobs=jobs)
+    if problems:
+        raise Exception("verify failed: {}".format(problems))
+
+
+def _measured(function, arguments, queue):
+    """Run function in this process and put its cost on queue"""
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    function(*arguments)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    queue.put({
+        "wall_seconds": time.perf_counter() - start,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime -
+        before.ru_utime - before.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": usage.ru_maxrss * 1024,
+    })
+
+
+def measure(function, *arguments):
+    """Run function in a fresh interpreter, return wall, CPU and peak RSS
+
+    A new process keeps the peak RSS of one operation apart from the
+    others and from the benchmark itself. CPU time includes the worker
+    threads, but not the interpreter start up.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(
+        target=_measured, args=(function, arguments, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if process.exitcode != 0:
+        raise Exception("{} failed with exit code {}".format(
+            function.__name__, process.exitcode))
+    return result
+
+
+def bench_operations(scales, jobs):
+    """Time backup, list, verify and restore on synthetic trees"""
+    results = {}
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as directory:
+            root = os.path.join(directory, "root")
+            files, size = create_tree(root, scale)
+            archive = os.path.join(directory, "backup.tar.gz")
+            result = {"files": files, "bytes": size}
+            for name, function in [("backup", run_backup),
+                                   ("list", run_list),
+                                   ("verify", run_verify),
+                                   ("restore", run_restore)]:
+                if name == "restore":
+                    shutil.rmtree(root)
+                measured = measure(function, root, archive, jobs)
+                measured["mb_per_second"] = \
+                    size / measured["wall_seconds"] / (1024 * 1024)
+                result[name] = measured
+            result["archive_bytes"] = os.path.getsize(archive)
+            results[scale] = result
+    return results
+
+
+def _commit():
+    """Return the git commit of the tree being measured, if any"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = {
+    "filter": lambda arguments: bench_filter(arguments.members),
+    "operations": lambda arguments: bench_operations(
+        arguments.scale, arguments.jobs),
+}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='benchmarks for keeper.py')
+    parser.add_argument(
+        'benchmark',
+        choices=list(BENCHMARKS),
+        help='benchmark to run')
+    parser.add_argument(
+        '--members',
+        type=int,
+        default=1000000,
+        help='number of members in the synthetic archive')
+    parser.add_argument(
+        '--scale',
+        nargs='+',
+        choices=list(SCALES),
+        default=['small'],
+        help='sizes of the synthetic Rundeck trees (default: small)')
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='jobs passed to backup and restore')
+    parser.add_argument(
+        '--output',
+        type=str,
+        help='also write the results to this JSON file')
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    parsed = parse_args(sys.argv[1:])
+    result = {
+        "benchmark": parsed.benchmark,
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "results": BENCHMARKS[parsed.benchmark](parsed),
+    }
+    print(json.dumps(result, indent=2))
+    if parsed.output:
+        with open(parsed.output, "w") as fileobj:
+            json.dump(result, fileobj, indent=2)
@@ -1,12 +1,3397 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import functools
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import select
+import signal
 import subprocess
 import os
+import shutil
 import sys
 import logging
+import stat
+import struct
 import tarfile
-from datetime import datetime
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Size of each independently compressed block of the tar stream
+BLOCK_SIZE = 1024 * 1024
+# Amount of compressed data fed to a decompressor at a time
+READ_SIZE = 64 * 1024
+
+# Optional codec libraries; missing ones fall back to stdlib codecs
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Optional remote storage libraries
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+
+class _Codec:
+    """Compression codec used for the tar stream
+
+    Every codec compresses a block into a standalone frame. Frames can be
+    concatenated, and the resulting file is still valid for the codec's
+    own command line tool.
+    """
+    name = None
+    extension = None
+    magic = None
+    default_level = None
+    available = True
+
+    def compress(self, data, level):
+        """Compress a block of data into a standalone frame"""
+        raise NotImplementedError
+
+    def decompressor(self):
+        """Return a decompressor object for a single frame
+
+        The object needs a decompress() method and the eof and unused_data
+        attributes, like the ones from zlib and lzma.
+        """
+        raise NotImplementedError
+
+    def open_reader(self, fileobj):
+        """Return a readable file object with the decompressed stream"""
+        return io.BufferedReader(_DecompressReader(fileobj, self),
+                                 buffer_size=BLOCK_SIZE)
+
+
+class _GzipCodec(_Codec):
+    name = "gzip"
+    extension = ".tar.gz"
+    magic = b"\x1f\x8b"
+    default_level = 6
+
+    def compress(self, data, level):
+        return gzip.compress(data, compresslevel=level, mtime=0)
+
+    def decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class _XzCodec(_Codec):
+    name = "xz"
+    extension = ".tar.xz"
+    magic = b"\xfd7zXZ\x00"
+    default_level = 6
+
+    def compress(self, data, level):
+        return lzma.compress(data, preset=level)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class _ZstdCodec(_Codec):
+    name = "zstd"
+    extension = ".tar.zst"
+    magic = b"\x28\xb5\x2f\xfd"
+    default_level = 3
+    available = zstandard is not None
+
+    def compress(self, data, level):
+        # Compressor objects are not thread safe, so use one per block
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class _Lz4Codec(_Codec):
+    name = "lz4"
+    extension = ".tar.lz4"
+    magic = b"\x04\x22\x4d\x18"
+    default_level = 0
+    available = lz4 is not None
+
+    def compress(self, data, level):
+        return lz4.frame.compress(data, compression_level=level)
+
+    def decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+class _Passthrough:
+    """Decompressor for uncompressed data, one chunk at a time"""
+    eof = True
+    unused_data = b""
+
+    def decompress(self, data):
+        return data
+
+
+class _NoCodec(_Codec):
+    name = "none"
+    extension = ".tar"
+    default_level = 0
+
+    def compress(self, data, level):
+        return data
+
+    def decompressor(self):
+        return _Passthrough()
+
+
+CODECS = collections.OrderedDict(
+    (codec.name, codec) for codec in [
+        _GzipCodec(), _ZstdCodec(), _Lz4Codec(), _XzCodec(), _NoCodec()
+    ]
+)
+# Stdlib codec to use when an optional library is not installed
+CODEC_FALLBACKS = {
+    "zstd": "gzip",
+    "lz4": "gzip",
+}
+
+
+def get_codec(name):
+    """Return the codec with the given name
+
+    Falls back to a stdlib codec if the library for the requested codec
+    is not installed.
+    """
+    if name not in CODECS:
+        raise Exception("unknown compression codec: {}".format(name))
+    codec = CODECS[name]
+    if not codec.available:
+        fallback = CODECS[CODEC_FALLBACKS[name]]
+        logging.warning(
+            "python library for {} compression is not installed, "
+            "falling back to {}".format(name, fallback.name)
+        )
+        codec = fallback
+    return codec
+
+
+def _detect_codec(fileobj):
+    """Return the codec of a backup file based on its magic bytes
+
+    A file that cannot seek, such as a pipe, must be buffered and is
+    only peeked at.
+    """
+    if fileobj.seekable():
+        head = fileobj.read(tarfile.BLOCKSIZE)
+        fileobj.seek(-len(head), os.SEEK_CUR)
+    else:
+        head = fileobj.peek(tarfile.BLOCKSIZE)[:tarfile.BLOCKSIZE]
+    for codec in CODECS.values():
+        if codec.magic and head.startswith(codec.magic):
+            if not codec.available:
+                raise Exception(
+                    "backup file is compressed with {}, but the python "
+                    "library for it is not installed".format(codec.name)
+                )
+            return codec
+    if head[257:262] == b"ustar":
+        return CODECS["none"]
+    raise Exception("unrecognised backup file format")
+
+
+class _DecompressReader(io.RawIOBase):
+    """Raw reader that decompresses a sequence of concatenated frames
+
+    Seeking forward reads and discards data. Seeking backward rewinds the
+    underlying file and starts over, so it should be avoided.
+    """
+
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.codec = codec
+        self._start = fileobj.tell() if fileobj.seekable() else None
+        self._reset()
+
+    def _reset(self):
+        self._decompressor = None
+        self._input = b""
+        self._output = b""
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.fileobj.seekable()
+
+    def tell(self):
+        return self._position
+
+    def _fill(self):
+        """Decompress more data, return False at the end of the stream"""
+        while not self._output:
+            if self._decompressor is None:
+                if not self._input:
+                    self._input = self.fileobj.read(READ_SIZE)
+                    if not self._input:
+                        return False
+                self._decompressor = self.codec.decompressor()
+            elif not self._input:
+                self._input = self.fileobj.read(READ_SIZE)
+                if not self._input:
+                    raise EOFError("compressed file ended before the "
+                                   "end-of-stream marker was reached")
+            self._output = self._decompressor.decompress(self._input)
+            if self._decompressor.eof:
+                # Start a new frame with whatever follows this one
+                self._input = self._decompressor.unused_data
+                self._decompressor = None
+            else:
+                self._input = b""
+        return True
+
+    def readinto(self, buffer):
+        if not self._output and not self._fill():
+            return 0
+        size = min(len(buffer), len(self._output))
+        buffer[:size] = self._output[:size]
+        self._output = self._output[size:]
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = self._position + offset
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can only seek from start")
+        if offset < self._position:
+            self.fileobj.seek(self._start)
+            self._reset()
+        while self._position < offset:
+            if not self._output and not self._fill():
+                break
+            size = min(offset - self._position, len(self._output))
+            self._output = self._output[size:]
+            self._position += size
+        return self._position
+
+
+class _ParallelCompressor:
+    """File-like writer that compresses blocks of data on a worker pool
+
+    The input stream is cut into blocks of block_size bytes and every block
+    becomes an independent frame of the codec. Frames are written out in
+    order, so the result is a standard multi-member file (for example a
+    .tar.gz) that the usual command line tools and tarfile can read.
+
+    Since every frame can be decompressed on its own, the file can be read
+    starting at any block. blocks lists the (uncompressed offset,
+    compressed offset) of each block written so far. A compressor
+    continuing an earlier one starts at its (uncompressed, compressed)
+    offsets.
+
+    With a `throttle`, the input counts as read and the frames as
+    written, and both are paced by it.
+    """
+
+    def __init__(self, fileobj, jobs=1, codec=None, level=None,
+                 block_size=BLOCK_SIZE, start=(0, 0), throttle=None):
+        self.fileobj = fileobj
+        self.throttle = throttle
+        self.jobs = max(1, jobs)
+        self.codec = codec or CODECS["gzip"]
+        if level is None:
+            level = self.codec.default_level
+        self.level = level
+        self.block_size = block_size
+        self.offset = start[0]
+        self.blocks = []
+        # Uncompressed and compressed bytes written to fileobj so far
+        self.written, self.compressed = start
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._executor = None
+        if self.jobs > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def tell(self):
+        """Return number of uncompressed bytes written so far"""
+        return self.offset
+
+    def write(self, data):
+        if self.throttle is not None:
+            self.throttle.read(len(data))
+        self._buffer += data
+        self.offset += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _write_block(self, size, frame):
+        """Write out a compressed block holding size bytes of input"""
+        self.blocks.append((self.written, self.compressed))
+        if self.throttle is not None:
+            self.throttle.write(len(frame))
+        self.fileobj.write(frame)
+        self.written += size
+        self.compressed += len(frame)
+
+    def _submit(self, block):
+        """Compress a block, either inline or on the worker pool"""
+        if self._executor is None:
+            self._write_block(
+                len(block), self.codec.compress(block, self.level))
+            return
+        self._pending.append((
+            len(block),
+            self._executor.submit(self.codec.compress, block, self.level)
+        ))
+        # Keep at most two blocks per worker in memory
+        while len(self._pending) >= self.jobs * 2:
+            size, future = self._pending.popleft()
+            self._write_block(size, future.result())
+
+    def _drain(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            size, future = self._pending.popleft()
+            self._write_block(size, future.result())
+
+    def checkpoint(self):
+        """Write out everything so far, as a shorter block if need be
+
+        Returns the (uncompressed, compressed) offsets to continue at.
+        """
+        self._drain()
+        self.fileobj.flush()
+        os.fsync(self.fileobj.fileno())
+        return self.written, self.compressed
+
+    def close(self):
+        """Flush remaining data and wait for all blocks to be written"""
+        self._drain()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# Seconds between samples of disk latency for adaptive throttling
+LATENCY_INTERVAL = 1
+# Read rate adaptive throttling never backs off below, bytes per second
+MIN_READ_RATE = 1024 * 1024
+
+
+class _TokenBucket:
+    """Limits a flow of bytes to rate bytes per second
+
+    Up to one second worth of bytes passes at once. Callers taking more
+    than is left sleep until the bucket has refilled. A rate of None
+    lets everything through. waited is the time callers slept.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.waited = 0.0
+        self._tokens = rate or 0
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        rate = self.rate
+        if rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                rate, self._tokens + (now - self._time) * rate) - amount
+            self._time = now
+            wait = -self._tokens / rate
+            if wait > 0:
+                self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _DiskLatency:
+    """Average latency of the disks holding some paths
+
+    Read from the request counts and times in /proc/diskstats. devices
+    is empty if none of the disks is found there, for example on
+    network file systems.
+    """
+
+    def __init__(self, paths):
+        self.devices = set()
+        for path in paths:
+            try:
+                device = os.stat(path).st_dev
+            except OSError:
+                continue
+            self.devices.add((os.major(device), os.minor(device)))
+        self._last = self._read()
+        if self._last is None:
+            self.devices = set()
+
+    def _read(self):
+        """Return (requests, milliseconds) completed on the devices"""
+        try:
+            with open("/proc/diskstats") as fileobj:
+                lines = fileobj.readlines()
+        except OSError:
+            return None
+        found = False
+        requests = milliseconds = 0
+        for line in lines:
+            fields = line.split()
+            if (int(fields[0]), int(fields[1])) in self.devices:
+                found = True
+                requests += int(fields[3]) + int(fields[7])
+                milliseconds += int(fields[6]) + int(fields[10])
+        return (requests, milliseconds) if found else None
+
+    def sample(self):
+        """Return the milliseconds per request since the last sample
+
+        None if no request completed.
+        """
+        current = self._read()
+        if current is None:
+            return None
+        requests = current[0] - self._last[0]
+        milliseconds = current[1] - self._last[1]
+        self._last = current
+        if requests <= 0:
+            return None
+        return milliseconds / requests
+
+
+class IOThrottle:
+    """Paces the reads and writes of backups on a live host
+
+    Token buckets hold bytes read to max_read_rate and bytes written to
+    max_write_rate, in bytes per second. With `max_latency`, in
+    milliseconds, the read rate is halved whenever the average latency of
+    the disks holding `paths` rises above it, and raised again by a
+    quarter every second it stays below, up to max_read_rate. A single
+    throttle can pace several backups at once.
+    """
+
+    def __init__(self, max_read_rate=None, max_write_rate=None,
+                 max_latency=None, paths=()):
+        self.max_read_rate = max_read_rate
+        self.max_latency = max_latency
+        self.reads = _TokenBucket(max_read_rate)
+        self.writes = _TokenBucket(max_write_rate)
+        self.backoffs = 0
+        self.disks = None
+        if max_latency is not None:
+            self.disks = _DiskLatency(paths)
+            if not self.disks.devices:
+                logging.warning("disk latency of {} is unknown, not "
+                                "backing off".format(",".join(paths)))
+                self.disks = None
+        self._lock = threading.Lock()
+        self._sampled = time.monotonic()
+        self._bytes = 0
+
+    @property
+    def waited(self):
+        """Seconds spent waiting for the limits"""
+        return self.reads.waited + self.writes.waited
+
+    def read(self, size):
+        """Account for size bytes read, wait if they come too fast"""
+        if self.disks is not None:
+            self._adapt(size)
+        self.reads.take(size)
+
+    def write(self, size):
+        """Account for size bytes written, wait if they go too fast"""
+        self.writes.take(size)
+
+    def _adapt(self, size):
+        """Follow the disk latency with the read rate"""
+        with self._lock:
+            self._bytes += size
+            now = time.monotonic()
+            elapsed = now - self._sampled
+            if elapsed < LATENCY_INTERVAL:
+                return
+            latency = self.disks.sample()
+            observed = self._bytes / elapsed
+            self._sampled = now
+            self._bytes = 0
+            rate = self.reads.rate
+            if latency is not None and latency > self.max_latency:
+                rate = max(MIN_READ_RATE, min(rate or observed, observed) / 2)
+                self.backoffs += 1
+                logging.info("disk latency {:.0f} ms, reading at most "
+                             "{:.1f} MB/s".format(
+                                 latency, rate / (1024 * 1024)))
+            elif rate is not None:
+                rate *= 1.25
+                if self.max_read_rate is not None:
+                    rate = min(rate, self.max_read_rate)
+                elif rate > 2 * observed:
+                    # Well above what is read, as good as no limit
+                    rate = None
+            self.reads.rate = rate
+
+
+# ioprio_set system call numbers, by machine
+_IOPRIO_SET = {
+    "x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314,
+    "ppc64le": 273, "s390x": 282,
+}
+IOPRIO_CLASSES = {"best-effort": 2, "idle": 3}
+
+
+def _lower_priority(nice=None, ionice=None):
+    """Lower the CPU and I/O priority of keeper
+
+    `nice` is added to the nice value. `ionice` is an I/O scheduling
+    class: "best-effort" at its lowest level, or "idle" to only use the
+    disk when no other process does. Both apply to the calling thread
+    and the threads it starts afterwards.
+    """
+    if nice:
+        os.nice(nice)
+    if ionice is None:
+        return
+    machine = os.uname().machine
+    if machine not in _IOPRIO_SET:
+        logging.warning("cannot set the I/O priority on {}".format(machine))
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    # Class and level of this thread (IOPRIO_WHO_PROCESS, 0)
+    value = IOPRIO_CLASSES[ionice] << 13 | (7 if ionice == "best-effort"
+                                            else 0)
+    if libc.syscall(_IOPRIO_SET[machine], 1, 0, value) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, "ioprio_set failed: {}".format(
+            os.strerror(error)))
+
+
+# Files up to this size are read into memory ahead of the tar writer
+PREFETCH_SIZE = 256 * 1024
+# Number of entries the read ahead may be in front of the tar writer
+PREFETCH_DEPTH = 256
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+# Restored files up to this size are written on the worker threads
+RESTORE_PARALLEL_SIZE = 1024 * 1024
+
+# Suffix of the manifest file written next to every backup file
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_VERSION = 1
+
+
+def _archive_name(path):
+    """Return the name a file system path gets inside the archive"""
+    return os.path.normpath(path).lstrip("/")
+
+
+def _walk(directory):
+    """Yield (path, stat) for a directory and everything below it
+
+    Symlinks are followed and entries are visited in sorted order, which
+    is the same order tarfile.add() uses.
+    """
+    try:
+        status = os.stat(directory)
+    except OSError as error:
+        logging.warning("skipping unreadable path {}: {}".format(
+            directory, error))
+        return
+    yield directory, status
+    if stat.S_ISDIR(status.st_mode):
+        for name in sorted(os.listdir(directory)):
+            yield from _walk(os.path.join(directory, name))
+
+
+class WalkFilter:
+    """Decides which paths a backup walks into and archives
+
+    Paths are matched as archive member names, without the leading /.
+    Paths matching an `exclude` glob are left out with everything below
+    them, before they are stat'ed. With `include` globs, only files
+    matching one of them are archived; directories are always walked.
+    Files larger than `max_size` bytes are left out. Files below the
+    `logs` directories are left out if they were last modified more than
+    `max_age` seconds ago, or not more than `min_age` seconds ago. Ages
+    count from the last call to start().
+    """
+
+    def __init__(self, exclude=(), include=(), max_size=None, max_age=None,
+                 min_age=None, logs=()):
+        self.exclude = [pattern.lstrip("/") for pattern in exclude]
+        self.include = [pattern.lstrip("/") for pattern in include]
+        self.max_size = max_size
+        self.max_age = max_age
+        self.min_age = min_age
+        self.logs = tuple(_archive_name(path) + "/" for path in logs)
+        self.start()
+
+    def start(self):
+        self.now = time.time()
+
+    def by_name(self):
+        """Return a filter of the exclude and include globs alone
+
+        What it leaves out does not change as files grow or age.
+        """
+        return WalkFilter(exclude=self.exclude, include=self.include)
+
+    def skips(self, name, is_dir):
+        """Return whether to leave out a path before it is stat'ed
+
+        is_dir() is only called if needed, as it may stat the path.
+        """
+        for pattern in self.exclude:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        if not self.include or is_dir():
+            return False
+        for pattern in self.include:
+            if fnmatch.fnmatchcase(name, pattern):
+                return False
+        return True
+
+    def skips_status(self, name, status):
+        """Return whether to leave out a path once it is stat'ed"""
+        if not stat.S_ISREG(status.st_mode):
+            return False
+        if self.max_size is not None and status.st_size > self.max_size:
+            return True
+        if not name.startswith(self.logs):
+            return False
+        age = self.now - status.st_mtime
+        if self.max_age is not None and age > self.max_age:
+            return True
+        return self.min_age is not None and age <= self.min_age
+
+
+class _ExcludedDirectories:
+    """Directories a WalkFilter leaves out, with everything below them
+
+    A directory is left out if it, or one above it up to the backed up
+    directories, matches by archive name. Results are kept, so each
+    directory is matched once, whatever order its files come in.
+    """
+
+    def __init__(self, walk_filter, directories):
+        self.walk_filter = walk_filter
+        self._excluded = dict.fromkeys(
+            [""] + [os.path.dirname(_archive_name(directory))
+                    for directory in directories], False)
+
+    def excludes(self, name):
+        """Return whether the directory name is left out"""
+        excluded = self._excluded.get(name)
+        if excluded is None:
+            excluded = self.excludes(os.path.dirname(name)) or \
+                self.walk_filter.skips(name, lambda: True)
+            self._excluded[name] = excluded
+        return excluded
+
+
+def _scan_directory(directory, walk_filter=None):
+    """Return (path, stat) for the entries of a directory, sorted by name
+
+    Entries left out by walk_filter are not stat'ed, if they can be left
+    out by name.
+    """
+    entries = []
+    with os.scandir(directory) as iterator:
+        for entry in sorted(iterator, key=lambda entry: entry.name):
+            if walk_filter is not None and walk_filter.skips(
+                    _archive_name(entry.path), entry.is_dir):
+                continue
+            try:
+                status = entry.stat()
+            except OSError as error:
+                logging.warning("skipping unreadable path {}: {}".format(
+                    entry.path, error))
+                continue
+            if walk_filter is not None and walk_filter.skips_status(
+                    _archive_name(entry.path), status):
+                continue
+            entries.append((entry.path, status))
+    return entries
+
+
+def _walk_scanned(future, executor, ahead, walk_filter=None):
+    """Yield the entries of a scanned directory and of its subdirectories
+
+    The next `ahead` subdirectories are always being scanned on the
+    executor while the current one is yielded.
+    """
+    entries = future.result()
+    subdirectories = [
+        path for path, status in entries if stat.S_ISDIR(status.st_mode)
+    ]
+    scans = {}
+
+    def _scan_ahead(start):
+        for path in subdirectories[start:start + ahead]:
+            if path not in scans:
+                scans[path] = executor.submit(
+                    _scan_directory, path, walk_filter)
+
+    _scan_ahead(0)
+    position = 0
+    for path, status in entries:
+        yield path, status
+        if path in scans:
+            position += 1
+            _scan_ahead(position)
+            yield from _walk_scanned(
+                scans.pop(path), executor, ahead, walk_filter)
+
+
+def _parallel_walk(directories, executor, ahead=16, walk_filter=None):
+    """Yield (path, stat) for directories and everything below them
+
+    Same entries in the same order as _walk, but directories are listed
+    and stat'ed on the executor ahead of time. All directories start
+    scanning at once. Below the directories, the entries walk_filter
+    leaves out are not walked.
+    """
+    roots = [
+        (directory, executor.submit(os.stat, directory),
+         executor.submit(_scan_directory, directory, walk_filter))
+        for directory in directories
+    ]
+    for directory, status, scan in roots:
+        yield directory, status.result()
+        yield from _walk_scanned(scan, executor, ahead, walk_filter)
+
+
+def _read_ahead(path, status, advise=True):
+    """Read ahead a file that is about to be archived
+
+    Small files are read into memory and returned. For large files the
+    kernel is asked to start reading them into the page cache, unless
+    `advise` is false, and None is returned.
+    """
+    if not stat.S_ISREG(status.st_mode):
+        return None
+    if status.st_size <= PREFETCH_SIZE:
+        with open(path, "rb") as fileobj:
+            return fileobj.read()
+    if advise and hasattr(os, "posix_fadvise"):
+        descriptor = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(descriptor, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(descriptor)
+    return None
+
+
+def _prefetch(items, executor, depth=PREFETCH_DEPTH, advise=True):
+    """Yield (item, data) with files read ahead on the executor
+
+    items are tuples that start with (path, stat, read), and a file is
+    only read ahead if read is true. At most `depth` items are in flight,
+    and they come out in the order they went in. data is the content of
+    small files, or None. `advise` is as for _read_ahead.
+    """
+    pending = collections.deque()
+    for item in items:
+        path, status, read = item[:3]
+        if read:
+            future = executor.submit(_read_ahead, path, status, advise)
+        else:
+            future = None
+        pending.append((item, future))
+        if len(pending) >= depth:
+            item, future = pending.popleft()
+            yield item, future and future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future and future.result()
+
+
+@functools.lru_cache(maxsize=None)
+def _user_name(uid):
+    if pwd is None:
+        return ""
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _group_name(gid):
+    if grp is None:
+        return ""
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def _make_tarinfo(archive, path, status, name):
+    """Build a TarInfo from an existing stat result"""
+    if not (stat.S_ISREG(status.st_mode) or stat.S_ISDIR(status.st_mode)):
+        # Let tarfile deal with devices, fifos and the like
+        return archive.gettarinfo(path, arcname=name)
+    tarinfo = archive.tarinfo(name)
+    tarinfo.mode = stat.S_IMODE(status.st_mode)
+    tarinfo.uid = status.st_uid
+    tarinfo.gid = status.st_gid
+    tarinfo.uname = _user_name(status.st_uid)
+    tarinfo.gname = _group_name(status.st_gid)
+    tarinfo.mtime = status.st_mtime
+    if stat.S_ISREG(status.st_mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = status.st_size
+    else:
+        tarinfo.type = tarfile.DIRTYPE
+    return tarinfo
+
+
+def _data_extents(fileobj, status):
+    """Return the (offset, length) data extents of a file with holes
+
+    Extents are found with SEEK_DATA and SEEK_HOLE. Returns None for
+    files without holes, and where the system cannot tell.
+    """
+    if not hasattr(os, "SEEK_DATA") or \
+            status.st_blocks * 512 >= status.st_size:
+        return None
+    descriptor = fileobj.fileno()
+    extents = []
+    offset = 0
+    try:
+        while offset < status.st_size:
+            try:
+                start = os.lseek(descriptor, offset, os.SEEK_DATA)
+            except OSError as error:
+                if error.errno != errno.ENXIO:
+                    raise
+                # Only a hole is left
+                break
+            end = min(os.lseek(descriptor, start, os.SEEK_HOLE),
+                      status.st_size)
+            if start >= end:
+                break
+            extents.append((start, end - start))
+            offset = end
+    except OSError as error:
+        logging.debug("cannot find holes in {}: {}".format(
+            fileobj.name, error))
+        return None
+    finally:
+        os.lseek(descriptor, 0, os.SEEK_SET)
+    if extents == [(0, status.st_size)]:
+        return None
+    # Like GNU tar, end with an empty extent at the end of the file
+    if not extents or sum(extents[-1]) < status.st_size:
+        extents.append((status.st_size, 0))
+    return extents
+
+
+def _sparse_map(extents):
+    """Return the sparse map block of a PAX 1.0 sparse member"""
+    lines = [str(len(extents))]
+    for offset, length in extents:
+        lines.extend([str(offset), str(length)])
+    block = ("\n".join(lines) + "\n").encode("ascii")
+    return block + bytes(-len(block) % tarfile.BLOCKSIZE)
+
+
+class _SparseReader:
+    """Reads the member data of a file with holes for tarfile.addfile
+
+    That is the sparse map followed by the data extents. If digest is
+    given, it is updated with the whole content of the file, holes
+    included, as extracting it would return it.
+    """
+
+    def __init__(self, fileobj, extents, digest=None):
+        self.fileobj = fileobj
+        self.digest = digest
+        self._buffer = _sparse_map(extents)
+        self._extents = collections.deque(extents)
+        self._remaining = 0
+        self._position = 0
+
+    @property
+    def size(self):
+        """Size of the member data"""
+        return len(self._buffer) + sum(
+            length for _, length in self._extents)
+
+    def _zeros(self, length):
+        while length > 0:
+            self.digest.update(bytes(min(length, READ_SIZE)))
+            length -= READ_SIZE
+
+    def _read_extent(self, size):
+        while not self._remaining and self._extents:
+            offset, self._remaining = self._extents.popleft()
+            if self.digest is not None:
+                self._zeros(offset - self._position)
+            self.fileobj.seek(offset)
+            self._position = offset
+        data = self.fileobj.read(min(size, self._remaining))
+        self._remaining -= len(data)
+        self._position += len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        """Return the sha256 of the file once all data was read"""
+        # Only the empty extent at the end is left
+        for offset, _ in self._extents:
+            self._zeros(offset - self._position)
+            self._position = offset
+        self._extents.clear()
+        return self.digest.hexdigest()
+
+    def read(self, size):
+        """Read size bytes, fewer only at the end of the data"""
+        chunks = []
+        while size > 0:
+            if self._buffer:
+                data = self._buffer[:size]
+                self._buffer = self._buffer[size:]
+            else:
+                data = self._read_extent(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+
+def _sparse_tarinfo(tarinfo, reader):
+    """Return the header of a file with holes as a PAX 1.0 sparse member
+
+    tarfile reads these back with the real name, size and holes.
+    """
+    sparse = copy.copy(tarinfo)
+    directory, name = os.path.split(tarinfo.name)
+    sparse.name = os.path.join(directory, "GNUSparseFile.0", name)
+    sparse.size = reader.size
+    # Headers are applied in order on read, and tarfile would add a path
+    # header after GNU.sparse.name for long or non-ASCII names
+    sparse.pax_headers = {"path": sparse.name}
+    sparse.pax_headers.update(
+        (key, value) for key, value in tarinfo.pax_headers.items()
+        if key != "path")
+    sparse.pax_headers.update({
+        "GNU.sparse.major": "1",
+        "GNU.sparse.minor": "0",
+        "GNU.sparse.name": tarinfo.name,
+        "GNU.sparse.realsize": str(tarinfo.size),
+    })
+    return sparse
+
+
+# Smallest file stored as a hard link to an identical file; a link member
+# costs a header, and tiny files compress to about as little
+DEDUP_MIN_SIZE = 4096
+
+
+class _DuplicateFinder:
+    """Finds files that are already in a backup, to store as hard links
+
+    Files are duplicates if they are the same inode, or if they have the
+    same size and sha256, and are in the same `group`: a restore of some
+    of the backed up directories then finds every file a link needs. A
+    file is only hashed before it is archived if an archived file has
+    the same size, reading it through `throttle`.
+    """
+
+    def __init__(self, min_size=DEDUP_MIN_SIZE, throttle=None):
+        self.min_size = min_size
+        self.throttle = throttle
+        self.saved = 0
+        self._inodes = {}
+        self._contents = {}
+        self._sizes = set()
+
+    def find(self, path, status, data, group=None):
+        """Return (name, sha256) of an archived copy of a file, or None"""
+        if status.st_nlink > 1:
+            found = self._inodes.get((group, status.st_dev, status.st_ino))
+            if found is not None:
+                self.saved += status.st_size
+                return found
+        size = status.st_size if data is None else len(data)
+        if size < self.min_size or size not in self._sizes:
+            return None
+        if data is not None:
+            digest = _sha256(data)
+        else:
+            digest = _file_hash(path, self.throttle)
+        name = self._contents.get((group, size, digest))
+        if name is None:
+            return None
+        self.saved += size
+        return name, digest
+
+    def add(self, name, status, size, digest, group=None):
+        """Remember an archived file"""
+        if status.st_nlink > 1:
+            self._inodes.setdefault(
+                (group, status.st_dev, status.st_ino), (name, digest))
+        if size >= self.min_size:
+            self._contents.setdefault((group, size, digest), name)
+            self._sizes.add(size)
+
+
+def _file_hash(path, throttle=None):
+    """Return the sha256 hex digest of a file, read through `throttle`"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fileobj:
+        for chunk in iter(lambda: fileobj.read(READ_SIZE), b""):
+            if throttle is not None:
+                throttle.read(len(chunk))
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _manifest_record(path, status, with_hash=False, data=None,
+                     throttle=None):
+    """Return the manifest record describing a file
+
+    data is the content of the file if it has been read already,
+    otherwise it is read through `throttle` to hash it.
+    """
+    if stat.S_ISREG(status.st_mode):
+        kind = "f"
+    elif stat.S_ISDIR(status.st_mode):
+        kind = "d"
+    else:
+        kind = "o"
+    record = {
+        "path": _archive_name(path),
+        "type": kind,
+        "size": status.st_size if kind == "f" else 0,
+        "mtime": status.st_mtime_ns,
+        "inode": status.st_ino,
+    }
+    if with_hash and kind == "f":
+        if data is None:
+            record["hash"] = _file_hash(path, throttle)
+        else:
+            record["hash"] = hashlib.sha256(data).hexdigest()
+    return record
+
+
+def _record_changed(record, previous):
+    """Return True if a file changed since the previous manifest record"""
+    if previous is None:
+        return True
+    if record["type"] != previous["type"] or \
+            record["size"] != previous["size"]:
+        return True
+    if record["mtime"] == previous["mtime"] and \
+            record["inode"] == previous["inode"]:
+        return False
+    # Metadata differs; trust the content hash if both sides have one
+    if "hash" in record and "hash" in previous:
+        return record["hash"] != previous["hash"]
+    return True
+
+
+class _JsonLinesWriter:
+    """Writes a manifest or index as gzipped JSON lines, header first
+
+    Records are streamed to a temporary file which replaces the final
+    file only once it is complete. After a checkpoint, the temporary file
+    is kept on errors, and a new writer can continue it from the offset
+    checkpoint() returned.
+    """
+
+    def __init__(self, path, header, resume_at=None):
+        self.path = path
+        self.count = 0
+        self.resumable = resume_at is not None
+        if resume_at is None:
+            self._raw = open(path + ".tmp", "wb")
+        else:
+            self._raw = open(path + ".tmp", "r+b")
+            self._raw.truncate(resume_at)
+            self._raw.seek(resume_at)
+        self._start()
+        if resume_at is None:
+            self._write(header)
+
+    def _start(self):
+        self._fileobj = gzip.GzipFile(
+            fileobj=self._raw, mode="wb", compresslevel=6)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self._fileobj.close()
+        self._raw.close()
+        if not self.resumable:
+            os.remove(self.path + ".tmp")
+
+    def _write(self, record):
+        self._fileobj.write(json.dumps(record).encode("utf-8") + b"\n")
+
+    def write(self, record):
+        self._write(record)
+        self.count += 1
+
+    def checkpoint(self):
+        """End the current gzip member and return the offset after it"""
+        self._fileobj.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self.resumable = True
+        offset = self._raw.tell()
+        self._start()
+        return offset
+
+    def close(self):
+        self._fileobj.close()
+        self._raw.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+def _read_json_lines(path, version):
+    """Return (header, iterator of records) for a manifest or index file"""
+    fileobj = gzip.open(path, "rt")
+    header = json.loads(fileobj.readline())
+    if header.get("version") != version:
+        fileobj.close()
+        raise Exception("unsupported file version in {}".format(path))
+
+    def _records():
+        with fileobj:
+            for line in fileobj:
+                yield json.loads(line)
+    return header, _records()
+
+
+def _read_manifest(path):
+    """Return (header, iterator of records) for a manifest file"""
+    return _read_json_lines(path, MANIFEST_VERSION)
+
+
+def _load_manifest(path):
+    """Return (header, dict of records by path) for a manifest file"""
+    header, records = _read_manifest(path)
+    return header, dict((record["path"], record) for record in records)
+
+
+# Suffix of the index file written next to every backup file
+INDEX_SUFFIX = ".index"
+INDEX_VERSION = 1
+
+# Last member of every backup file, the checksums of the files before it
+CHECKSUMS_MEMBER = ".keeper/checksums"
+CHECKSUMS_VERSION = 2
+
+# Checkpoints of an unfinished backup, to resume it from
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_VERSION = 1
+# Bytes of tar stream between checkpoints
+CHECKPOINT_SIZE = 256 * 1024 * 1024
+
+
+def _write_journal(path, journal):
+    """Replace a checkpoint journal in one atomic step"""
+    with open(path + ".tmp", "w") as fileobj:
+        json.dump(journal, fileobj)
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _read_journal(path):
+    try:
+        with open(path) as fileobj:
+            journal = json.load(fileobj)
+    except FileNotFoundError:
+        raise Exception("nothing to resume, {} not found".format(path))
+    if journal.get("version") != JOURNAL_VERSION:
+        raise Exception("unsupported file version in {}".format(path))
+    return journal
+
+
+class _IndexWriter(_JsonLinesWriter):
+    """Writes the index of a backup file
+
+    Every entry is a list of the member name, the compressed offset of the
+    block its header starts in, the uncompressed offset of the header
+    within that block, and the member's size, mode and tar type. Entries
+    are held back until their block has been written and its compressed
+    offset is known.
+    """
+
+    def __init__(self, path, header, resume_at=None):
+        super().__init__(path, header, resume_at)
+        self._pending = collections.deque()
+        self._block = 0
+
+    def add(self, tarinfo, offset):
+        """Add a member whose header starts at offset in the tar stream"""
+        self._pending.append((
+            tarinfo.name, offset, tarinfo.size, tarinfo.mode,
+            tarinfo.type.decode("ascii")
+        ))
+
+    def flush(self, compressor):
+        """Write the entries whose blocks the compressor has written"""
+        blocks = compressor.blocks
+        while self._pending and self._pending[0][1] < compressor.written:
+            name, offset, size, mode, kind = self._pending.popleft()
+            while self._block + 1 < len(blocks) and \
+                    blocks[self._block + 1][0] <= offset:
+                self._block += 1
+            start, block_offset = blocks[self._block]
+            self.write([name, block_offset, offset - start, size, mode, kind])
+
+
+class _DiscardWriter:
+    """Takes the place of the manifest and index of a streamed backup"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def write(self, record):
+        self.count += 1
+
+    def add(self, tarinfo, offset):
+        pass
+
+    def flush(self, compressor):
+        pass
+
+
+def _read_index(path):
+    """Return (header, iterator of entries) for an index file"""
+    return _read_json_lines(path, INDEX_VERSION)
+
+
+def _iter_indexed(filepath, entries):
+    """Yield (archive, tarinfo) for index entries of a backup file
+
+    Reading starts at the block each entry is in, so only the blocks that
+    hold the entries are decompressed. Entries must be in the order of the
+    index.
+    """
+    with open(filepath, "rb") as fileobj:
+        codec = _detect_codec(fileobj)
+        block = reader = None
+        for entry in entries:
+            block_offset, offset = entry[1:3]
+            if block_offset != block or offset < reader.tell():
+                fileobj.seek(block_offset)
+                reader = codec.open_reader(fileobj)
+                block = block_offset
+            reader.seek(offset)
+            # A TarFile on a seekable reader starts at the current position
+            archive = tarfile.TarFile(fileobj=reader, mode="r")
+            yield archive, archive.firstmember
+
+
+# Type bits of the mode shown by list, by tar member type
+_TYPE_MODES = {
+    tarfile.REGTYPE: stat.S_IFREG,
+    tarfile.AREGTYPE: stat.S_IFREG,
+    tarfile.LNKTYPE: stat.S_IFREG,
+    tarfile.DIRTYPE: stat.S_IFDIR,
+    tarfile.SYMTYPE: stat.S_IFLNK,
+    tarfile.CHRTYPE: stat.S_IFCHR,
+    tarfile.BLKTYPE: stat.S_IFBLK,
+    tarfile.FIFOTYPE: stat.S_IFIFO,
+}
+
+
+def _pattern_matcher(pattern):
+    """Return a function matching member names against a glob pattern"""
+    if pattern is None:
+        return lambda name: True
+    pattern = pattern.lstrip("/")
+    return lambda name: fnmatch.fnmatchcase(name, pattern)
+
+
+def list_backup(filepath, only=None, fileobj=None):
+    """Yield (name, size, mode, type) for the files in a backup file
+
+    The index is used when there is one; otherwise the backup file, or
+    fileobj if given, is read as a stream.
+    """
+    match = _pattern_matcher(only)
+    index_path = filepath + INDEX_SUFFIX
+    if fileobj is None and filepath != "-" and os.path.isfile(index_path):
+        header, entries = _read_index(index_path)
+        for name, block_offset, offset, size, mode, kind in entries:
+            if match(name):
+                yield name, size, mode, kind.encode("ascii")
+        return
+    with _open_backup_file(filepath, fileobj=fileobj) as archive:
+        for tarinfo in _iter_stream(archive):
+            if tarinfo.name != CHECKSUMS_MEMBER and match(tarinfo.name):
+                yield tarinfo.name, tarinfo.size, tarinfo.mode, tarinfo.type
+
+
+class _HashingReader:
+    """File wrapper that computes the sha256 of what is read through it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+class _ChecksumWriter:
+    """Collects file checksums in a temporary file during a backup
+
+    add_to(archive) appends them as the last member of the archive. With
+    a path, they are collected in that file instead, which a resumed
+    backup continues from the offset checkpoint() returned.
+    """
+
+    def __init__(self, path=None, resume_at=None):
+        self.path = path
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+        elif resume_at is None:
+            self._file = open(path, "w+b")
+        else:
+            self._file = open(path, "r+b")
+            self._file.truncate(resume_at)
+            self._file.seek(resume_at)
+        if resume_at is None:
+            self._write({"version": CHECKSUMS_VERSION, "algorithm": "sha256"})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is None and self.path is not None:
+            os.remove(self.path)
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record).encode("utf-8") + b"\n")
+
+    def write(self, name, digest, link=None):
+        record = {"path": name, "sha256": digest}
+        if link is not None:
+            # A hard link member, which has no content of its own
+            record["link"] = link
+        self._write(record)
+
+    def add_to(self, archive):
+        tarinfo = tarfile.TarInfo(CHECKSUMS_MEMBER)
+        tarinfo.size = self._file.tell()
+        tarinfo.mtime = time.time()
+        tarinfo.mode = 0o644
+        self._file.seek(0)
+        archive.addfile(tarinfo, self._file)
+
+
+def _iter_checksums(fileobj, links=True):
+    """Yield (name, digest) from a checksums member
+
+    Hard link members are left out unless `links` is set.
+    """
+    header = json.loads(fileobj.readline().decode("utf-8"))
+    if header.get("version") not in (1, CHECKSUMS_VERSION):
+        raise Exception("unsupported checksums version {}".format(
+            header.get("version")))
+    for line in fileobj:
+        record = json.loads(line.decode("utf-8"))
+        if links or "link" not in record:
+            yield record["path"], record["sha256"]
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _live_file_hash(name):
+    """Return the sha256 of a file on disk, or None if it is missing"""
+    try:
+        return _file_hash(os.path.join("/", name))
+    except FileNotFoundError:
+        return None
+
+
+def _hash_archive(archive, computed, jobs):
+    """Hash every file in a streamed archive, in order, into computed
+
+    Small files are hashed on `jobs` threads while the next members are
+    decompressed. The checksums member is copied to a temporary file,
+    which is returned, or None if the archive has none.
+    """
+    embedded = None
+    pending = collections.deque()
+
+    def _drain(limit):
+        while len(pending) > limit:
+            name, digest = pending.popleft()
+            if not isinstance(digest, str):
+                digest = digest.result()
+            computed.write(json.dumps([name, digest]) + "\n")
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for tarinfo in _iter_stream(archive):
+            if tarinfo.name == CHECKSUMS_MEMBER:
+                embedded = tempfile.TemporaryFile()
+                shutil.copyfileobj(
+                    archive.extractfile(tarinfo), embedded, READ_SIZE)
+                embedded.seek(0)
+                continue
+            if not tarinfo.isreg():
+                continue
+            fileobj = archive.extractfile(tarinfo)
+            if tarinfo.size <= RESTORE_PARALLEL_SIZE:
+                digest = executor.submit(_sha256, fileobj.read())
+            else:
+                reader = _HashingReader(fileobj)
+                while reader.read(READ_SIZE):
+                    pass
+                digest = reader.digest.hexdigest()
+            pending.append((tarinfo.name, digest))
+            _drain(jobs * 4)
+        _drain(0)
+    return embedded
+
+
+def verify_backup(filepath, against_live=False, jobs=None):
+    """Check a backup file and return a list of problems found
+
+    The backup file is read once, as a stream, and every file in it is
+    hashed and compared with the checksums embedded at backup time.
+    With `against_live`, the files on disk are hashed in `jobs` processes
+    and compared with the checksums too.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    problems = []
+    with tempfile.TemporaryFile("w+") as computed:
+        try:
+            with _open_backup_file(filepath) as archive:
+                embedded = _hash_archive(archive, computed, jobs)
+        except (tarfile.TarError, EOFError, OSError, zlib.error,
+                lzma.LZMAError) as error:
+            return ["backup file is damaged: {}".format(error)]
+        if embedded is None:
+            logging.warning("{} has no embedded checksums, only its "
+                            "structure was checked".format(filepath))
+            return problems
+        computed.seek(0)
+        with embedded:
+            # Both lists are in the order of the archive, and hard links
+            # have no content to hash
+            checksums = _iter_checksums(embedded, links=False)
+            for line in computed:
+                name, digest = json.loads(line)
+                expected_name, expected = next(checksums, (None, None))
+                if name != expected_name:
+                    problems.append(
+                        "checksums do not match the files in the backup, "
+                        "expected {} and found {}".format(expected_name, name))
+                    return problems
+                if digest != expected:
+                    problems.append("checksum mismatch: {}".format(name))
+            for name, expected in checksums:
+                problems.append("missing from backup: {}".format(name))
+            if against_live:
+                embedded.seek(0)
+                problems.extend(_verify_live(_iter_checksums(embedded), jobs))
+    return problems
+
+
+def _verify_live(checksums, jobs, batch=1024):
+    """Compare checksums with the files on disk, hashed in processes"""
+    problems = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            entries = [entry for entry, _ in zip(checksums, range(batch))]
+            if not entries:
+                break
+            names = [name for name, digest in entries]
+            for (name, expected), digest in zip(
+                    entries, executor.map(_live_file_hash, names,
+                                          chunksize=16)):
+                if digest is None:
+                    problems.append("missing on disk: /{}".format(name))
+                elif digest != expected:
+                    problems.append("changed on disk: /{}".format(name))
+    return problems
+
+
+class _PathTrie:
+    """Set of directories that archive member names are matched against
+
+    Directories are stored by path component, so a member is matched in
+    O(depth) steps and only on component boundaries: data2/file is not
+    inside data.
+    """
+
+    def __init__(self, paths):
+        self._root = {}
+        self._depth = 0
+        for path in paths:
+            node = self._root
+            depth = 0
+            for part in _archive_name(path).split("/"):
+                if part and part != ".":
+                    node = node.setdefault(part, {})
+                    depth += 1
+            # None marks the end of a configured directory
+            node[None] = path
+            self._depth = max(self._depth, depth)
+
+    def find(self, name):
+        """Return the directory that name is in, or None"""
+        node = self._root
+        if None in node:
+            return node[None]
+        # Components below the deepest directory never matter
+        for part in name.split("/", self._depth):
+            if not part:
+                continue
+            node = node.get(part)
+            if node is None:
+                return None
+            if None in node:
+                return node[None]
+        return None
+
+    def match(self, name):
+        """Return True if name is one of the directories or inside one"""
+        return self.find(name) is not None
+
+
+def _format_bytes(size):
+    """Return a human readable size"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} TB".format(size)
+
+
+class _Progress:
+    """Counts files and bytes of a backup or restore and reports progress
+
+    Bytes are counted with add(), or followed through a callable such as
+    the position in the compressed file. With report set, a progress line
+    is logged every `interval` seconds, with a percentage and ETA when
+    totals are known. Time, files and bytes are also kept per directory.
+    """
+
+    def __init__(self, operation, total_files=None, total_bytes=None,
+                 report=False, interval=PROGRESS_INTERVAL):
+        self.operation = operation
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.report = report
+        self.interval = interval
+        self.files = 0
+        self.started = datetime.now()
+        self.directories = collections.OrderedDict()
+        self._read = 0
+        self._written = 0
+        self._read_counter = None
+        self._write_counter = None
+        self._start = time.monotonic()
+        self._last = (self._start, 0)
+        self._directory = None
+        self._directory_start = None
+
+    @property
+    def bytes_read(self):
+        if self._read_counter is not None:
+            return self._read_counter()
+        return self._read
+
+    @property
+    def bytes_written(self):
+        if self._write_counter is not None:
+            return self._write_counter()
+        return self._written
+
+    def follow_input(self, counter):
+        """Take bytes read from counter(), on top of what was read so far"""
+        self.release()
+        base = self._read
+        self._read_counter = lambda: base + counter()
+
+    def follow_output(self, counter):
+        """Take bytes written from counter(), on top of what was written"""
+        self.release()
+        base = self._written
+        self._write_counter = lambda: base + counter()
+
+    def release(self):
+        """Stop following counters, keeping their last values"""
+        self._read = self.bytes_read
+        self._written = self.bytes_written
+        self._read_counter = self._write_counter = None
+
+    def enter(self, directory):
+        """Count what follows towards a directory"""
+        if directory == self._directory:
+            return
+        self._leave()
+        self._directory = directory
+        self._directory_start = time.monotonic()
+        self.directories.setdefault(
+            directory, {"files": 0, "bytes": 0, "seconds": 0.0})
+
+    def _leave(self):
+        if self._directory is not None:
+            self.directories[self._directory]["seconds"] += \
+                time.monotonic() - self._directory_start
+            self._directory = None
+
+    def add(self, files=0, read=0, written=0):
+        """Count files and bytes, and report if it is time to"""
+        self.files += files
+        self._read += read
+        self._written += written
+        if self._directory is not None:
+            self.directories[self._directory]["files"] += files
+            self.directories[self._directory]["bytes"] += read + written
+        if self.report and \
+                time.monotonic() - self._last[0] >= self.interval:
+            self.log()
+
+    @property
+    def ratio(self):
+        """Compression ratio, uncompressed bytes per compressed byte"""
+        if self.operation == "backup":
+            uncompressed, compressed = self.bytes_read, self.bytes_written
+        else:
+            compressed, uncompressed = self.bytes_read, self.bytes_written
+        if not compressed:
+            return None
+        return float(uncompressed) / compressed
+
+    def log(self):
+        """Log a progress line"""
+        now = time.monotonic()
+        read = self.bytes_read
+        last_time, last_read = self._last
+        self._last = (now, read)
+        rate = (read - last_read) / max(now - last_time, 1e-6)
+        message = "{}: {} files, {} read, {} written".format(
+            self.operation, self.files, _format_bytes(read),
+            _format_bytes(self.bytes_written))
+        if self.ratio is not None:
+            message += ", ratio {:.2f}".format(self.ratio)
+        message += ", {:.1f} MB/s".format(rate / (1024 * 1024))
+        # Estimate from bytes if the total is known, files otherwise
+        if self.total_bytes:
+            done, total = read, self.total_bytes
+        elif self.total_files:
+            done, total = self.files, self.total_files
+        else:
+            done = total = None
+        if done:
+            remaining = max(total - done, 0) * (now - self._start) / done
+            message += ", {:.0f}% done, ETA {}".format(
+                min(100.0, 100.0 * done / total),
+                timedelta(seconds=int(remaining)))
+        logging.info(message)
+
+    def finish(self):
+        """Stop the clock and log a final progress line if reporting"""
+        self._leave()
+        self.release()
+        self.seconds = time.monotonic() - self._start
+        if self.report:
+            self.log()
+
+    def stats(self):
+        """Return the statistics of a finished run"""
+        return {
+            "operation": self.operation,
+            "started": self.started.isoformat(),
+            "seconds": self.seconds,
+            "files": self.files,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "ratio": self.ratio,
+            "directories": self.directories,
+        }
+
+    def write_stats(self, path):
+        """Write the statistics of a finished run to a JSON file"""
+        with open(path, "w") as fileobj:
+            json.dump(self.stats(), fileobj, indent=2)
+
+
+@contextlib.contextmanager
+def _open_backup_file(filepath, progress=None, fileobj=None):
+    """Open a backup file as a stream, whatever codec it was written with
+
+    The archive can only be iterated once, front to back, but it never
+    needs to seek in the decompressed data. Compressed bytes read are
+    counted by progress, if given. A filepath of "-" reads from stdin,
+    and a fileobj is read instead of filepath.
+    """
+    with contextlib.ExitStack() as stack:
+        if fileobj is None and filepath == "-":
+            fileobj = sys.stdin.buffer
+        elif fileobj is None:
+            fileobj = stack.enter_context(open(filepath, "rb"))
+        codec = _detect_codec(fileobj)
+        logging.debug("backup file is compressed with {}".format(codec.name))
+        if progress is not None and fileobj.seekable():
+            progress.follow_input(fileobj.tell)
+        try:
+            with tarfile.open(fileobj=codec.open_reader(fileobj),
+                              mode="r|") as archive:
+                yield archive
+        finally:
+            if progress is not None:
+                progress.release()
+
+
+def _iter_stream(archive):
+    """Iterate members of a streamed archive without keeping them around"""
+    for tarinfo in archive:
+        yield tarinfo
+        # TarFile remembers every member it has seen, which adds up to
+        # gigabytes with millions of files; drop them as we go
+        archive.members = []
+
+
+# Extract links and special files exactly as they are stored, like tarfile
+# did before extraction filters were introduced
+if hasattr(tarfile, "fully_trusted_filter"):
+    _EXTRACT_OPTIONS = {"filter": "fully_trusted"}
+else:
+    _EXTRACT_OPTIONS = {}
+
+
+def _apply_attributes(target, record):
+    """Apply owner, mode and mtime of a snapshot record to a file"""
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        uid, gid = record["uid"], record["gid"]
+        try:
+            uid = pwd.getpwnam(record["uname"]).pw_uid
+        except (KeyError, AttributeError):
+            pass
+        try:
+            gid = grp.getgrnam(record["gname"]).gr_gid
+        except (KeyError, AttributeError):
+            pass
+        os.chown(target, uid, gid)
+    os.chmod(target, record["mode"])
+    os.utime(target, ns=(record["mtime"], record["mtime"]))
+
+
+def _refuse_existing(target):
+    """Raise the exception for a file that would be overwritten"""
+    logging.error(
+        "refusing to restore when file already exists on file system: "
+        "{}".format(target)
+    )
+    raise Exception("refusing to overwrite existing file: {}".format(target))
+
+
+def _find_existing(names):
+    """Return the sorted paths of names that already exist as files
+
+    Names are grouped by parent directory and every directory is listed
+    once, instead of calling stat for every name. Directories that do not
+    exist are not listed, and neither is anything below them.
+    """
+    parents = collections.defaultdict(set)
+    for name in names:
+        parent, base = os.path.split(os.path.join("/", name))
+        parents[parent].add(base)
+    existing = []
+    missing = None
+    # Sorting by components puts every directory right before its subtree
+    for parent in sorted(parents, key=lambda path: path.split("/")):
+        if missing is not None and (
+                parent == missing or parent.startswith(missing + "/")):
+            continue
+        bases = parents[parent]
+        try:
+            with os.scandir(parent) as entries:
+                for entry in entries:
+                    if entry.name in bases and entry.is_file():
+                        existing.append(entry.path)
+        except (FileNotFoundError, NotADirectoryError):
+            missing = parent
+        except PermissionError:
+            # Not listable, the names may still be there
+            existing.extend(
+                os.path.join(parent, base) for base in bases
+                if os.path.isfile(os.path.join(parent, base))
+            )
+    return sorted(existing)
+
+
+def _set_attributes(archive, tarinfo, target):
+    """Apply owner, mode and mtime of an archive member"""
+    archive.chown(tarinfo, target, False)
+    if not tarinfo.issym():
+        archive.chmod(tarinfo, target)
+        archive.utime(tarinfo, target)
+
+
+def _create_exclusive(target):
+    """Open a new file for writing, refusing to touch an existing one
+
+    O_EXCL makes the check for an existing file and the creation of the
+    new one a single atomic step.
+    """
+    try:
+        descriptor = os.open(
+            target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        _refuse_existing(target)
+    return os.fdopen(descriptor, "wb")
+
+
+def _write_restored_file(archive, tarinfo, target, data):
+    """Write the content of a regular file and apply its attributes"""
+    with _create_exclusive(target) as target_file:
+        target_file.write(data)
+    _set_attributes(archive, tarinfo, target)
+
+
+def _copy_extents(source, target_file, extents, size):
+    """Copy the data extents of a file with holes, then set its size"""
+    for offset, length in extents:
+        source.seek(offset)
+        target_file.seek(offset)
+        while length > 0:
+            data = source.read(min(length, READ_SIZE))
+            if not data:
+                raise Exception("unexpected end of data in {}".format(
+                    target_file.name))
+            target_file.write(data)
+            length -= len(data)
+    target_file.truncate(size)
+
+
+def _write_sparse_file(archive, tarinfo, target):
+    """Write only the data extents of a file with holes"""
+    # The raw member can seek forward in a stream too, and reads nothing
+    # for the holes skipped
+    source = archive.extractfile(tarinfo).raw
+    with _create_exclusive(target) as target_file:
+        _copy_extents(source, target_file, tarinfo.sparse, tarinfo.size)
+    _set_attributes(archive, tarinfo, target)
+
+
+def _copy_restored_file(archive, tarinfo, target):
+    """Restore a hard link member as a copy of the file it links to
+
+    Returns the size of the copy.
+    """
+    with open(os.path.join("/", tarinfo.linkname), "rb") as source, \
+            _create_exclusive(target) as target_file:
+        status = os.fstat(source.fileno())
+        extents = _data_extents(source, status)
+        if extents is None:
+            shutil.copyfileobj(source, target_file, READ_SIZE)
+        else:
+            _copy_extents(source, target_file, extents, status.st_size)
+    _set_attributes(archive, tarinfo, target)
+    return status.st_size
+
+
+# Journal of the files written by a restore, next to the backup file
+RESTORE_JOURNAL_SUFFIX = ".restore-journal"
+# Restored files between checkpoints of the journal
+RESTORE_CHECKPOINT_FILES = 1000
+
+
+class _RestoreJournal:
+    """Append-only record of the files a restore has written
+
+    The name of each file is added before the file is created. Once all
+    files named so far are completely written, their number is added as
+    a checkpoint. A resumed restore skips the files before the last
+    checkpoint, and removes and writes again the ones after it.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        # Names of the files restored, and those that may be incomplete
+        self.done = []
+        self.unfinished = []
+        self.started = self.checkpointed = 0
+        self._descriptor = None
+        if resume:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fileobj:
+                lines = fileobj.readlines()
+        except FileNotFoundError:
+            raise Exception("nothing to resume, {} not found".format(
+                self.path))
+        names = []
+        checkpoint = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line was cut off
+                break
+            if isinstance(entry, int):
+                checkpoint = entry
+            else:
+                names.append(entry)
+        self.done = names[:checkpoint]
+        self.unfinished = names[checkpoint:]
+
+    def open(self):
+        """Remove unfinished files and start appending to the journal"""
+        for name in self.unfinished:
+            target = os.path.join("/", name)
+            if os.path.lexists(target) and not os.path.isdir(target):
+                logging.debug("removing unfinished {}".format(target))
+                os.remove(target)
+        self.unfinished = []
+        with open(self.path + ".tmp", "w") as fileobj:
+            for name in self.done:
+                fileobj.write(json.dumps(name) + "\n")
+            fileobj.write(json.dumps(len(self.done)) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+        self.started = self.checkpointed = len(self.done)
+        self.done = set(self.done)
+        self._descriptor = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def _append(self, entry):
+        # One write per line, so an interruption only cuts off the last one
+        os.write(self._descriptor, (json.dumps(entry) + "\n").encode())
+
+    def start(self, name):
+        self._append(name)
+        self.started += 1
+
+    def checkpoint(self):
+        self._append(self.started)
+        self.checkpointed = self.started
+
+    def close(self):
+        if self._descriptor is not None:
+            os.close(self._descriptor)
+            self._descriptor = None
+
+
+class _RestoreWriter:
+    """Writes archive members below / without overwriting any file
+
+    Reading and decompressing the archive stays in the calling thread.
+    Directories are created there too, so they exist before any file in
+    them is written. Small regular files are read into memory and then
+    created, written and given their attributes on `jobs` worker threads.
+    Large files, links and special files are written in the calling
+    thread. Directory attributes are applied by close(), deepest first,
+    since restoring their contents would change the mtime again.
+
+    Hard link members are restored as copies of the file they link to,
+    or as hard links with `hardlinks`.
+
+    With a `journal`, every file is recorded in it, and files it lists
+    as restored already are skipped.
+    """
+
+    def __init__(self, jobs=1, progress=None, hardlinks=False,
+                 journal=None):
+        self.jobs = max(1, jobs)
+        self.hardlinks = hardlinks
+        self.journal = journal
+        self.count = 0
+        self.progress = progress
+        self._directories = []
+        # Directories known to exist, saves a makedirs call per file
+        self._created = set()
+        self._pending = collections.deque()
+        self._executor = None
+        if self.jobs > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.journal is not None:
+            self.journal.close()
+
+    def _makedirs(self, directory):
+        if directory not in self._created:
+            os.makedirs(directory, exist_ok=True)
+            self._created.add(directory)
+
+    def flush(self, limit=0):
+        """Wait until at most limit files are being written"""
+        while len(self._pending) > limit:
+            self._pending.popleft().result()
+
+    def add(self, archive, tarinfo):
+        """Restore one archive member"""
+        target = os.path.join("/", tarinfo.name)
+        journal = self.journal
+        if journal is not None and not tarinfo.isdir():
+            if tarinfo.name in journal.done:
+                return
+            if journal.started - journal.checkpointed >= \
+                    RESTORE_CHECKPOINT_FILES:
+                self.flush()
+                journal.checkpoint()
+            # Only files this restore creates may be removed on resume
+            if os.path.lexists(target):
+                _refuse_existing(target)
+            journal.start(tarinfo.name)
+        self.count += 1
+        if self.progress is not None:
+            self.progress.add(
+                files=1, written=tarinfo.size if tarinfo.isreg() else 0)
+        if tarinfo.isdir():
+            self._makedirs(target)
+            self._directories.append((archive, tarinfo))
+            return
+        self._makedirs(os.path.dirname(target))
+        if tarinfo.issparse():
+            _write_sparse_file(archive, tarinfo, target)
+        elif tarinfo.isreg() and self._executor is not None and \
+                tarinfo.size <= RESTORE_PARALLEL_SIZE:
+            data = archive.extractfile(tarinfo).read()
+            self._pending.append(self._executor.submit(
+                _write_restored_file, archive, tarinfo, target, data))
+            self.flush(self.jobs * 4)
+        elif tarinfo.isreg():
+            with _create_exclusive(target) as target_file:
+                shutil.copyfileobj(
+                    archive.extractfile(tarinfo), target_file, READ_SIZE)
+            _set_attributes(archive, tarinfo, target)
+        elif tarinfo.islnk() and not self.hardlinks:
+            # The file to copy must be completely written
+            self.flush()
+            size = _copy_restored_file(archive, tarinfo, target)
+            if self.progress is not None:
+                self.progress.add(written=size)
+        else:
+            # A hard link needs its target to be completely written
+            self.flush()
+            if os.path.lexists(target):
+                _refuse_existing(target)
+            archive.extract(tarinfo, path="/", set_attrs=False,
+                            **_EXTRACT_OPTIONS)
+            _set_attributes(archive, tarinfo, target)
+
+    def close(self):
+        """Wait for all files and apply directory attributes"""
+        self.flush()
+        self._directories.sort(
+            key=lambda item: item[1].name, reverse=True)
+        for archive, tarinfo in self._directories:
+            _set_attributes(
+                archive, tarinfo, os.path.join("/", tarinfo.name))
+        self._directories = []
+
+
+# Content defined chunking: chunk sizes for the deduplicating store
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+# Boundaries are after a newline whose window of the last CHUNK_WINDOW
+# bytes has a crc32 with the CHUNK_MASK bits clear. That is about every
+# 256 KiB of text, and every 1 MiB of binary data, past the minimum size
+CHUNK_ANCHOR = b"\n"
+CHUNK_WINDOW = 32
+CHUNK_MASK = (1 << 12) - 1
+
+
+def _find_chunk_end(data, start):
+    """Return the end of the chunk that starts at start in data
+
+    Boundaries depend on the content before them only, so they survive
+    insertions earlier in the file. Newlines are found with bytes.find,
+    and only their windows are hashed. Returns len(data) if no boundary
+    is found before the maximum chunk size.
+    """
+    end = min(len(data), start + CHUNK_MAX_SIZE)
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    view = memoryview(data)
+    position = start + CHUNK_MIN_SIZE - 1
+    while True:
+        position = data.find(CHUNK_ANCHOR, position, end)
+        if position < 0:
+            return end
+        position += 1
+        if not zlib.crc32(view[position - CHUNK_WINDOW:position]) & \
+                CHUNK_MASK:
+            return position
+
+
+def _iter_chunks(fileobj):
+    """Yield content defined chunks of a file"""
+    data = b""
+    start = 0
+    end_of_file = False
+    while True:
+        # Keep a full maximum chunk buffered, so no boundary is missed
+        while not end_of_file and len(data) - start < CHUNK_MAX_SIZE:
+            more = fileobj.read(CHUNK_MAX_SIZE)
+            end_of_file = not more
+            data = data[start:] + more
+            start = 0
+        if start >= len(data):
+            return
+        end = _find_chunk_end(data, start)
+        yield data[start:end]
+        start = end
+
+
+@contextlib.contextmanager
+def _lock(lock_path, what):
+    """Hold a lock file, waiting while another keeper holds it
+
+    The lock is an flock on the file, which the kernel releases when the
+    process holding it dies. Without fcntl, the file is created
+    exclusively instead, and an exception is raised if it exists.
+    """
+    if fcntl is None:
+        try:
+            descriptor = os.open(
+                lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            raise Exception(
+                "{} is locked; remove {} if no other keeper is "
+                "running".format(what, lock_path)
+            )
+        os.close(descriptor)
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+        return
+    with open(lock_path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info("waiting for the lock of {}".format(what))
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        # The file stays, removing it would let two keepers lock
+        # different files of the same name
+        yield
+
+
+class ChunkStore:
+    """Deduplicating backup store with content addressed chunks
+
+    Files are cut into content defined chunks, and every chunk is stored
+    once under its sha256 in chunks/. A backup is recorded as a snapshot
+    manifest in snapshots/ that lists the chunks of every file. Chunks
+    that no snapshot refers to are removed by prune().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks_path = os.path.join(path, "chunks")
+        self.snapshots_path = os.path.join(path, "snapshots")
+        for directory in [self.chunks_path, self.snapshots_path]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        # Chunks known to be in the store, saves a stat per chunk
+        self._known = set()
+
+    def lock(self):
+        """Hold the store lock, so backups and prunes do not overlap"""
+        return _lock(os.path.join(self.path, "lock"),
+                     "chunk store {}".format(self.path))
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks_path, digest[:2], digest)
+
+    def _snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots_path, snapshot_id + ".gz")
+
+    def put_chunk(self, data):
+        """Store a chunk unless it is already there, return its id"""
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self._known:
+            return digest
+        path = self._chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write under a temporary name, so a chunk is never half there
+            temporary = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(temporary, "wb") as fileobj:
+                fileobj.write(zlib.compress(data, 6))
+            os.replace(temporary, path)
+        self._known.add(digest)
+        return digest
+
+    def put_file(self, fileobj, executor, jobs):
+        """Store the chunks of a file, return the list of chunk ids
+
+        Chunks are hashed and compressed on the executor, with at most two
+        chunks per job in memory.
+        """
+        digests = []
+        pending = collections.deque()
+        for chunk in _iter_chunks(fileobj):
+            pending.append(executor.submit(self.put_chunk, chunk))
+            if len(pending) >= 2 * max(1, jobs):
+                digests.append(pending.popleft().result())
+        digests.extend(future.result() for future in pending)
+        return digests
+
+    def get_chunk(self, digest):
+        """Return the data of a stored chunk"""
+        with open(self._chunk_path(digest), "rb") as fileobj:
+            return zlib.decompress(fileobj.read())
+
+    def snapshots(self):
+        """Return the ids of all snapshots, oldest first"""
+        return sorted(
+            name[:-len(".gz")] for name in os.listdir(self.snapshots_path)
+            if name.endswith(".gz")
+        )
+
+    def read_snapshot(self, snapshot_id):
+        """Return (header, iterator of records) for a snapshot"""
+        path = self._snapshot_path(snapshot_id)
+        if not os.path.isfile(path):
+            raise Exception("snapshot {} not found in {}".format(
+                snapshot_id, self.path))
+        return _read_json_lines(path, MANIFEST_VERSION)
+
+    def write_snapshot(self, snapshot_id, header):
+        """Return a writer for the records of a new snapshot"""
+        return _JsonLinesWriter(self._snapshot_path(snapshot_id), header)
+
+    def expired(self, daily=0, weekly=0, monthly=0):
+        """Return the ids of the snapshots a retention policy drops"""
+        entries = []
+        for snapshot_id in self.snapshots():
+            header, records = self.read_snapshot(snapshot_id)
+            records.close()
+            entries.append((snapshot_id, header))
+        keep = _retained(entries, daily, weekly, monthly)
+        return [
+            snapshot_id for snapshot_id, header in entries
+            if snapshot_id not in keep
+        ]
+
+    def prune(self, forget=()):
+        """Remove the given snapshots and every unreferenced chunk
+
+        Returns the number of chunks removed.
+        """
+        with self.lock():
+            for snapshot_id in forget:
+                logging.info("forgetting snapshot {}".format(snapshot_id))
+                os.remove(self._snapshot_path(snapshot_id))
+            referenced = set()
+            for snapshot_id in self.snapshots():
+                header, records = self.read_snapshot(snapshot_id)
+                for record in records:
+                    referenced.update(record.get("chunks", ()))
+            removed = 0
+            for directory in os.listdir(self.chunks_path):
+                for digest in os.listdir(
+                        os.path.join(self.chunks_path, directory)):
+                    if digest not in referenced:
+                        os.remove(self._chunk_path(digest))
+                        removed += 1
+            self._known.clear()
+        logging.info("prune complete: {} chunks removed".format(removed))
+        return removed
+
+
+# Default size of the parts of an upload or download to remote storage
+PART_SIZE = 8 * 1024 * 1024
+# S3 refuses multipart uploads with smaller parts, except for the last
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+# Largest part and most parts S3 takes in one multipart upload
+S3_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+S3_MAX_PARTS = 10000
+# Parts uploaded before the part size doubles, so a streamed upload of
+# unknown size fits in S3_MAX_PARTS parts
+PART_GROWTH = 1000
+
+
+class _AtomicFileWriter(io.FileIO):
+    """Writes a file under a temporary name, renamed into place by close()
+
+    abort() removes the temporary file instead.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        super().__init__(path + ".tmp", "wb")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            os.replace(self._path + ".tmp", self._path)
+
+    def abort(self):
+        super().close()
+        os.remove(self._path + ".tmp")
+
+
+class _MultipartWriter(io.RawIOBase):
+    """Uploads what is written to it as parts, on `jobs` threads
+
+    start() is called before the first part is uploaded. upload_part(
+    number, data) uploads one part and returns a value that is passed on
+    to complete(parts) with all the others, in order. At most two parts
+    per thread are held in memory. A file smaller than one part is sent
+    with put(data) instead.
+
+    The part size doubles every PART_GROWTH parts, up to
+    S3_MAX_PART_SIZE: 10000 parts starting at 8 MB hold over 5 TB, the
+    most S3 stores in one object. An upload that would still need more
+    than S3_MAX_PARTS parts fails before the part past the limit is sent.
+    """
+
+    def __init__(self, start, upload_part, complete, put, abort,
+                 part_size=PART_SIZE, jobs=4):
+        self._start = start
+        self._upload_part = upload_part
+        self._complete = complete
+        self._put = put
+        self._abort = abort
+        self.part_size = part_size
+        self.jobs = max(1, jobs)
+        self._buffer = bytearray()
+        self._parts = []
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def writable(self):
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _next_part_size(self):
+        submitted = len(self._parts) + len(self._pending)
+        return min(S3_MAX_PART_SIZE,
+                   self.part_size << (submitted // PART_GROWTH))
+
+    def write(self, data):
+        self._buffer += data
+        size = self._next_part_size()
+        while len(self._buffer) >= size:
+            self._submit(bytes(self._buffer[:size]))
+            del self._buffer[:size]
+            size = self._next_part_size()
+        return len(data)
+
+    def _submit(self, data):
+        number = len(self._parts) + len(self._pending) + 1
+        if number > S3_MAX_PARTS:
+            raise Exception("upload too large for {} parts of at most {} "
+                            "bytes".format(S3_MAX_PARTS, S3_MAX_PART_SIZE))
+        if number == 1:
+            self._start()
+        self._pending.append(
+            self._executor.submit(self._upload_part, number, data))
+        while len(self._pending) >= self.jobs * 2:
+            self._parts.append(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        if not self._parts and not self._pending:
+            self._put(bytes(self._buffer))
+        else:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+            while self._pending:
+                self._parts.append(self._pending.popleft().result())
+            self._complete(self._parts)
+        self._buffer = bytearray()
+        self._executor.shutdown(wait=True)
+        super().close()
+
+    def abort(self):
+        """Drop the upload, nothing is left in storage"""
+        self._executor.shutdown(wait=True)
+        if self._parts or self._pending:
+            self._abort()
+        super().close()
+
+
+class _RangedReader(io.RawIOBase):
+    """Reads a remote object in parts, fetched ahead on `jobs` threads
+
+    fetch(start, end) returns the bytes from start up to, not including,
+    end. Parts are returned in order.
+    """
+
+    def __init__(self, fetch, size, part_size=PART_SIZE, jobs=4):
+        self._fetch = fetch
+        self.size = size
+        self.part_size = part_size
+        self.jobs = max(1, jobs)
+        self._next = 0
+        self._data = b""
+        self._offset = 0
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while self._next < self.size and \
+                len(self._pending) < self.jobs * 2:
+            end = min(self.size, self._next + self.part_size)
+            self._pending.append(
+                self._executor.submit(self._fetch, self._next, end))
+            self._next = end
+
+    def readinto(self, buffer):
+        if self._offset >= len(self._data):
+            self._fill()
+            if not self._pending:
+                return 0
+            self._data = self._pending.popleft().result()
+            self._offset = 0
+        size = min(len(buffer), len(self._data) - self._offset)
+        buffer[:size] = self._data[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+        super().close()
+
+
+class Storage:
+    """Where backup files are kept
+
+    Backends implement open_writer(name), which returns a file object
+    that stores name once it is closed and can be abort()ed, open_reader
+    (name), get_file(name, path), which returns False if there is no such
+    file, and put_file(path, name).
+    """
+
+    def put_file(self, path, name):
+        with open(path, "rb") as source, self.open_writer(name) as target:
+            shutil.copyfileobj(source, target, READ_SIZE)
+
+    def get_file(self, name, path):
+        try:
+            source = self.open_reader(name)
+        except FileNotFoundError:
+            return False
+        with source, open(path, "wb") as target:
+            shutil.copyfileobj(source, target, READ_SIZE)
+        return True
+
+
+class LocalStorage(Storage):
+    """Backup files in a local directory"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def open_writer(self, name):
+        os.makedirs(self.path, exist_ok=True)
+        return _AtomicFileWriter(os.path.join(self.path, name))
+
+    def open_reader(self, name):
+        return open(os.path.join(self.path, name), "rb")
+
+
+def _s3_missing(error):
+    """Return True if error is an S3 error for a missing key"""
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in ("404", "NoSuchKey", "NotFound")
+
+
+class S3Storage(Storage):
+    """Backup files in an S3 compatible bucket
+
+    Uploads are multipart uploads and downloads are ranged GETs, both in
+    parts of `part_size` bytes on `jobs` threads. client is a boto3 S3
+    client, or anything with the same methods.
+    """
+
+    def __init__(self, bucket, prefix="", client=None, part_size=PART_SIZE,
+                 jobs=4):
+        if client is None:
+            if boto3 is None:
+                raise Exception(
+                    "S3 storage needs the boto3 python package")
+            client = boto3.client("s3")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.part_size = part_size
+        self.jobs = jobs
+
+    def _key(self, name):
+        if self.prefix:
+            return self.prefix + "/" + name
+        return name
+
+    def open_writer(self, name):
+        key = self._key(name)
+        upload = {}
+
+        def _start():
+            upload["id"] = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=key)["UploadId"]
+
+        def _upload_part(number, data):
+            response = self.client.upload_part(
+                Bucket=self.bucket, Key=key, PartNumber=number,
+                UploadId=upload["id"], Body=data)
+            return {"ETag": response["ETag"], "PartNumber": number}
+
+        def _complete(parts):
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload["id"],
+                MultipartUpload={"Parts": parts})
+
+        def _put(data):
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+        def _abort():
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload["id"])
+
+        return _MultipartWriter(_start, _upload_part, _complete, _put,
+                                _abort, part_size=self.part_size,
+                                jobs=self.jobs)
+
+    def open_reader(self, name):
+        key = self._key(name)
+        try:
+            size = self.client.head_object(
+                Bucket=self.bucket, Key=key)["ContentLength"]
+        except Exception as error:
+            if _s3_missing(error):
+                raise FileNotFoundError(name)
+            raise
+
+        def _fetch(start, end):
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=key,
+                Range="bytes={}-{}".format(start, end - 1))
+            return response["Body"].read()
+
+        return io.BufferedReader(
+            _RangedReader(_fetch, size, self.part_size, self.jobs),
+            READ_SIZE)
+
+
+class _SFTPWriter(io.RawIOBase):
+    """Writes a file over SFTP under a temporary name, like a local one"""
+
+    def __init__(self, sftp, path):
+        self._sftp = sftp
+        self._path = path
+        self._file = sftp.open(path + ".tmp", "wb")
+        self._file.set_pipelined(True)
+
+    def writable(self):
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self._file.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._sftp.posix_rename(self._path + ".tmp", self._path)
+        super().close()
+
+    def abort(self):
+        self._file.close()
+        self._sftp.remove(self._path + ".tmp")
+        super().close()
+
+
+class SFTPStorage(Storage):
+    """Backup files in a directory on an SFTP server
+
+    Writes are pipelined and reads are prefetched, so many requests are
+    in flight on the one connection.
+    """
+
+    def __init__(self, host, path, username=None, port=22):
+        if paramiko is None:
+            raise Exception("SFTP storage needs the paramiko python package")
+        self._ssh = paramiko.SSHClient()
+        self._ssh.load_system_host_keys()
+        self._ssh.connect(host, port=port, username=username)
+        self.sftp = self._ssh.open_sftp()
+        self.path = path
+
+    def open_writer(self, name):
+        return _SFTPWriter(self.sftp, self.path + "/" + name)
+
+    def open_reader(self, name):
+        fileobj = self.sftp.open(self.path + "/" + name, "rb")
+        fileobj.prefetch()
+        return io.BufferedReader(fileobj, READ_SIZE)
+
+
+def get_storage(url, part_size=PART_SIZE, jobs=4):
+    """Return the storage for a URL
+
+    s3://bucket/prefix, sftp://user@host:port/path, or a local directory.
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "s3":
+        if part_size < S3_MIN_PART_SIZE:
+            raise Exception("S3 parts must be at least {} MB".format(
+                S3_MIN_PART_SIZE // (1024 * 1024)))
+        return S3Storage(parsed.netloc, parsed.path, part_size=part_size,
+                         jobs=jobs)
+    if parsed.scheme == "sftp":
+        return SFTPStorage(parsed.hostname, parsed.path,
+                           username=parsed.username, port=parsed.port or 22)
+    if parsed.scheme in ("", "file"):
+        return LocalStorage(parsed.path)
+    raise Exception("unsupported storage {}".format(url))
+
+
+# The database, which rundeckd modifies in place
+DATABASE_DIRECTORY = "/var/lib/rundeck/data"
+# Execution logs, the biggest directory by far
+LOGS_DIRECTORY = "/var/lib/rundeck/logs"
+# Directories backed up and restored by default
+SYSTEM_DIRECTORIES = [
+    # ToDo: add /etc/rundeck/realm.properties for user auth?
+    DATABASE_DIRECTORY,               # database
+    LOGS_DIRECTORY,                   # execution logs (biggest)
+    "/var/lib/rundeck/.ssh",          # ssh keys
+    "/var/lib/rundeck/var/storage",   # keystore files and metadata
+    "/var/rundeck/projects"           # project definitions
+]
+
+# Catalog of the backup files in a destination directory
+CATALOG_NAME = "keeper-catalog.json"
+CATALOG_VERSION = 1
+
+
+class Catalog:
+    """List of the backup files in a destination directory
+
+    Every backup adds its archive name, creation time, size, type and
+    directories, so backups can be listed and pruned without opening
+    them. The catalog is rewritten atomically under a lock. Without a
+    catalog, one is built from the headers of the manifests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.catalog_path = os.path.join(path, CATALOG_NAME)
+
+    def lock(self):
+        return _lock(self.catalog_path + ".lock",
+                     "catalog {}".format(self.catalog_path))
+
+    def entries(self):
+        """Return the catalog entries, oldest first"""
+        if not os.path.isfile(self.catalog_path):
+            return self._scan()
+        with open(self.catalog_path) as fileobj:
+            catalog = json.load(fileobj)
+        if catalog.get("version") != CATALOG_VERSION:
+            raise Exception("unsupported file version in {}".format(
+                self.catalog_path))
+        return catalog["backups"]
+
+    def _scan(self):
+        """Build entries from the manifests in the directory"""
+        entries = []
+        for name in os.listdir(self.path):
+            if os.path.isfile(os.path.join(self.path, name, SHARDS_MANIFEST)):
+                entries.append(self.sharded_entry(
+                    name, _read_shards(os.path.join(self.path, name))))
+                continue
+            archive = name[:-len(MANIFEST_SUFFIX)]
+            if not name.endswith(MANIFEST_SUFFIX) or \
+                    not os.path.isfile(os.path.join(self.path, archive)):
+                continue
+            header, records = _read_manifest(os.path.join(self.path, name))
+            records.close()
+            entries.append(self.entry(
+                header, os.path.getsize(os.path.join(self.path, archive))))
+        entries.sort(key=lambda entry: entry["created"])
+        return entries
+
+    @staticmethod
+    def entry(header, size):
+        """Return the catalog entry for a backup from its manifest header"""
+        return {
+            "archive": header["archive"],
+            "created": header["created"],
+            "size": size,
+            "type": header["type"],
+            "base": header["base"],
+            "partial": header["directories"] != SYSTEM_DIRECTORIES,
+            "directories": header["directories"],
+        }
+
+    @staticmethod
+    def sharded_entry(name, shards):
+        """Return the catalog entry for the directory of a sharded backup"""
+        return {
+            "archive": name,
+            "created": shards["created"],
+            "size": sum(shard["size"] for shard in shards["shards"]),
+            "type": "full",
+            "base": None,
+            "partial": shards["directories"] != SYSTEM_DIRECTORIES,
+            "directories": shards["directories"],
+            "sharded": True,
+        }
+
+    def _write(self, entries):
+        with open(self.catalog_path + ".tmp", "w") as fileobj:
+            json.dump({"version": CATALOG_VERSION, "backups": entries},
+                      fileobj, indent=1)
+        os.replace(self.catalog_path + ".tmp", self.catalog_path)
+
+    def add(self, entry):
+        """Add or replace the entry of a backup"""
+        with self.lock():
+            entries = [
+                existing for existing in self.entries()
+                if existing["archive"] != entry["archive"]
+            ]
+            entries.append(entry)
+            entries.sort(key=lambda existing: existing["created"])
+            self._write(entries)
+
+    def prune(self, daily=0, weekly=0, monthly=0, dry_run=False):
+        """Remove the backups the retention policy does not keep
+
+        Returns the names of the removed backup files. The catalog is
+        updated before any file is removed.
+        """
+        with self.lock():
+            entries = self.entries()
+            keep = _retained(
+                [(entry["archive"], entry) for entry in entries],
+                daily, weekly, monthly)
+            removed = [
+                entry for entry in entries if entry["archive"] not in keep
+            ]
+            if dry_run:
+                for entry in removed:
+                    logging.info("would remove {}".format(entry["archive"]))
+                return [entry["archive"] for entry in removed]
+            self._write([
+                entry for entry in entries if entry["archive"] in keep])
+            for entry in removed:
+                name = entry["archive"]
+                logging.info("removing {}".format(name))
+                if entry.get("sharded"):
+                    # All shards of the backup go together
+                    shutil.rmtree(os.path.join(self.path, name),
+                                  ignore_errors=True)
+                    continue
+                for suffix in ["", MANIFEST_SUFFIX, INDEX_SUFFIX]:
+                    path = os.path.join(self.path, name + suffix)
+                    if os.path.exists(path):
+                        os.remove(path)
+        logging.info("prune complete: {} backups removed, {} kept".format(
+            len(removed), len(keep)))
+        return [entry["archive"] for entry in removed]
+
+
+def _retained(entries, daily=0, weekly=0, monthly=0):
+    """Return the names of the backups a retention policy keeps
+
+    entries are (name, entry) pairs, where entry has the created time,
+    the directories and the base of the backup. Backups of the same
+    directories are kept as a set: the newest backup of each of the last
+    `daily` days, `weekly` weeks and `monthly` months that have one. Bases
+    of kept incremental backups are always kept too.
+    """
+    if not (daily or weekly or monthly):
+        raise Exception("a retention policy needs at least one --keep")
+    sets = collections.defaultdict(list)
+    for name, entry in entries:
+        created = datetime.fromisoformat(entry["created"])
+        sets[tuple(entry["directories"])].append((created, name))
+    keep = set()
+    for backups in sets.values():
+        backups.sort(reverse=True)
+        for count, period in [(daily, "%Y-%m-%d"), (weekly, "%G-%V"),
+                              (monthly, "%Y-%m")]:
+            periods = set()
+            for created, name in backups:
+                key = created.strftime(period)
+                if key in periods:
+                    continue
+                if len(periods) >= count:
+                    break
+                periods.add(key)
+                keep.add(name)
+    # Never break an incremental chain
+    bases = dict((name, entry.get("base")) for name, entry in entries)
+    for name in list(keep):
+        base = bases.get(name)
+        while base is not None and base not in keep:
+            keep.add(base)
+            base = bases.get(base)
+    return keep
+
+
+# ioctl that clones a file as a copy-on-write copy (reflink)
+FICLONE = 0x40049409
+
+
+def _reflink(source, target, fallback=True):
+    """Copy a file as a reflink, or as a regular copy if not supported
+
+    Returns True if the file was cloned. Without `fallback`, a file that
+    cannot be cloned is not copied, and target is removed.
+    """
+    if fcntl is not None:
+        with open(source, "rb") as source_file, \
+                open(target, "wb") as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE,
+                            source_file.fileno())
+                return True
+            except OSError as error:
+                logging.debug("cannot reflink {}: {}".format(source, error))
+    if not fallback:
+        if os.path.exists(target):
+            os.remove(target)
+        return False
+    shutil.copyfile(source, target)
+    return False
+
+
+class _CopySnapshot:
+    """Snapshot of directories as a tree of hard links or reflinks
+
+    The tree is made next to every directory, on the same file system.
+    Hard links are instant everywhere, but a file that is modified in
+    place changes in the snapshot too, so the SNAPSHOT_COPIED directories
+    are copied instead. Reflinks are copy-on-write copies on btrfs and
+    XFS; elsewhere the snapshot is refused rather than copying everything
+    while rundeckd is stopped.
+    """
+
+    def __init__(self, link):
+        self.link = link
+        self._roots = []
+        self._copied = 0
+
+    def _copy_file(self, source, target, copy):
+        if self.link and not copy:
+            os.link(source, target)
+            return
+        if self.link:
+            # A reflink if possible, else a full copy
+            _reflink(source, target)
+            self._copied += 1
+        elif not _reflink(source, target, fallback=False):
+            raise Exception(
+                "reflinks are not supported on the file system of {}, use "
+                "--online hardlink, lvm or btrfs".format(source))
+        shutil.copystat(source, target)
+
+    def _copy_tree(self, source, target, copy):
+        os.mkdir(target)
+        with os.scandir(source) as entries:
+            for entry in entries:
+                path = os.path.join(target, entry.name)
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), path)
+                elif entry.is_dir():
+                    self._copy_tree(entry.path, path, copy or self._copy.match(
+                        _archive_name(entry.path)))
+                elif not entry.is_file():
+                    logging.debug("not snapshotting special file {}".format(
+                        entry.path))
+                else:
+                    self._copy_file(entry.path, path, copy)
+        shutil.copystat(source, target)
+
+    def create(self, directories):
+        sources = {}
+        self._copy = _PathTrie(SNAPSHOT_COPIED)
+        for directory in directories:
+            root = os.path.join(
+                os.path.dirname(os.path.normpath(directory)),
+                ".keeper-snapshot-{}".format(os.getpid()))
+            if root not in self._roots:
+                os.mkdir(root, 0o700)
+                self._roots.append(root)
+            sources[directory] = os.path.join(
+                root, os.path.basename(os.path.normpath(directory)))
+            self._copy_tree(directory, sources[directory],
+                            self._copy.match(_archive_name(directory)))
+        if self._copied:
+            logging.info("{} files modified in place were copied".format(
+                self._copied))
+        return sources
+
+    def remove(self):
+        for root in self._roots:
+            shutil.rmtree(root)
+        self._roots = []
+
+
+def _mount_of(directory):
+    """Return (device, mount point, type) of the file system of directory"""
+    output = subprocess.check_output(
+        ["findmnt", "--noheadings", "--output", "SOURCE,TARGET,FSTYPE",
+         "--target", directory],
+        universal_newlines=True)
+    source, target, fstype = output.split()[:3]
+    # btrfs reports the subvolume as device[/subvolume]
+    return source.split("[")[0], target, fstype
+
+
+class _LvmSnapshot:
+    """Snapshot of the LVM logical volumes holding the directories
+
+    Every volume gets a snapshot volume, mounted read only below a
+    temporary directory.
+    """
+
+    def __init__(self, size="1G"):
+        self.size = size
+        self._volumes = []
+        self._mounts = []
+
+    def create(self, directories):
+        sources = {}
+        mounts = {}
+        name = "keeper-snapshot-{}".format(os.getpid())
+        for directory in directories:
+            device, target, fstype = _mount_of(directory)
+            if device not in mounts:
+                group = subprocess.check_output(
+                    ["lvs", "--noheadings", "--options", "vg_name", device],
+                    universal_newlines=True).strip()
+                subprocess.check_call(
+                    ["lvcreate", "--snapshot", "--size", self.size,
+                     "--name", name, device])
+                volume = "/dev/{}/{}".format(group, name)
+                self._volumes.append(volume)
+                mount_point = tempfile.mkdtemp(prefix="keeper-snapshot-")
+                # XFS refuses to mount a second file system with one UUID
+                options = "ro,nouuid" if fstype == "xfs" else "ro"
+                subprocess.check_call(
+                    ["mount", "-o", options, volume, mount_point])
+                self._mounts.append(mount_point)
+                mounts[device] = (target, mount_point)
+            target, mount_point = mounts[device]
+            sources[directory] = os.path.join(
+                mount_point, os.path.relpath(directory, target))
+        return sources
+
+    def remove(self):
+        for mount_point in self._mounts:
+            subprocess.check_call(["umount", mount_point])
+            os.rmdir(mount_point)
+        for volume in self._volumes:
+            subprocess.check_call(["lvremove", "--force", volume])
+        self._mounts = []
+        self._volumes = []
+
+
+class _BtrfsSnapshot:
+    """Read only snapshot of the btrfs subvolumes holding the directories
+
+    Subvolumes nested below a directory are not part of the snapshot.
+    """
+
+    def __init__(self):
+        self._snapshots = []
+
+    def create(self, directories):
+        sources = {}
+        snapshots = {}
+        for directory in directories:
+            device, target, fstype = _mount_of(directory)
+            if target not in snapshots:
+                snapshot = os.path.join(
+                    target, ".keeper-snapshot-{}".format(os.getpid()))
+                subprocess.check_call(
+                    ["btrfs", "subvolume", "snapshot", "-r", target,
+                     snapshot])
+                self._snapshots.append(snapshot)
+                snapshots[target] = snapshot
+            sources[directory] = os.path.join(
+                snapshots[target], os.path.relpath(directory, target))
+        return sources
+
+    def remove(self):
+        for snapshot in self._snapshots:
+            subprocess.check_call(
+                ["btrfs", "subvolume", "delete", snapshot])
+        self._snapshots = []
+
+
+# Directories a hard link snapshot copies, since their files are modified
+# in place and a hard link would follow the changes
+SNAPSHOT_COPIED = [DATABASE_DIRECTORY]
+
+SNAPSHOT_METHODS = collections.OrderedDict([
+    ("lvm", _LvmSnapshot),
+    ("btrfs", _BtrfsSnapshot),
+    ("reflink", functools.partial(_CopySnapshot, link=False)),
+    ("hardlink", functools.partial(_CopySnapshot, link=True)),
+])
+
+
+# Where the rundeckd init script writes its pid
+RUNDECK_PIDFILES = ["/var/run/rundeckd.pid", "/run/rundeckd.pid"]
+# cgroup of the rundeckd unit when systemd runs it, on cgroup v2
+RUNDECK_CGROUP = "/sys/fs/cgroup/system.slice/rundeckd.service"
+# Seconds a rundeckd status is trusted before it is checked again
+RUNDECK_STATUS_TTL = 5
+
+
+def _is_rundeck_process(pid):
+    """Return True if pid is a java process running rundeck"""
+    try:
+        with open("/proc/{}/cmdline".format(pid), "rb") as fileobj:
+            arguments = fileobj.read().split(b"\0")
+    except OSError:
+        return False
+    return os.path.basename(arguments[0]) == b"java" and \
+        any(b"rundeck" in argument.lower() for argument in arguments[1:])
+
+
+def _status_from_pidfile():
+    """Return True if a pidfile names a running rundeckd, None otherwise
+
+    A stale pidfile is left behind when rundeckd crashes, or when it was
+    restarted without rewriting it, so it does not tell that rundeckd is
+    stopped. The other detectors decide then.
+    """
+    for path in RUNDECK_PIDFILES:
+        try:
+            with open(path) as fileobj:
+                pid = int(fileobj.read().strip())
+        except (OSError, ValueError):
+            continue
+        if _is_rundeck_process(pid):
+            return True
+    return None
+
+
+def _has_systemd():
+    """Return True if systemd manages the services of this machine"""
+    return os.path.isdir("/run/systemd/system")
+
+
+def _status_from_systemd():
+    """Return the rundeckd status from systemd, None without the unit"""
+    if not _has_systemd():
+        return None
+    # systemd removes the cgroup of a unit when it stops
+    procs = os.path.join(RUNDECK_CGROUP, "cgroup.procs")
+    if os.path.isfile(procs):
+        with open(procs) as fileobj:
+            return bool(fileobj.read().strip())
+    try:
+        output = subprocess.check_output(
+            ["systemctl", "show", "--property=LoadState,ActiveState",
+             "rundeckd"],
+            universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    properties = dict(
+        line.split("=", 1) for line in output.splitlines() if "=" in line)
+    if properties.get("LoadState") != "loaded":
+        return None
+    return properties.get("ActiveState") in ("active", "activating",
+                                             "reloading")
+
+
+def _status_from_service():
+    """Return the rundeckd status from its init script
+
+    None if there is no service command or no rundeckd service.
+    """
+    try:
+        status = subprocess.check_output(
+            ["service", "rundeckd", "status"],
+            # Universal newlines ensures error.output is a string
+            universal_newlines=True,
+            stderr=subprocess.DEVNULL
+        )
+    except FileNotFoundError:
+        return None
+    except subprocess.CalledProcessError as error:
+        if "rundeckd" not in error.output:
+            logging.debug("service does not know rundeckd")
+            return None
+        else:
+            status = error.output
+    if "rundeckd" in status and "running" in status:
+        return True
+    else:
+        return False
+
+
+def _status_from_processes():
+    """Return True if any process is rundeck, None without /proc"""
+    if not os.path.isdir("/proc"):
+        return None
+    return any(
+        _is_rundeck_process(name) for name in os.listdir("/proc")
+        if name.isdigit()
+    )
+
+
+# Checks in order of cost; the first that can tell decides
+RUNDECK_DETECTORS = [
+    _status_from_pidfile,
+    _status_from_systemd,
+    _status_from_service,
+    _status_from_processes,
+]
+
+_rundeck_status = {}
+_rundeck_status_lock = threading.Lock()
+
+
+def _rundeck_service_command(action):
+    """Return the command that starts or stops rundeckd"""
+    if _has_systemd():
+        return ["systemctl", action, "rundeckd"]
+    return ["service", "rundeckd", action]
+
+
+def _detect_rundeck():
+    for detector in RUNDECK_DETECTORS:
+        running = detector()
+        if running is not None:
+            logging.debug("rundeckd {} according to {}".format(
+                "running" if running else "not running", detector.__name__))
+            return running
+    raise Exception("cannot tell if rundeckd is running on this machine")
+
+
+def rundeck_is_running(ttl=RUNDECK_STATUS_TTL):
+    """Return True if rundeckd is running
+
+    The answer is cached in the process for `ttl` seconds.
+    """
+    with _rundeck_status_lock:
+        checked = _rundeck_status.get("checked")
+        if checked is None or time.monotonic() - checked >= ttl:
+            _rundeck_status["running"] = _detect_rundeck()
+            _rundeck_status["checked"] = time.monotonic()
+        return _rundeck_status["running"]
+
+
+def _forget_rundeck_status():
+    """Check the status again next time, after starting or stopping"""
+    with _rundeck_status_lock:
+        _rundeck_status.clear()
+
+
+SHARDS_MANIFEST = "shards.json"
+SHARDS_VERSION = 1
+
+# Directory of the cold tier in a destination directory, and how it is
+# compressed
+COLD_DIRECTORY = "cold"
+COLD_COMPRESSION = "xz"
+COLD_LEVEL = 9
+
+
+def _plan_chunks(root, limit, executor, walk_filter=None):
+    """Split a directory tree into chunks of about limit bytes of files
+
+    A chunk is a list of (relative path, names) items. A directory larger
+    than limit is split into its entries, down to single files, and then
+    appears in one chunk with the names it had, instead of None. Entries
+    walk_filter leaves out are not in any chunk.
+    """
+    sizes = collections.Counter()
+    walked = set()
+    for path, status in _parallel_walk([root], executor,
+                                       walk_filter=walk_filter):
+        walked.add(os.path.relpath(path, root))
+        if stat.S_ISREG(status.st_mode):
+            relative = os.path.relpath(path, root)
+            parent = os.path.dirname(relative)
+            while True:
+                sizes[parent] += status.st_size
+                if not parent:
+                    break
+                parent = os.path.dirname(parent)
+            sizes[relative] = status.st_size
+    items = []
+
+    def _split(relative):
+        path = os.path.join(root, relative) if relative else root
+        if sizes[relative] <= limit or not os.path.isdir(path):
+            items.append((relative, None, sizes[relative]))
+            return
+        names = sorted(os.listdir(path))
+        items.append((relative, names, 0))
+        for name in names:
+            if walk_filter is None or os.path.join(relative, name) in walked:
+                _split(os.path.join(relative, name))
+
+    _split("")
+    chunks = [[]]
+    size = 0
+    for relative, names, item_size in items:
+        if chunks[-1] and size + item_size > limit:
+            chunks.append([])
+            size = 0
+        chunks[-1].append((relative, names))
+        size += item_size
+    return chunks
+
+
+def _chunk_walk(items, walk_filter=None):
+    """Return a walk for backup() over one chunk of _plan_chunks
+
+    Entries created in a split directory since it was planned are in no
+    chunk, so they are walked with the chunk that holds the directory.
+    """
+    def _walk_chunk(roots, executor):
+        for root in roots:
+            for relative, names in items:
+                path = os.path.join(root, relative) if relative else root
+                try:
+                    status = os.stat(path)
+                except OSError as error:
+                    logging.warning("skipping unreadable path {}: {}".format(
+                        path, error))
+                    continue
+                yield path, status
+                if names is not None:
+                    if set(os.listdir(path)).issubset(names):
+                        continue
+                    names = set(names)
+                    for subpath, substatus in _scan_directory(
+                            path, walk_filter):
+                        if os.path.basename(subpath) in names:
+                            continue
+                        yield subpath, substatus
+                        if stat.S_ISDIR(substatus.st_mode):
+                            yield from _walk_scanned(
+                                executor.submit(
+                                    _scan_directory, subpath, walk_filter),
+                                executor, 16, walk_filter)
+                elif stat.S_ISDIR(status.st_mode):
+                    yield from _walk_scanned(
+                        executor.submit(_scan_directory, path, walk_filter),
+                        executor, 16, walk_filter)
+    return _walk_chunk
+
+
+def _read_shards(path):
+    """Return the top level manifest of a sharded backup"""
+    with open(os.path.join(path, SHARDS_MANIFEST)) as fileobj:
+        shards = json.load(fileobj)
+    if shards.get("version") != SHARDS_VERSION:
+        raise Exception("unsupported file version in {}".format(
+            os.path.join(path, SHARDS_MANIFEST)))
+    return shards
 
 
 class Keeper:
@@ -21,21 +3406,14 @@ class Keeper:
                               " or restore from backup")
                 raise Exception("rundeckd is still running")
             else:
-                logging.warning("rundeckd is running! Proceeding anyways due to --ignore-running flag")
+                logging.warning("rundeckd is running! Proceeding anyways")
 
         self.count = 0
         self.bar = None
         # Directories to include in backup and restore
         if system_directories is None:
             # Default is to backup and restore all directories
-            self.system_directories = [
-                # ToDo: add /etc/rundeck/realm.properties for user auth?
-                "/var/lib/rundeck/data",          # database
-                "/var/lib/rundeck/logs",          # execution logs (biggest)
-                "/var/lib/rundeck/.ssh",          # ssh keys
-                "/var/lib/rundeck/var/storage",   # keystore files and metadata
-                "/var/rundeck/projects"           # project definitions
-            ]
+            self.system_directories = list(SYSTEM_DIRECTORIES)
         else:
             self.system_directories = system_directories
 
@@ -52,122 +3430,1592 @@ class Keeper:
                     "relative paths not allowed, please fix {}".format(path)
                 )
 
+    def _rundeck_service(self, action):
+        """Run a service command for rundeckd, through systemd if it runs"""
+        logging.info("{} rundeckd".format(action))
+        try:
+            subprocess.check_call(_rundeck_service_command(action))
+        finally:
+            _forget_rundeck_status()
+
+    @contextlib.contextmanager
+    def snapshot(self, method):
+        """Snapshot the directories for an online backup
+
+        rundeckd is stopped, if it is running, only while the snapshot is
+        taken, and started again right away. Yields a dict mapping each
+        directory to where it can be read in the snapshot, which is
+        removed on exit. method is one of SNAPSHOT_METHODS.
+        """
+        snapshot = SNAPSHOT_METHODS[method]()
+        directories = [
+            directory for directory in self.system_directories
+            if os.path.isdir(directory)
+        ]
+        running = self._rundeck_is_running()
+        if running:
+            self._rundeck_service("stop")
+        started = time.monotonic()
+        try:
+            sources = snapshot.create(directories)
+        except BaseException:
+            snapshot.remove()
+            raise
+        finally:
+            if running:
+                self._rundeck_service("start")
+        logging.info("{} snapshot taken in {:.1f} seconds".format(
+            method, time.monotonic() - started))
+        try:
+            yield sources
+        finally:
+            snapshot.remove()
+
     def _has_duplicate_or_overlap(self, paths):
         """Return true if list of paths has duplicate or overlapping paths"""
-        if len(paths) > 1:
-            # TODO: This seems inefficient; see if there's a simpler deduper possible
-            first = paths[0]
-            remaining = paths[1:]
-            for item in remaining:
-                if first in item or item in first:
-                    logging.error("found conflicting paths {},{}".format(
-                        first,
-                        item
-                    ))
-                    return True
-            self._has_duplicate_or_overlap(remaining)
+        # Sorting by component puts every path right before the paths
+        # inside it, so comparing neighbours is enough
+        # / has no components, so it comes first and contains everything
+        parts = sorted(
+            ([part for part in _archive_name(path).split("/") if part], path)
+            for path in paths
+        )
+        for (first_parts, first), (item_parts, item) in zip(parts,
+                                                             parts[1:]):
+            if item_parts[:len(first_parts)] == first_parts:
+                logging.error("found conflicting paths {},{}".format(
+                    first,
+                    item
+                ))
+                return True
         return False
 
     def _rundeck_is_running(self):
         """Return True if rundeckd is running, False otherwise"""
-        try:
-            status = subprocess.check_output(
-                ["service", "rundeckd", "status"],
-                # Universal newlines ensures error.output is a string
-                universal_newlines=True
-            )
-        except subprocess.CalledProcessError as error:
-            if "rundeckd" not in error.output:
-                raise Exception(
-                    "error running service command, "
-                    "is rundeckd installed on this machine?"
-                )
-            else:
-                status = error.output
-        if "rundeckd" in status and "running" in status:
-            return True
+        return rundeck_is_running()
+
+    def _backup_totals(self, destination_path, base, directories, executor):
+        """Return (files, bytes) expected in a backup, for progress
+
+        Taken from the base manifest or the newest manifest in the
+        destination, or else from a scan of the directories.
+        """
+        manifest_path = base
+        if manifest_path is None and destination_path is not None:
+            manifests = [
+                os.path.join(destination_path, name)
+                for name in os.listdir(destination_path)
+                if name.endswith(MANIFEST_SUFFIX)
+            ]
+            if manifests:
+                manifest_path = max(manifests, key=os.path.getmtime)
+        files = size = 0
+        if manifest_path is not None:
+            logging.debug("progress totals from {}".format(manifest_path))
+            header, records = _read_manifest(manifest_path)
+            for record in records:
+                if record.get("type") == "f":
+                    files += 1
+                    size += record["size"]
         else:
-            return False
+            logging.debug("scanning directories for progress totals")
+            for path, status in _parallel_walk(directories, executor):
+                if stat.S_ISREG(status.st_mode):
+                    files += 1
+                    size += status.st_size
+        return files, size
+
+    def backup(self, destination_path, filename, jobs=1,
+               compression="gzip", level=None, base=None,
+               hash_files=False, read_jobs=4, progress=False,
+               stats_path=None, checksums=True, fileobj=None, sources=None,
+               walk=None, dedup=True, catalog=True, resume=False,
+               checkpoint_size=CHECKPOINT_SIZE, throttle=None,
+               walk_filter=None):
+        """Create a backup file
+
+        The tar stream is compressed in blocks on `jobs` worker threads,
+        using the codec named by `compression`. Directories are walked and
+        files are read ahead on `read_jobs` threads, feeding the single
+        tar writer in a deterministic order. A manifest of all files is
+        written next to the backup file. If `base` is the manifest of an
+        earlier backup, only new or changed files are archived.
+
+        Unless `checksums` is false, the sha256 of every archived file is
+        stored in a last member of the backup file, for verify.
+
+        Unless `dedup` is false, a file that is the same inode as, or has
+        the same content as, a file already archived is stored as a hard
+        link to it.
+
+        If `fileobj` is given, such as stdout, the backup is streamed to
+        it instead. Memory use does not depend on the size of the backup.
+        The manifest and index are still written to destination_path,
+        unless it is None.
+
+        `sources` maps directories to where they are read from instead,
+        such as a snapshot(). Files keep the names of the directories.
+
+        `walk` replaces _parallel_walk for finding the files, such as the
+        file-state cache of a Daemon. Unless `catalog` is false, the
+        backup is added to the catalog of destination_path.
 
-    def backup(self, destination_path, filename):
-        """Create a backup file"""
+        A backup file is checkpointed every `checkpoint_size` bytes of tar
+        stream: everything archived so far is written out and the
+        position is saved in a journal next to it. With `resume`, an
+        interrupted backup of the same name continues from its last
+        checkpoint.
+
+        An IOThrottle passed as `throttle` paces reading the files and
+        writing the backup file, so a running Rundeck is not slowed
+        down. Large files are then not read ahead.
+
+        Files a WalkFilter passed as `walk_filter` leaves out are not
+        archived, and an incremental backup records them as deleted.
+
+        With `progress`, files, bytes, ratio, throughput and ETA are
+        logged while the backup runs. If `stats_path` is given, the final
+        statistics with timings per directory are written there as JSON.
+        """
         # Start message
         logging.debug("starting backup")
 
-        if not os.path.exists(destination_path):
+        if fileobj is not None:
+            logging.debug("streaming backup {}".format(filename))
+        if destination_path is not None and \
+                not os.path.exists(destination_path):
             logging.debug("backup directory {} not found; creating now".format(
                 destination_path))
             os.makedirs(destination_path)
 
-        file_path = os.path.join(destination_path, filename)
-        logging.debug("using full backup path {}".format(file_path))
+        if destination_path is not None:
+            file_path = os.path.join(destination_path, filename)
+            logging.debug("using full backup path {}".format(file_path))
+        codec = get_codec(compression)
+        logging.debug("compressing with {}".format(codec.name))
+
+        header = {
+            "version": MANIFEST_VERSION,
+            "archive": filename,
+            "created": datetime.now().isoformat(),
+            "type": "full",
+            "base": None,
+            "directories": self.system_directories,
+        }
+        if base is None:
+            base_records = {}
+        else:
+            logging.info("loading base manifest {}".format(base))
+            base_header, base_records = _load_manifest(base)
+            header["type"] = "incremental"
+            header["base"] = base_header["archive"]
+        stored = 0
+
+        journal_path = journal = None
+        if destination_path is not None and fileobj is None and \
+                checkpoint_size:
+            journal_path = file_path + JOURNAL_SUFFIX
+        if resume:
+            if journal_path is None:
+                raise Exception("only backups written to a file can be "
+                                "resumed")
+            journal = _read_journal(journal_path)
+            started = journal["header"]
+            if journal["codec"] != codec.name or \
+                    started["directories"] != header["directories"] or \
+                    started["base"] != header["base"]:
+                raise Exception("{} was started with other options".format(
+                    file_path))
+            header["created"] = started["created"]
+            stored = journal["stored"]
+            checksums = journal["checksums"] is not None
+            logging.info("resuming backup {} after {}".format(
+                file_path, "/".join(journal["position"][1:])))
+        elif journal_path is not None and os.path.exists(journal_path):
+            logging.warning("starting {} over, discarding its "
+                            "checkpoints".format(file_path))
+            os.remove(journal_path)
+        members = _PathTrie(self.system_directories)
+        order = dict(
+            (directory, index)
+            for index, directory in enumerate(self.system_directories))
+
+        def _position(name):
+            """Position of a file in the walk, comparable as a list"""
+            return [order[members.find(name)]] + name.split("/")
 
         # Create tar file and save all directories to it
-        with tarfile.open(file_path, mode='w:gz', dereference=True) as archive:
+        with contextlib.ExitStack() as stack:
+            resume_at = collections.defaultdict(lambda: None, journal or {})
+            if destination_path is None:
+                manifest = index = _DiscardWriter()
+            else:
+                manifest = stack.enter_context(_JsonLinesWriter(
+                    file_path + MANIFEST_SUFFIX, header,
+                    resume_at["manifest"]))
+                index = stack.enter_context(_IndexWriter(
+                    file_path + INDEX_SUFFIX,
+                    {"version": INDEX_VERSION, "archive": filename,
+                     "codec": codec.name},
+                    resume_at["index"]
+                ))
+            if fileobj is not None:
+                output = fileobj
+            elif journal is not None:
+                # Whatever was written after the checkpoint is cut off
+                output = stack.enter_context(open(file_path, "r+b"))
+                output.truncate(journal["compressed"])
+                output.seek(journal["compressed"])
+                manifest.count = journal["count"]
+            else:
+                output = stack.enter_context(open(file_path, "wb"))
+            compressor = stack.enter_context(_ParallelCompressor(
+                output, jobs=jobs, codec=codec, level=level,
+                start=(resume_at["tar"] or 0, resume_at["compressed"] or 0),
+                throttle=throttle))
+            checkpointed = compressor.tell()
+            # Sparse files need PAX headers
+            archive = stack.enter_context(tarfile.open(
+                fileobj=compressor, mode='w', dereference=True,
+                format=tarfile.PAX_FORMAT))
+            walk_pool = stack.enter_context(
+                ThreadPoolExecutor(max_workers=max(1, read_jobs)))
+            read_pool = stack.enter_context(
+                ThreadPoolExecutor(max_workers=max(1, read_jobs)))
+            checksum_writer = None
+            if checksums and journal_path is not None:
+                checksum_writer = stack.enter_context(_ChecksumWriter(
+                    file_path + ".checksums", resume_at["checksums"]))
+            elif checksums:
+                checksum_writer = stack.enter_context(_ChecksumWriter())
+            duplicates = _DuplicateFinder(throttle=throttle) \
+                if dedup else None
+            hashing = checksums or dedup
+            directories = []
+            for directory in self.system_directories:
+                if os.path.isdir(directory):
+                    directories.append(directory)
+                else:
+                    logging.warning("skipping missing directory {}".format(
+                        directory
+                    ))
+            # Directories to read, and the directory each one stands for
+            roots = [(sources or {}).get(path, path) for path in directories]
+            originals = dict(zip(roots, directories))
+            # Files are only deduplicated within a backed up directory
+            groups = _PathTrie(directories)
+            renamed = _PathTrie(roots) if sources else None
+            total_files = total_bytes = None
+            if progress:
+                total_files, total_bytes = self._backup_totals(
+                    destination_path, base, roots, walk_pool)
+            self.bar = _Progress("backup", total_files, total_bytes,
+                                 report=progress)
+            self.bar.follow_output(lambda: compressor.compressed)
+
+            excluded = None
+            if walk_filter is not None:
+                excluded = _ExcludedDirectories(walk_filter, directories)
+
+            def _classify(entries):
+                """Decide from metadata which files need to be read"""
+                for path, status in entries:
+                    record = _manifest_record(path, status)
+                    if renamed is not None:
+                        root = renamed.find(record["path"])
+                        record["path"] = _archive_name(
+                            originals[root] + path[len(root):])
+                    # Walks need not be in order, nor filtered
+                    if walk_filter is not None and (
+                            excluded.excludes(
+                                os.path.dirname(record["path"])) or
+                            walk_filter.skips(
+                                record["path"],
+                                lambda: stat.S_ISDIR(status.st_mode)) or
+                            walk_filter.skips_status(record["path"], status)):
+                        continue
+                    previous = base_records.pop(record["path"], None)
+                    changed = _record_changed(record, previous)
+                    if not changed and previous.get("hash"):
+                        record["hash"] = previous["hash"]
+                    yield path, status, changed, record, previous
+
+            def _unfinished(items):
+                """Leave out the files archived before the checkpoint"""
+                items = iter(items)
+                for item in items:
+                    if _position(item[3]["path"]) > journal["position"]:
+                        yield item
+                        break
+                yield from items
+
+            if walk is None:
+                # Snapshot paths are filtered once they are renamed
+                walk = functools.partial(
+                    _parallel_walk,
+                    walk_filter=walk_filter if renamed is None else None)
+            if walk_filter is not None:
+                walk_filter.start()
+            items = _classify(walk(roots, walk_pool))
+            if journal is not None:
+                items = _unfinished(items)
+            for item, data in _prefetch(items, read_pool,
+                                        advise=throttle is None):
+                path, status, changed, record, previous = item
+                if path in originals:
+                    logging.info("adding directory {}".format(
+                        originals[path]))
+                    self.bar.enter(originals[path])
+                self.bar.add(files=1, read=status.st_size
+                             if stat.S_ISREG(status.st_mode) else 0)
+                if changed and hash_files and record["type"] == "f":
+                    record["hash"] = _manifest_record(
+                        path, status, True, data, throttle)["hash"]
+                    changed = _record_changed(record, previous)
+                record["stored"] = changed
+                link = group = None
+                if changed and duplicates is not None and \
+                        stat.S_ISREG(status.st_mode):
+                    group = groups.find(record["path"])
+                    link = duplicates.find(path, status, data, group)
+                    if link is not None:
+                        # Restores that leave out the archived copy
+                        # write it in place of the link instead
+                        record["link"] = link[0]
+                manifest.write(record)
+                if not changed:
+                    continue
+                stored += 1
+                tarinfo = _make_tarinfo(
+                    archive, path, status, record["path"])
+                offset = compressor.tell()
+                digest = None
+                if link is not None:
+                    # Extracts to a hard link to the archived copy, and
+                    # is checked against live files with its checksum
+                    tarinfo.type = tarfile.LNKTYPE
+                    tarinfo.linkname, digest = link
+                    tarinfo.size = 0
+                    archive.addfile(tarinfo)
+                elif data is not None:
+                    # The file may have changed since it was stat'ed
+                    tarinfo.size = len(data)
+                    archive.addfile(tarinfo, io.BytesIO(data))
+                    if hashing:
+                        digest = _sha256(data)
+                elif tarinfo.isreg():
+                    with open(path, "rb") as fileobj:
+                        extents = _data_extents(fileobj, status)
+                        if extents is not None:
+                            # Holes are not archived, nor restored
+                            reader = _SparseReader(
+                                fileobj, extents,
+                                hashlib.sha256() if hashing else None)
+                            archive.addfile(
+                                _sparse_tarinfo(tarinfo, reader), reader)
+                            if hashing:
+                                digest = reader.hexdigest()
+                        elif hashing:
+                            reader = _HashingReader(fileobj)
+                            archive.addfile(tarinfo, reader)
+                            digest = reader.digest.hexdigest()
+                        else:
+                            archive.addfile(tarinfo, fileobj)
+                else:
+                    archive.addfile(tarinfo)
+                if digest is not None and checksum_writer is not None:
+                    checksum_writer.write(
+                        tarinfo.name, digest,
+                        tarinfo.linkname if link is not None else None)
+                if link is None and digest is not None and \
+                        duplicates is not None:
+                    duplicates.add(
+                        tarinfo.name, status, tarinfo.size, digest, group)
+                index.add(tarinfo, offset)
+                index.flush(compressor)
+                if journal_path is not None and \
+                        compressor.tell() - checkpointed >= checkpoint_size:
+                    checkpointed, compressed = compressor.checkpoint()
+                    index.flush(compressor)
+                    _write_journal(journal_path, {
+                        "version": JOURNAL_VERSION,
+                        "header": header,
+                        "codec": codec.name,
+                        "tar": checkpointed,
+                        "compressed": compressed,
+                        "manifest": manifest.checkpoint(),
+                        "count": manifest.count,
+                        "index": index.checkpoint(),
+                        "checksums": checksum_writer and
+                        checksum_writer.checkpoint(),
+                        "stored": stored,
+                        "position": _position(record["path"]),
+                    })
+                    logging.debug("checkpoint after {}".format(path))
+            if checksum_writer is not None:
+                checksum_writer.add_to(archive)
+            archive.close()
+            compressor.close()
+            output.flush()
+            self.bar.finish()
+            index.flush(compressor)
+            total = manifest.count
+
+            # Whatever is left of the base manifest no longer exists
+            for name in sorted(base_records):
+                manifest.write({"path": name, "deleted": True})
+
+        if journal_path is not None and os.path.exists(journal_path):
+            os.remove(journal_path)
+        if fileobj is None and catalog:
+            Catalog(destination_path).add(
+                Catalog.entry(header, os.path.getsize(file_path)))
+        self.count = stored
+        logging.info("backup complete: {} of {} files archived".format(
+            stored, total))
+        if duplicates is not None and duplicates.saved:
+            logging.info("{} of duplicate files stored as hard links".format(
+                _format_bytes(duplicates.saved)))
+        if throttle is not None and throttle.waited:
+            logging.info("throttled for {:.1f} seconds, backed off {} "
+                         "times".format(throttle.waited, throttle.backoffs))
+        if stats_path is not None:
+            self.bar.write_stats(stats_path)
+
+    def backup_sharded(self, destination_path, name, shard_size=None,
+                       shard_jobs=4, sources=None, **options):
+        """Create a sharded backup, one backup file per directory
+
+        The shards are written to the directory destination_path/name, on
+        `shard_jobs` threads, so small directories do not wait for large
+        ones. With `shard_size` in bytes, a directory is split into
+        shards of about that size of files. A top level manifest lists
+        the shards, and the catalog of destination_path has one entry for
+        all of them. Options are passed on to backup. Returns the path of
+        the sharded backup.
+        """
+        if options.get("base") or options.get("stats_path"):
+            raise Exception("sharded backups cannot be incremental or "
+                            "write statistics")
+        catalog = options.pop("catalog", True)
+        # Snapshot paths are not what the filter matches
+        walk_filter = options.get("walk_filter") if not sources else None
+        if walk_filter is not None:
+            walk_filter.start()
+        path = os.path.join(destination_path, name)
+        os.makedirs(path)
+        codec = get_codec(options.get("compression", "gzip"))
+        shards = []
+        # Directories are walked for the plan like backup() walks them
+        walk_jobs = max(1, options.get("read_jobs", 4))
+        with ThreadPoolExecutor(max_workers=walk_jobs) as executor:
+            for index, directory in enumerate(self.system_directories):
+                if not os.path.isdir(directory):
+                    logging.warning("skipping missing directory {}".format(
+                        directory))
+                    continue
+                chunks = [None]
+                if shard_size is not None:
+                    chunks = _plan_chunks(
+                        (sources or {}).get(directory, directory),
+                        shard_size, executor, walk_filter)
+                slug = _archive_name(directory).replace("/", "_")
+                for chunk, items in enumerate(chunks):
+                    shards.append({
+                        "archive": "{:02d}-{}-{:03d}{}".format(
+                            index, slug, chunk, codec.extension),
+                        "directory": directory,
+                        "chunk": chunk,
+                        "items": items,
+                    })
+        logging.info("writing {} shards to {}".format(len(shards), path))
+
+        def _backup_shard(shard):
+            keeper = copy.copy(self)
+            keeper.system_directories = [shard["directory"]]
+            walk = None
+            if shard["items"] is not None:
+                walk = _chunk_walk(shard["items"], walk_filter)
+            # The top level manifest stands for the shards
+            keeper.backup(destination_path=path, filename=shard["archive"],
+                          sources=sources, walk=walk, catalog=False,
+                          **options)
+            return keeper.count
+
+        with ThreadPoolExecutor(max_workers=max(1, shard_jobs)) as executor:
+            counts = list(executor.map(_backup_shard, shards))
+        self.count = sum(counts)
+        for shard, count in zip(shards, counts):
+            del shard["items"]
+            shard["files"] = count
+            shard["size"] = os.path.getsize(
+                os.path.join(path, shard["archive"]))
+        manifest = {
+            "version": SHARDS_VERSION,
+            "created": datetime.now().isoformat(),
+            "directories": self.system_directories,
+            "shards": shards,
+        }
+        temporary = os.path.join(path, SHARDS_MANIFEST + ".tmp")
+        with open(temporary, "w") as fileobj:
+            json.dump(manifest, fileobj, indent=1)
+        os.replace(temporary, os.path.join(path, SHARDS_MANIFEST))
+        if catalog:
+            Catalog(destination_path).add(
+                Catalog.sharded_entry(name, manifest))
+        logging.info("sharded backup complete: {} files in {} shards".format(
+            self.count, len(shards)))
+        return path
+
+    def backup_cold(self, destination_path, min_age,
+                    logs_directory=LOGS_DIRECTORY, **options):
+        """Move old execution logs into the cold tier of destination_path
+
+        The cold tier is a directory of xz compressed backup files of the
+        logs last modified more than min_age seconds ago. Every run adds
+        one holding the old logs that are not in the cold tier yet, as an
+        incremental backup of the one before, so cold backup files are
+        written once and never rewritten. Regular backups leave these
+        logs out with a WalkFilter of the same max_age. Returns the path
+        of the new cold backup file.
+        """
+        if logs_directory not in self.system_directories:
+            raise Exception("{} is not backed up, it has no cold "
+                            "tier".format(logs_directory))
+        path = os.path.join(destination_path, COLD_DIRECTORY)
+        os.makedirs(path, exist_ok=True)
+        base = None
+        entries = Catalog(path).entries()
+        if entries:
+            base = os.path.join(path, entries[-1]["archive"] + MANIFEST_SUFFIX)
+        filename = _backup_filename(
+            get_codec(COLD_COMPRESSION), incremental=base is not None,
+            kind="cold-logs")
+        keeper = copy.copy(self)
+        keeper.system_directories = [logs_directory]
+        options.setdefault("level", COLD_LEVEL)
+        keeper.backup(
+            destination_path=path, filename=filename, base=base,
+            compression=COLD_COMPRESSION,
+            walk_filter=WalkFilter(min_age=min_age, logs=[logs_directory]),
+            **options)
+        self.count = keeper.count
+        return os.path.join(path, filename)
+
+    def backup_remote(self, storage, filename, **options):
+        """Create a backup file in remote storage
+
+        The backup is streamed into the storage as it is written. The
+        manifest and index are written to a temporary directory and
+        stored next to it afterwards. Options are passed on to backup.
+        """
+        with tempfile.TemporaryDirectory() as sidecars:
+            with storage.open_writer(filename) as output:
+                self.backup(sidecars, filename, fileobj=output, **options)
+            for suffix in [MANIFEST_SUFFIX, INDEX_SUFFIX]:
+                storage.put_file(
+                    os.path.join(sidecars, filename + suffix),
+                    filename + suffix)
+        logging.info("stored backup {}".format(filename))
+
+    def restore_remote(self, storage, filename, **options):
+        """Restore files from a backup file in remote storage
+
+        The manifest is fetched first, if there is one, and the backup is
+        then streamed from the storage. Options are passed on to restore.
+        """
+        with tempfile.TemporaryDirectory() as sidecars:
+            filepath = os.path.join(sidecars, filename)
+            storage.get_file(
+                filename + MANIFEST_SUFFIX, filepath + MANIFEST_SUFFIX)
+            with storage.open_reader(filename) as fileobj:
+                self.restore(filepath, fileobj=fileobj, **options)
+
+    def backup_to_store(self, store_path, snapshot_id=None, jobs=1):
+        """Back up all directories into a deduplicating chunk store
+
+        Only chunks that are not in the store yet are written. Files whose
+        size, mtime and inode match the latest snapshot reuse its chunk
+        list without being read at all. Returns the new snapshot id.
+        """
+        store = ChunkStore(store_path)
+        if snapshot_id is None:
+            snapshot_id = datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
+        if snapshot_id in store.snapshots():
+            raise Exception("snapshot {} already exists".format(snapshot_id))
+        header = {
+            "version": MANIFEST_VERSION,
+            "snapshot": snapshot_id,
+            "created": datetime.now().isoformat(),
+            "directories": self.system_directories,
+        }
+        files = reused = 0
+
+        with store.lock(), \
+                ThreadPoolExecutor(max_workers=max(1, jobs)) as executor, \
+                store.write_snapshot(snapshot_id, header) as snapshot:
+            previous = {}
+            snapshots = store.snapshots()
+            if snapshots:
+                logging.info("comparing with snapshot {}".format(
+                    snapshots[-1]))
+                previous_header, records = store.read_snapshot(snapshots[-1])
+                previous = dict((record["path"], record) for record in records)
+
+            directories = []
             for directory in self.system_directories:
                 if os.path.isdir(directory):
-                    logging.info("adding directory {}".format(directory))
-                    archive.add(directory)
+                    directories.append(directory)
                 else:
                     logging.warning("skipping missing directory {}".format(
                         directory
                     ))
+            # Directories are listed and stat'ed ahead on the executor
+            for path, status in _parallel_walk(directories, executor):
+                if path in directories:
+                    logging.info("adding directory {}".format(path))
+                record = _manifest_record(path, status)
+                if record["type"] == "o":
+                    logging.warning("skipping special file {}".format(
+                        path))
+                    continue
+                record.update(
+                    mode=stat.S_IMODE(status.st_mode),
+                    uid=status.st_uid,
+                    gid=status.st_gid,
+                    uname=_user_name(status.st_uid),
+                    gname=_group_name(status.st_gid),
+                )
+                if record["type"] == "f":
+                    files += 1
+                    old = previous.get(record["path"])
+                    if old is not None and "chunks" in old and \
+                            not _record_changed(record, old):
+                        record["chunks"] = old["chunks"]
+                        reused += 1
+                    else:
+                        with open(path, "rb") as fileobj:
+                            record["chunks"] = store.put_file(
+                                fileobj, executor, jobs)
+                snapshot.write(record)
+
+        logging.info(
+            "backup complete: snapshot {}, {} files, {} unchanged".format(
+                snapshot_id, files, reused)
+        )
+        return snapshot_id
+
+    def restore_snapshot(self, store_path, snapshot_id, dry_run=False):
+        """Restore files from a snapshot in a deduplicating chunk store
+
+        With `dry_run`, only the check for existing files is done.
+        """
+        store = ChunkStore(store_path)
+        restore_paths = _PathTrie(self.system_directories)
+
+        logging.info(
+            "checking restore paths to avoid overwriting existing files..."
+        )
+        header, records = store.read_snapshot(snapshot_id)
+        self._check_paths_before_restore(
+            record["path"] for record in records
+            if restore_paths.match(record["path"])
+        )
+        if dry_run:
+            logging.info("dry run: no existing files would be overwritten")
+            return
+
+        count = 0
+        directories = []
+        header, records = store.read_snapshot(snapshot_id)
+        for record in records:
+            if not restore_paths.match(record["path"]):
+                continue
+            target = os.path.join("/", record["path"])
+            logging.debug("restoring {}".format(record["path"]))
+            count += 1
+            if record["type"] == "d":
+                os.makedirs(target, exist_ok=True)
+                directories.append(record)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                descriptor = os.open(
+                    target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                _refuse_existing(target)
+            with os.fdopen(descriptor, "wb") as target_file:
+                for digest in record["chunks"]:
+                    target_file.write(store.get_chunk(digest))
+            _apply_attributes(target, record)
+
+        # Directory attributes last, deepest first
+        directories.sort(key=lambda record: record["path"], reverse=True)
+        for record in directories:
+            _apply_attributes(os.path.join("/", record["path"]), record)
+        logging.info("restore complete: {} files from snapshot {}".format(
+            count, snapshot_id))
+
+    def _check_paths_before_restore(self, names):
+        """Check all files and raise an exception if any already exists
+
+        Every existing file is logged before the exception is raised.
+        """
+        existing = _find_existing(names)
+        for full_path in existing:
+            logging.error(
+                "no action taken, refusing to restore when"
+                " file already exists on file system: {}".format(
+                    full_path
+                )
+            )
+        if len(existing) == 1:
+            raise Exception(
+                "refusing to overwrite existing file: {}".format(
+                    existing[0]
+                )
+            )
+        if existing:
+            raise Exception(
+                "refusing to overwrite {} existing files, first: {}".format(
+                    len(existing), existing[0]
+                )
+            )
+
+    def _restore_stream(self, filepath, select, writer, fileobj=None,
+                        copies=None):
+        """Restore members of a backup file in a single streaming pass
+
+        select(name) returns the directory a member is restored into, or
+        None to skip it. `copies` maps the names of skipped members to the
+        hard link members that are restored as copies of them.
+        """
+        copies = copies or {}
+        copied = set()
+        with _open_backup_file(filepath, progress=self.bar,
+                               fileobj=fileobj) as archive:
+            for tarinfo in _iter_stream(archive):
+                directory = select(tarinfo.name)
+                if directory is None:
+                    for name in copies.get(tarinfo.name, ()):
+                        member = copy.copy(tarinfo)
+                        member.name = name
+                        self.bar.enter(select(name))
+                        logging.debug("restoring {}".format(name))
+                        writer.add(archive, member)
+                        copied.add(name)
+                    continue
+                self.bar.enter(directory)
+                if tarinfo.name in copied:
+                    # Written already, it only needs its own attributes
+                    writer.flush()
+                    _set_attributes(
+                        archive, tarinfo, os.path.join("/", tarinfo.name))
+                    continue
+                logging.debug("restoring {}".format(tarinfo.name))
+                self._restore_member(filepath, archive, tarinfo, select,
+                                     writer)
+            # Files must be complete before the archive is closed
+            writer.flush()
+
+    def _restore_indexed(self, filepath, index_path, select, writer):
+        """Restore members of a backup file found through its index
 
-        logging.info("backup complete")
-
-    def restore(self, filepath, directories=None):
-        """Restore files from a backup tar file"""
-        def _check_paths_before_restore(pathlist):
-            """Check all files and raise exceptions if any already exists"""
-            for path in pathlist:
-                full_path = os.path.join("/", path.name)
-                if (os.path.isfile(full_path)):
-                    logging.error(
-                        "no action taken, refusing to restore when"
-                        " file already exists on file system: {}".format(
-                            full_path
-                        )
-                    )
-                    raise Exception(
-                        "refusing to overwrite existing file: {}".format(
-                            full_path
-                        )
-                    )
-        logging.info("loading backup file...")
-        with tarfile.open(filepath, 'r:gz') as archive:
-            all_files = archive.getmembers()
-            # All filenames go here
-            files_to_restore = []
-            for tarinfo in all_files:
-                # Check each directory against all files
-                for path in self.system_directories:
-                    # Remove any '/' from the start of the path
-                    if path.startswith('/'):
-                        path = path[1:]
-                    # Save each individual file for later checking existence
-                    if tarinfo.name.startswith(path):
-                        files_to_restore.append(tarinfo)
-                        logging.debug("path: " + path)
+        Only the blocks holding members for which select(name) returns a
+        directory are read.
+        """
+        header, entries = _read_index(index_path)
+        for archive, tarinfo in _iter_indexed(
+                filepath,
+                (entry for entry in entries if select(entry[0]) is not None)):
+            self.bar.enter(select(tarinfo.name))
+            logging.debug("restoring {}".format(tarinfo.name))
+            self._restore_member(filepath, archive, tarinfo, select, writer)
+        writer.flush()
+
+    def _restore_member(self, filepath, archive, tarinfo, select, writer):
+        """Restore a member, also a hard link to a file that is not
+
+        The file a hard link member links to is archived earlier in the
+        same backup file. If it is not restored from there, because of
+        --only or a newer version in a restore chain, it is read through
+        the index and written in place of the link.
+        """
+        if not tarinfo.islnk() or select(tarinfo.linkname) is not None:
+            writer.add(archive, tarinfo)
+            return
+        index_path = filepath + INDEX_SUFFIX
+        entry = None
+        if filepath != "-" and os.path.isfile(index_path):
+            header, entries = _read_index(index_path)
+            with contextlib.closing(entries):
+                for entry in entries:
+                    if entry[0] == tarinfo.linkname:
+                        break
+                else:
+                    entry = None
+        if entry is None:
+            raise Exception(
+                "cannot restore {}, a hard link to {} which is not "
+                "restored, without the index of {}".format(
+                    tarinfo.name, tarinfo.linkname, filepath))
+        for source_archive, source in _iter_indexed(filepath, [entry]):
+            member = copy.copy(source)
+            for attribute in ["name", "mode", "uid", "gid", "uname",
+                              "gname", "mtime"]:
+                setattr(member, attribute, getattr(tarinfo, attribute))
+            writer.add(source_archive, member)
+            writer.flush()
+
+    def _restore_journal(self, filepath, streamed, resume):
+        """Return the journal of a resumable restore, or None
+
+        With `resume`, the journal of an interrupted restore is continued,
+        or a new one is started if there is none.
+        """
+        if not resume:
+            return None
+        if streamed:
+            raise Exception("only restores from a backup file can be resumed")
+        path = filepath + RESTORE_JOURNAL_SUFFIX
+        if not os.path.exists(path):
+            logging.info("journaling restore to {}".format(path))
+            return _RestoreJournal(path)
+        journal = _RestoreJournal(path, True)
+        logging.info("resuming restore from {}, {} files restored "
+                     "already".format(filepath, len(journal.done)))
+        return journal
+
+    def _open_restore_journal(self, journal):
+        """Start journaling a restore, if the journal can be written"""
+        if journal is None:
+            return None
+        try:
+            journal.open()
+        except OSError as error:
+            if journal.done:
+                raise
+            logging.warning("restore cannot be resumed, no journal: "
+                            "{}".format(error))
+            return None
+        return journal
+
+    def restore(self, filepath, directories=None, only=None, jobs=1,
+                progress=False, stats_path=None, dry_run=False,
+                fileobj=None, hardlinks=False, resume=False):
+        """Restore files from a backup tar file
+
+        The backup file is read once, as a stream. Existing files are
+        looked up in the manifest of the backup before anything is
+        written. Without a manifest, each file is checked atomically as it
+        is created instead.
+
+        If `only` is a glob pattern, only matching files are restored, and
+        the index of the backup is used to read just the blocks that hold
+        them. Files are written on `jobs` worker threads.
+
+        `progress` and `stats_path` report on the restore like they do
+        for backup. With `dry_run`, only the check for existing files is
+        done; the names come from the index when there is no manifest.
+
+        A filepath of "-" reads the backup from stdin. If `fileobj` is
+        given, the backup is read from it, and filepath is only used to
+        find the manifest.
+
+        Files stored as hard links to identical files are restored as
+        copies, unless `hardlinks` is true. If the file a link is to is
+        not restored, its content is written in place of the link.
+
+        With `resume`, the files written are recorded in a journal next to
+        the backup file, and an interrupted restore continues where its
+        journal left off. The files it wrote are not existing files.
+        """
+        restore_paths = _PathTrie(self.system_directories)
+        only_paths = _pattern_matcher(only)
+
+        def _select(name):
+            if not only_paths(name):
+                return None
+            return restore_paths.find(name)
+
+        manifest_path = filepath + MANIFEST_SUFFIX
+        index_path = filepath + INDEX_SUFFIX
+        # A backup read from stdin has no manifest or index
+        streamed = filepath == "-" or fileobj is not None
+        journal = self._restore_journal(filepath, streamed, resume)
+        restored = set()
+        if journal is not None:
+            restored = set(journal.done + journal.unfinished)
+        # Hard link members restored without the file they link to
+        copies = collections.defaultdict(list)
+
+        def _restored(records):
+            for record in records:
+                if record.get("deleted") or \
+                        not record.get("stored", True) or \
+                        _select(record["path"]) is None:
+                    continue
+                if "link" in record and _select(record["link"]) is None:
+                    copies[record["link"]].append(record["path"])
+                if record["path"] not in restored:
+                    yield record["path"]
+
+        if filepath != "-" and os.path.isfile(manifest_path):
             # Check that files don't already exist before restoring
             logging.info(
                 "checking restore paths to avoid overwriting existing files..."
             )
-            _check_paths_before_restore(files_to_restore)
-            logging.info("restoring files into directories {}".format(
-                ",".join(self.system_directories)
-            ))
-
-            restore_members = files_to_restore
-            logging.debug(
-                "restoring files in {}".format(self.system_directories)
+            header, records = _read_manifest(manifest_path)
+            self._check_paths_before_restore(_restored(records))
+        elif dry_run:
+            logging.info("checking restore paths in {}".format(filepath))
+            self._check_paths_before_restore(
+                name for name, size, mode, kind
+                in list_backup(filepath, fileobj=fileobj)
+                if _select(name) is not None and name not in restored
             )
-            archive.extractall(
-                path="/",
-                members=restore_members
+        else:
+            logging.warning(
+                "no manifest found for {}, checking for existing files "
+                "while restoring".format(filepath)
             )
-            logging.info("restore complete: {} files".format(
-                len(files_to_restore)
-            ))
+
+        if dry_run:
+            logging.info("dry run: no existing files would be overwritten")
+            return
+        logging.info("restoring files into directories {}".format(
+            ",".join(self.system_directories)
+        ))
+        total_bytes = None
+        if not streamed:
+            total_bytes = os.path.getsize(filepath)
+        self.bar = _Progress("restore", total_bytes=total_bytes,
+                             report=progress)
+        journal = self._open_restore_journal(journal)
+        with _RestoreWriter(jobs=jobs, progress=self.bar,
+                            hardlinks=hardlinks, journal=journal) as writer:
+            if only is not None and not streamed and \
+                    os.path.isfile(index_path):
+                self._restore_indexed(filepath, index_path, _select, writer)
+            else:
+                self._restore_stream(
+                    filepath, _select, writer, fileobj, copies)
+            writer.close()
+        if journal is not None:
+            os.remove(journal.path)
+        self.bar.finish()
+        self.count = writer.count
+        logging.info("restore complete: {} files".format(writer.count))
+        if stats_path is not None:
+            self.bar.write_stats(stats_path)
+
+    def restore_sharded(self, path, shard=None, shard_jobs=4,
+                        dry_run=False, **options):
+        """Restore a sharded backup, its shards at the same time
+
+        Only the shards of the configured directories are restored, or
+        only the shard named `shard`. Every shard is checked for existing
+        files before any is restored. Options are passed on to restore.
+        """
+        shards = [
+            entry for entry in _read_shards(path)["shards"]
+            if entry["directory"] in self.system_directories and
+            shard in (None, entry["archive"])
+        ]
+        if shard is not None and not shards:
+            raise Exception("no shard {} in {}".format(shard, path))
+
+        def _restore_shard(entry, dry_run):
+            keeper = copy.copy(self)
+            keeper.system_directories = [entry["directory"]]
+            keeper.restore(os.path.join(path, entry["archive"]),
+                           dry_run=dry_run, **options)
+            return keeper.count
+
+        for entry in shards:
+            _restore_shard(entry, True)
+        if dry_run:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, shard_jobs)) as executor:
+            self.count = sum(executor.map(
+                lambda entry: _restore_shard(entry, False), shards))
+        # Chunks of a directory write into the same subdirectories, so their
+        # mtimes are set again once all chunks are restored
+        chunks = collections.Counter(entry["directory"] for entry in shards)
+        for entry in shards:
+            if chunks[entry["directory"]] > 1:
+                header, records = _read_manifest(os.path.join(
+                    path, entry["archive"] + MANIFEST_SUFFIX))
+                directories = [
+                    record for record in records if record.get("type") == "d"
+                ]
+                directories.sort(key=lambda record: record["path"],
+                                 reverse=True)
+                for record in directories:
+                    target = os.path.join("/", record["path"])
+                    if os.path.isdir(target):
+                        os.utime(target, ns=(record["mtime"], record["mtime"]))
+        logging.info("restore complete: {} files from {} shards".format(
+            self.count, len(shards)))
+
+    def restore_chain(self, filepaths, jobs=1, progress=False,
+                      stats_path=None, dry_run=False, hardlinks=False,
+                      resume=False):
+        """Restore a full backup followed by incremental backups
+
+        The manifests are read first to find the backup file that holds
+        the final version of each file. Every backup file is then read
+        once and every file is written once. With `dry_run`, only the
+        chain and the existing files are checked. `hardlinks` and
+        `resume` are as for restore, the journal is kept next to the last
+        backup file.
+        """
+        archive_names = []
+        # Index in filepaths of the backup holding each file
+        owners = {}
+        for index, filepath in enumerate(filepaths):
+            header, records = _read_manifest(filepath + MANIFEST_SUFFIX)
+            if index == 0 and header["type"] != "full":
+                raise Exception(
+                    "restore chain must start with a full backup, "
+                    "got {}".format(filepath)
+                )
+            if index > 0 and header["base"] != archive_names[-1]:
+                raise Exception("{} is not based on {}".format(
+                    filepath, archive_names[-1]))
+            archive_names.append(header["archive"])
+            for record in records:
+                if record.get("deleted"):
+                    owners.pop(record["path"], None)
+                elif record["stored"]:
+                    owners[record["path"]] = index
+
+        restore_paths = _PathTrie(self.system_directories)
+        # Map each file to the backup holding it and its directory
+        owners = dict(
+            (name, (index, restore_paths.find(name)))
+            for name, index in owners.items()
+            if restore_paths.match(name)
+        )
+        journal = self._restore_journal(filepaths[-1], False, resume)
+        restored = set()
+        if journal is not None:
+            restored = set(journal.done + journal.unfinished)
+        logging.info(
+            "checking restore paths to avoid overwriting existing files..."
+        )
+        self._check_paths_before_restore(
+            name for name in owners if name not in restored)
+        if dry_run:
+            logging.info("dry run: no existing files would be overwritten")
+            return
+
+        self.bar = _Progress(
+            "restore",
+            total_bytes=sum(os.path.getsize(path) for path in filepaths),
+            report=progress
+        )
+
+        def _select(index):
+            def _owned(name):
+                owner, directory = owners.get(name, (None, None))
+                return directory if owner == index else None
+            return _owned
+
+        journal = self._open_restore_journal(journal)
+        with _RestoreWriter(jobs=jobs, progress=self.bar,
+                            hardlinks=hardlinks, journal=journal) as writer:
+            for index, filepath in enumerate(filepaths):
+                logging.info("restoring files from {}".format(filepath))
+                self._restore_stream(filepath, _select(index), writer)
+            writer.close()
+        if journal is not None:
+            os.remove(journal.path)
+        self.bar.finish()
+        self.count = writer.count
+        logging.info("restore complete: {} files from {} backups".format(
+            len(owners), len(filepaths)
+        ))
+        if stats_path is not None:
+            self.bar.write_stats(stats_path)
+
+
+# inotify events that change what a backup would record
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+                IN_MOVE_SELF | IN_ONLYDIR)
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class _Inotify:
+    """Collects the paths changed below watched directories
+
+    Uses the Linux inotify API through libc. A thread reads the events,
+    and watches directories created or moved into a watched directory,
+    unless skips(path) is true for them.
+    """
+
+    def __init__(self, skips=None):
+        self.skips = skips
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not supported on this system")
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches = {}
+        self._changed = set()
+        self._created = set()
+        self._overflow = False
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def watch(self, directory):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), INOTIFY_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, "cannot watch {}: {}".format(
+                directory, os.strerror(error)))
+        with self._lock:
+            self._watches[wd] = directory
+
+    def _watch_new(self, directory):
+        """Watch a new directory and everything below it"""
+        for path, subdirectories, _ in os.walk(directory):
+            if self.skips is not None and self.skips(path):
+                subdirectories[:] = []
+                continue
+            try:
+                self.watch(path)
+            except OSError as error:
+                logging.warning(str(error))
+                with self._lock:
+                    self._overflow = True
+
+    def _read(self):
+        while not self._closed.is_set():
+            readable, _, _ = select.select([self._fd], [], [], 1)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+                offset += _INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                self._event(wd, mask, name)
+
+    def _event(self, wd, mask, name):
+        with self._lock:
+            if mask & IN_Q_OVERFLOW:
+                self._overflow = True
+                return
+            directory = self._watches.get(wd)
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+            if directory is None:
+                return
+            path = os.path.join(directory, name) if name else directory
+            self._changed.add(path)
+            if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                # The directory changed too
+                self._changed.add(directory)
+            created = mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO)
+            if created:
+                self._created.add(path)
+        if created:
+            self._watch_new(path)
+
+    def changes(self):
+        """Return (overflowed, changed paths, created directories)
+
+        and start collecting again.
+        """
+        with self._lock:
+            changes = self._overflow, self._changed, self._created
+            self._overflow = False
+            self._changed = set()
+            self._created = set()
+        return changes
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        os.close(self._fd)
+
+
+class _FileStateCache:
+    """Stat results of the backed up files, kept between backups
+
+    A full walk stats every file and watches every directory with
+    inotify. Later walks only stat the paths inotify reported and take
+    everything else from the cache. Without inotify, or when events were
+    lost, every walk is a full walk. Files changed while a full walk
+    lists their directory may be missed until the next full walk. Paths
+    walk_filter leaves out by name are neither walked nor cached.
+    """
+
+    def __init__(self, watch=True, walk_filter=None):
+        self.entries = None
+        self.roots = None
+        self.full_walks = 0
+        self.watcher = None
+        # Sizes and ages are checked by backup(), as they change
+        self.walk_filter = walk_filter and walk_filter.by_name()
+        self.excluded = None
+        if watch:
+            self.watcher = self._new_watcher()
+
+    def _new_watcher(self):
+        try:
+            return _Inotify(skips=self._skips)
+        except (OSError, AttributeError) as error:
+            logging.warning("cannot watch for changes, every backup walks "
+                            "all directories: {}".format(error))
+            return None
+
+    def walk(self, directories, executor, rescan=False):
+        """Yield (path, stat) like _parallel_walk, for backup()"""
+        if self.watcher is not None and self.entries is not None and \
+                self.roots == directories and not rescan:
+            overflowed, changed, created = self.watcher.changes()
+            if not overflowed:
+                self._update(changed, created)
+                logging.info("{} changed paths since the last walk".format(
+                    len(changed)))
+                yield from self.entries.items()
+                return
+            logging.warning("changes were lost, walking all directories")
+        yield from self._full_walk(directories, executor)
+
+    def _full_walk(self, directories, executor):
+        self.entries = None
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = self._new_watcher()
+        self.full_walks += 1
+        if self.walk_filter is not None:
+            self.excluded = _ExcludedDirectories(
+                self.walk_filter, directories)
+        entries = collections.OrderedDict()
+        for path, status in _parallel_walk(directories, executor,
+                                           walk_filter=self.walk_filter):
+            if stat.S_ISDIR(status.st_mode) and self.watcher is not None:
+                try:
+                    self.watcher.watch(path)
+                except OSError as error:
+                    logging.warning("{}, every backup walks all "
+                                    "directories".format(error))
+                    self.watcher.close()
+                    self.watcher = None
+            entries[path] = status
+            yield path, status
+        # Only a complete walk can stand for the directories
+        self.entries = entries
+        self.roots = list(directories)
+
+    def _skips(self, path):
+        """Return whether walk_filter leaves out a path"""
+        if self.excluded is None:
+            return False
+        name = _archive_name(path)
+        return self.excluded.excludes(os.path.dirname(name)) or \
+            self.walk_filter.skips(name, lambda: os.path.isdir(path))
+
+    def _update(self, changed, created):
+        """Stat the changed paths again and walk the created directories"""
+        deleted = []
+        for path in sorted(changed):
+            if self._skips(path):
+                continue
+            try:
+                status = os.stat(path)
+            except OSError:
+                self.entries.pop(path, None)
+                deleted.append(path + "/")
+                continue
+            self.entries[path] = status
+            if path in created and stat.S_ISDIR(status.st_mode):
+                for subpath, substatus in _walk(path):
+                    if not self._skips(subpath):
+                        self.entries[subpath] = substatus
+        if deleted:
+            deleted = tuple(deleted)
+            self.entries = collections.OrderedDict(
+                (path, status) for path, status in self.entries.items()
+                if not path.startswith(deleted))
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+
+
+# Default hours between backups of the daemon
+DAEMON_FULL_INTERVAL = 7 * 24
+DAEMON_INCREMENTAL_INTERVAL = 1
+# Seconds to wait before trying again after a failed backup
+DAEMON_RETRY = 5 * 60
+# Longest sleep between looking at the schedule, so that changes of the
+# clock are noticed
+DAEMON_WAKEUP = 60
+
+
+def _backup_filename(codec, incremental=False, partial=False,
+                     kind="backup"):
+    """Return the default name for a new backup file"""
+    prefix = "rundeck-{}-".format(kind)
+    if incremental:
+        prefix += "incremental-"
+    if partial:
+        prefix += "partial-"
+    return prefix + "{}{}".format(
+        datetime.now().strftime('%Y-%m-%d--%H-%M-%S'), codec.extension)
+
+
+class Daemon:
+    """Takes full and incremental backups of a Keeper on a schedule
+
+    The catalog of destination_path tells when the last backups were
+    taken, so a restarted daemon keeps to the schedule. Each incremental
+    backup is based on the backup before it. Between backups the state of
+    the files is cached in memory, so that incremental backups do not
+    walk all directories again. Intervals are in hours.
+    """
+
+    def __init__(self, keeper, destination_path,
+                 full_interval=DAEMON_FULL_INTERVAL,
+                 incremental_interval=DAEMON_INCREMENTAL_INTERVAL,
+                 ignore_running=False, watch=True, **options):
+        self.keeper = keeper
+        self.destination_path = destination_path
+        self.full_interval = timedelta(hours=full_interval)
+        self.incremental_interval = timedelta(hours=incremental_interval)
+        self.ignore_running = ignore_running
+        self.options = options
+        self.cache = _FileStateCache(
+            watch=watch, walk_filter=options.get("walk_filter"))
+        self.stopped = threading.Event()
+        os.makedirs(destination_path, exist_ok=True)
+
+    def _history(self):
+        """Return the catalog entries of the last full and last backup"""
+        entries = [
+            entry for entry in Catalog(self.destination_path).entries()
+            if entry["directories"] == self.keeper.system_directories and
+            os.path.isfile(os.path.join(
+                self.destination_path, entry["archive"] + MANIFEST_SUFFIX))
+        ]
+        fulls = [entry for entry in entries if entry["type"] == "full"]
+        if not fulls:
+            return None, None
+        return fulls[-1], entries[-1]
+
+    def due(self):
+        """Return the type of the next backup and when it is due"""
+        full, last = self._history()
+        if full is None:
+            return "full", datetime.now()
+        full_at = datetime.fromisoformat(full["created"]) + self.full_interval
+        incremental_at = datetime.fromisoformat(last["created"]) + \
+            self.incremental_interval
+        if full_at <= incremental_at:
+            return "full", full_at
+        return "incremental", incremental_at
+
+    def run_once(self, kind):
+        """Take a backup of the given type now, return its file name"""
+        if not self.ignore_running and self.keeper._rundeck_is_running():
+            raise Exception("rundeckd is still running")
+        full, last = self._history()
+        base = None
+        if kind == "incremental" and last is not None:
+            base = os.path.join(
+                self.destination_path, last["archive"] + MANIFEST_SUFFIX)
+        codec = get_codec(self.options.get("compression", "gzip"))
+        filename = _backup_filename(
+            codec, incremental=base is not None,
+            partial=self.keeper.system_directories != SYSTEM_DIRECTORIES)
+        logging.info("starting scheduled {} backup {}".format(
+            "incremental" if base else "full", filename))
+        self.keeper.backup(
+            destination_path=self.destination_path,
+            filename=filename,
+            base=base,
+            walk=functools.partial(self.cache.walk, rescan=base is None),
+            **self.options)
+        return filename
+
+    def run(self):
+        """Take backups when they are due, until stop() is called"""
+        planned = None
+        try:
+            while not self.stopped.is_set():
+                kind, when = self.due()
+                delay = (when - datetime.now()).total_seconds()
+                if delay > 0:
+                    if planned != (kind, when):
+                        planned = (kind, when)
+                        logging.info("next {} backup at {}".format(
+                            kind, when.isoformat(" ", "seconds")))
+                    self.stopped.wait(min(delay, DAEMON_WAKEUP))
+                    continue
+                try:
+                    self.run_once(kind)
+                except Exception as error:
+                    logging.error("{} backup failed, retrying in {} "
+                                  "seconds: {}".format(
+                                      kind, DAEMON_RETRY, error))
+                    self.stopped.wait(DAEMON_RETRY)
+        finally:
+            self.cache.close()
+
+    def stop(self, *args):
+        """Stop run(), also usable as a signal handler"""
+        logging.info("stopping daemon")
+        self.stopped.set()
+
+
+def _run_backup(keeper, arguments, filename, options):
+    """Write a backup to where the arguments send it"""
+    if arguments.storage:
+        keeper.backup_remote(
+            get_storage(arguments.storage,
+                        part_size=arguments.part_size * 1024 * 1024,
+                        jobs=arguments.transfer_jobs),
+            filename, **options)
+        return
+    output = None
+    if arguments.dest == "-":
+        output = sys.stdout.buffer
+    elif arguments.fd is not None:
+        output = os.fdopen(arguments.fd, "wb", closefd=False)
+    keeper.backup(
+        destination_path=None if output is not None else arguments.dest,
+        filename=filename,
+        fileobj=output,
+        **options)
+
+
+def _throttle(arguments, keeper):
+    """Lower the priority of keeper, return the IOThrottle asked for"""
+    _lower_priority(arguments.nice, arguments.ionice)
+    if arguments.max_read_rate is None and \
+            arguments.max_write_rate is None and \
+            arguments.max_latency is None:
+        return None
+    return IOThrottle(
+        max_read_rate=arguments.max_read_rate and
+        arguments.max_read_rate * 1024 * 1024,
+        max_write_rate=arguments.max_write_rate and
+        arguments.max_write_rate * 1024 * 1024,
+        max_latency=arguments.max_latency,
+        paths=keeper.system_directories)
+
+
+def _walk_filter(arguments):
+    """Return the WalkFilter the arguments ask for, or None"""
+    if not arguments.exclude and not arguments.include and \
+            arguments.max_file_size is None and \
+            arguments.logs_newer_than is None:
+        return None
+    return WalkFilter(
+        exclude=arguments.exclude or (),
+        include=arguments.include or (),
+        max_size=arguments.max_file_size and
+        int(arguments.max_file_size * 1024 * 1024),
+        max_age=arguments.logs_newer_than and
+        arguments.logs_newer_than * 24 * 3600,
+        logs=[LOGS_DIRECTORY])
+
+
+def _add_filter_arguments(parser):
+    """Options that choose the files to back up"""
+    parser.add_argument(
+        '--exclude',
+        type=str,
+        action='append',
+        help='leave out paths matching this glob pattern, and everything '
+             'below them; repeat for more patterns')
+    parser.add_argument(
+        '--include',
+        type=str,
+        action='append',
+        help='only back up files matching this glob pattern; repeat for '
+             'more patterns')
+    parser.add_argument(
+        '--max-file-size',
+        type=float,
+        help='leave out files larger than this many MB')
+    parser.add_argument(
+        '--logs-newer-than',
+        type=float,
+        help='leave out execution logs last modified more than this many '
+             'days ago')
+
+
+def _add_throttle_arguments(parser):
+    """Options that keep backups from slowing down a running Rundeck"""
+    parser.add_argument(
+        '--max-read-rate',
+        type=float,
+        help='read the files at most this many MB/s')
+    parser.add_argument(
+        '--max-write-rate',
+        type=float,
+        help='write the backup file at most this many MB/s')
+    parser.add_argument(
+        '--max-latency',
+        type=float,
+        help='halve the read rate while the disks being backed up take '
+             'longer than this many milliseconds per request')
+    parser.add_argument(
+        '--nice',
+        type=int,
+        help='add this to the CPU nice value of keeper')
+    parser.add_argument(
+        '--ionice',
+        choices=list(IOPRIO_CLASSES),
+        help='I/O scheduling class of keeper, idle only uses the disk '
+             'when no other process does')
+
+
+def _interrupted_backup(destination_path):
+    """Return the name of the interrupted backup in destination_path"""
+    if not destination_path or destination_path == "-" or \
+            not os.path.isdir(destination_path):
+        raise Exception("--resume continues a backup in a --dest directory")
+    names = [
+        name[:-len(JOURNAL_SUFFIX)]
+        for name in sorted(os.listdir(destination_path))
+        if name.endswith(JOURNAL_SUFFIX)
+    ]
+    if len(names) != 1:
+        raise Exception("{} interrupted backups in {}, choose one with "
+                        "--filename".format(len(names), destination_path))
+    return names[0]
 
 
 def main(arguments):
@@ -205,29 +5053,204 @@ def main(arguments):
         system_directories = None
         partial = ""
 
+    if parser_name == "list" and arguments.repo:
+        store = ChunkStore(arguments.repo)
+        for snapshot_id in store.snapshots():
+            header, records = store.read_snapshot(snapshot_id)
+            records.close()
+            print("{} {}".format(snapshot_id, ",".join(header["directories"])))
+        return
+    if parser_name == "list":
+        # Listing only reads the backup file, rundeckd may be running
+        for name, size, mode, kind in list_backup(arguments.file,
+                                                  only=arguments.only):
+            print("{} {:>12} {}".format(
+                stat.filemode(_TYPE_MODES.get(kind, 0) | mode),
+                size,
+                name
+            ))
+        return
+    if parser_name == "verify":
+        # Verifying only reads, rundeckd may be running
+        problems = verify_backup(arguments.file,
+                                 against_live=arguments.against_live,
+                                 jobs=arguments.jobs)
+        for problem in problems:
+            logging.error(problem)
+        if problems:
+            raise Exception("verification of {} failed: {} problems".format(
+                arguments.file, len(problems)))
+        logging.info("verified {}".format(arguments.file))
+        return
+    if parser_name == "prune":
+        retention = dict(daily=arguments.keep_daily,
+                         weekly=arguments.keep_weekly,
+                         monthly=arguments.keep_monthly)
+        if arguments.dest:
+            Catalog(arguments.dest).prune(dry_run=arguments.dry_run,
+                                          **retention)
+            return
+        store = ChunkStore(arguments.repo)
+        forget = list(arguments.forget)
+        if any(retention.values()):
+            forget.extend(snapshot_id for snapshot_id in store.expired(
+                **retention) if snapshot_id not in forget)
+        if arguments.dry_run:
+            for snapshot_id in forget:
+                logging.info("would forget snapshot {}".format(snapshot_id))
+            return
+        store.prune(forget=forget)
+        return
+
     # Restore does not have the option to ignore running, so default to False
     if "ignore_running" in arguments:
         ignore_running = arguments.ignore_running
     else:
         ignore_running = False
+    # An online backup stops rundeckd itself, just for the snapshot
+    online = getattr(arguments, "online", None)
+    if online:
+        ignore_running = True
+    # The daemon looks for rundeckd before each backup instead
+    if parser_name == "daemon":
+        ignore_running = True
     keeper = Keeper(
         system_directories=system_directories,
         ignore_running=ignore_running
     )
 
-    if parser_name == "backup":
-        # Set the name of the backup file to be created
+    if parser_name == "daemon":
+        throttle = _throttle(arguments, keeper)
+        daemon = Daemon(
+            keeper, arguments.dest,
+            full_interval=arguments.full_interval,
+            incremental_interval=arguments.incremental_interval,
+            ignore_running=arguments.ignore_running,
+            watch=arguments.watch,
+            jobs=arguments.jobs,
+            compression=get_codec(arguments.compression).name,
+            level=arguments.level,
+            hash_files=arguments.hash,
+            read_jobs=arguments.read_jobs,
+            checksums=arguments.checksums,
+            throttle=throttle,
+            walk_filter=_walk_filter(arguments))
+        signal.signal(signal.SIGTERM, daemon.stop)
+        signal.signal(signal.SIGINT, daemon.stop)
+        daemon.run()
+    elif parser_name == "backup" and arguments.repo:
+        keeper.backup_to_store(store_path=arguments.repo, jobs=arguments.jobs)
+    elif parser_name == "backup":
+        # Set the name of the backup file to be created, also recorded
+        # for a backup streamed to stdout or a file descriptor
+        codec = get_codec(arguments.compression)
+        if arguments.incremental and not arguments.base:
+            raise Exception("--incremental requires --base")
+        if arguments.cold_tier and (
+                arguments.logs_newer_than is None or not arguments.dest or
+                arguments.dest == "-" or arguments.storage):
+            raise Exception("--cold-tier requires --logs-newer-than and a "
+                            "--dest directory")
         if arguments.filename:
             backup_filename = arguments.filename
+        elif arguments.resume:
+            backup_filename = _interrupted_backup(arguments.dest)
         else:
-            backup_filename = "rundeck-backup-" + partial + "{}.tar.gz".format(
-                datetime.now().strftime('%Y-%m-%d--%H-%M-%S')
-            )
-        keeper.backup(
-            destination_path=arguments.dest,
-            filename=backup_filename)
+            # Incremental and partial backups are named as such
+            backup_filename = _backup_filename(
+                codec, incremental=arguments.incremental,
+                partial=bool(partial))
+        options = dict(
+            jobs=arguments.jobs,
+            compression=codec.name,
+            level=arguments.level,
+            base=arguments.base if arguments.incremental else None,
+            hash_files=arguments.hash,
+            read_jobs=arguments.read_jobs,
+            progress=arguments.progress,
+            stats_path=arguments.stats_json,
+            checksums=arguments.checksums,
+            dedup=arguments.dedup,
+            resume=arguments.resume,
+            throttle=_throttle(arguments, keeper),
+            walk_filter=_walk_filter(arguments))
+        if arguments.shards:
+            if arguments.incremental or arguments.stats_json or \
+                    arguments.resume or not arguments.dest or \
+                    arguments.dest == "-":
+                raise Exception("--shards writes full backups to a --dest "
+                                "directory, without --stats-json or "
+                                "--resume")
+            del options["resume"]
+            options.update(
+                shard_size=arguments.shard_size and
+                arguments.shard_size * 1024 * 1024,
+                shard_jobs=arguments.shard_jobs)
+            # The shards are named inside the directory of the backup
+            if backup_filename.endswith(codec.extension):
+                backup_filename = backup_filename[:-len(codec.extension)]
+        with contextlib.ExitStack() as stack:
+            if online:
+                options["sources"] = stack.enter_context(
+                    keeper.snapshot(online))
+            if arguments.shards:
+                keeper.backup_sharded(arguments.dest, backup_filename,
+                                      **options)
+            else:
+                _run_backup(keeper, arguments, backup_filename, options)
+            if arguments.cold_tier:
+                path = keeper.backup_cold(
+                    arguments.dest, arguments.logs_newer_than * 24 * 3600,
+                    jobs=arguments.jobs, read_jobs=arguments.read_jobs,
+                    checksums=arguments.checksums,
+                    throttle=options["throttle"],
+                    sources=options.get("sources"))
+                logging.info("old execution logs moved to {}".format(path))
+    elif parser_name == "restore" and arguments.repo:
+        if not arguments.snapshot:
+            raise Exception("restoring from --repo requires --snapshot")
+        keeper.restore_snapshot(
+            store_path=arguments.repo, snapshot_id=arguments.snapshot,
+            dry_run=arguments.dry_run)
+    elif parser_name == "restore" and arguments.storage:
+        if len(arguments.file) != 1:
+            raise Exception("--storage restores a single --file")
+        keeper.restore_remote(
+            get_storage(arguments.storage,
+                        part_size=arguments.part_size * 1024 * 1024,
+                        jobs=arguments.transfer_jobs),
+            arguments.file[0], only=arguments.only, jobs=arguments.jobs,
+            progress=arguments.progress, stats_path=arguments.stats_json,
+            dry_run=arguments.dry_run, hardlinks=arguments.hardlinks,
+            resume=arguments.resume)
+    elif parser_name == "restore" and os.path.isdir(arguments.file[0]):
+        if len(arguments.file) != 1:
+            raise Exception("a sharded backup is restored on its own")
+        keeper.restore_sharded(
+            arguments.file[0], shard=arguments.shard,
+            shard_jobs=arguments.shard_jobs, only=arguments.only,
+            jobs=arguments.jobs, progress=arguments.progress,
+            dry_run=arguments.dry_run, hardlinks=arguments.hardlinks,
+            resume=arguments.resume)
     elif parser_name == "restore":
-        keeper.restore(filepath=arguments.file)
+        if len(arguments.file) > 1:
+            if "-" in arguments.file:
+                raise Exception("stdin cannot be used in a restore chain")
+            if arguments.only:
+                raise Exception("--only cannot be used with a restore chain")
+            keeper.restore_chain(filepaths=arguments.file, jobs=arguments.jobs,
+                                 progress=arguments.progress,
+                                 stats_path=arguments.stats_json,
+                                 dry_run=arguments.dry_run,
+                                 hardlinks=arguments.hardlinks,
+                                 resume=arguments.resume)
+        else:
+            keeper.restore(filepath=arguments.file[0], only=arguments.only,
+                           jobs=arguments.jobs, progress=arguments.progress,
+                           stats_path=arguments.stats_json,
+                           dry_run=arguments.dry_run,
+                           hardlinks=arguments.hardlinks,
+                           resume=arguments.resume)
 
 
 def parse_args(args):
@@ -250,11 +5273,37 @@ def parse_args(args):
 
     # Backup options
     backup_parser = subparsers.add_parser('backup', help='create a backup')
-    backup_parser.add_argument(
+    backup_destination = backup_parser.add_mutually_exclusive_group(
+        required=True)
+    backup_destination.add_argument(
         '--dest',
         type=str,
-        required=True,
-        help='path to write backup file to')
+        help='path to write backup file to, or - to stream it to stdout')
+    backup_destination.add_argument(
+        '--fd',
+        type=int,
+        help='stream the backup file to this open file descriptor')
+    backup_destination.add_argument(
+        '--storage',
+        type=str,
+        help='remote storage to stream the backup file into: '
+             's3://bucket/prefix, sftp://user@host/path or a directory')
+    backup_parser.add_argument(
+        '--part-size',
+        type=int,
+        default=PART_SIZE // (1024 * 1024),
+        help='size in MB of the parts sent to or read from --storage '
+             '(default: {})'.format(PART_SIZE // (1024 * 1024)))
+    backup_parser.add_argument(
+        '--transfer-jobs',
+        type=int,
+        default=4,
+        help='number of parts sent to or read from --storage at the same '
+             'time (default: 4)')
+    backup_destination.add_argument(
+        '--repo',
+        type=str,
+        help='path of a deduplicating chunk store to back up into')
     backup_parser.add_argument(
         '--filename',
         type=str,
@@ -265,15 +5314,324 @@ def parse_args(args):
         default=False,
         help='allow backup even if rundeckd is running'
     )
+    backup_parser.add_argument(
+        '--online',
+        choices=list(SNAPSHOT_METHODS),
+        help='stop rundeckd only while the directories are snapshotted '
+             'with this method, then back up from the snapshot')
+    backup_parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of threads used to compress the backup file')
+    backup_parser.add_argument(
+        '--read-jobs',
+        type=int,
+        default=4,
+        help='number of threads used to walk directories and read files '
+             'ahead of the archive writer (default: 4)')
+    backup_parser.add_argument(
+        '--compression',
+        choices=list(CODECS),
+        default='gzip',
+        help='compression codec for the backup file (default: gzip)')
+    backup_parser.add_argument(
+        '--level',
+        type=int,
+        help='compression level, defaults to a codec specific value')
+    backup_parser.add_argument(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='only archive files that changed since the --base backup')
+    backup_parser.add_argument(
+        '--base',
+        type=str,
+        help='manifest file of the backup to base an incremental backup on')
+    backup_parser.add_argument(
+        '--hash',
+        action='store_true',
+        default=False,
+        help='record a checksum of every file in the manifest, so that '
+             'incremental backups can skip files that were only touched')
+    backup_parser.add_argument(
+        '--no-checksums',
+        dest='checksums',
+        action='store_false',
+        default=True,
+        help='do not store file checksums in the backup file for verify')
+    backup_parser.add_argument(
+        '--shards',
+        action='store_true',
+        default=False,
+        help='write a directory with one backup file per directory, '
+             'written at the same time')
+    backup_parser.add_argument(
+        '--shard-size',
+        type=int,
+        help='with --shards, split directories into backup files of about '
+             'this many MB')
+    backup_parser.add_argument(
+        '--shard-jobs',
+        type=int,
+        default=4,
+        help='number of shards written or restored at the same time '
+             '(default: 4)')
+    backup_parser.add_argument(
+        '--no-dedup',
+        dest='dedup',
+        action='store_false',
+        default=True,
+        help='archive every copy of identical files, instead of storing '
+             'copies as hard links')
+    backup_parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='continue an interrupted backup from its last checkpoint, the '
+             'one in --dest unless --filename is given')
+    _add_throttle_arguments(backup_parser)
+    _add_filter_arguments(backup_parser)
+    backup_parser.add_argument(
+        '--cold-tier',
+        action='store_true',
+        default=False,
+        help='also move the execution logs --logs-newer-than leaves out '
+             'into the xz compressed cold tier in --dest')
+    backup_parser.add_argument(
+        '--progress',
+        action='store_true',
+        default=False,
+        help='log files, bytes, throughput and ETA every {} seconds'.format(
+            PROGRESS_INTERVAL))
+    backup_parser.add_argument(
+        '--stats-json',
+        type=str,
+        help='write statistics with timings per directory to this file')
 
     # Restore options
     restore_parser = subparsers.add_parser(
         'restore',
         help='restore from a backup file')
+    restore_source = restore_parser.add_mutually_exclusive_group(
+        required=True)
+    restore_source.add_argument(
+        '--file',
+        type=str,
+        action='append',
+        help='path to backup file to restore from, or - to read it from '
+             'stdin; repeat to restore a full backup followed by its '
+             'incremental backups. A directory is a sharded backup')
+    restore_source.add_argument(
+        '--repo',
+        type=str,
+        help='path of a deduplicating chunk store to restore from')
+    restore_parser.add_argument(
+        '--storage',
+        type=str,
+        help='remote storage to read the --file backup file from')
+    restore_parser.add_argument(
+        '--part-size',
+        type=int,
+        default=PART_SIZE // (1024 * 1024),
+        help='size in MB of the parts sent to or read from --storage '
+             '(default: {})'.format(PART_SIZE // (1024 * 1024)))
+    restore_parser.add_argument(
+        '--transfer-jobs',
+        type=int,
+        default=4,
+        help='number of parts sent to or read from --storage at the same '
+             'time (default: 4)')
+    restore_parser.add_argument(
+        '--snapshot',
+        type=str,
+        help='id of the snapshot to restore from --repo')
+    restore_parser.add_argument(
+        '--only',
+        type=str,
+        help='only restore files matching this glob pattern')
+    restore_parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of threads used to write restored files')
+    restore_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        default=False,
+        help='only check that no existing file would be overwritten')
+    restore_parser.add_argument(
+        '--shard',
+        type=str,
+        help='restore only this backup file of a sharded backup')
+    restore_parser.add_argument(
+        '--shard-jobs',
+        type=int,
+        default=4,
+        help='number of shards of a sharded backup restored at the same '
+             'time (default: 4)')
+    restore_parser.add_argument(
+        '--hardlinks',
+        action='store_true',
+        default=False,
+        help='restore identical files stored as hard links as hard links, '
+             'instead of as separate copies')
+    restore_parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='record the files restored in a journal, and continue an '
+             'interrupted restore from it, skipping the files it restored')
+    restore_parser.add_argument(
+        '--progress',
+        action='store_true',
+        default=False,
+        help='log files, bytes, throughput and ETA every {} seconds'.format(
+            PROGRESS_INTERVAL))
     restore_parser.add_argument(
+        '--stats-json',
+        type=str,
+        help='write statistics with timings per directory to this file')
+
+    # List options
+    list_parser = subparsers.add_parser(
+        'list',
+        help='list the files in a backup file')
+    list_source = list_parser.add_mutually_exclusive_group(required=True)
+    list_source.add_argument(
         '--file',
         type=str,
-        help='path to backup file to restore from')
+        help='path to backup file to list')
+    list_source.add_argument(
+        '--repo',
+        type=str,
+        help='list the snapshots in a deduplicating chunk store')
+    list_parser.add_argument(
+        '--only',
+        type=str,
+        help='only list files matching this glob pattern')
+
+    # Verify options
+    verify_parser = subparsers.add_parser(
+        'verify',
+        help='check a backup file against the checksums stored in it')
+    verify_parser.add_argument(
+        'file',
+        type=str,
+        help='path to backup file to verify')
+    verify_parser.add_argument(
+        '--against-live',
+        action='store_true',
+        default=False,
+        help='also compare the checksums with the files on disk')
+    verify_parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        help='number of threads and processes used for hashing '
+             '(default: number of CPUs)')
+
+    # Daemon options
+    daemon_parser = subparsers.add_parser(
+        'daemon',
+        help='take full and incremental backups on a schedule')
+    daemon_parser.add_argument(
+        '--dest',
+        type=str,
+        required=True,
+        help='directory to write backup files to')
+    daemon_parser.add_argument(
+        '--full-interval',
+        type=float,
+        default=DAEMON_FULL_INTERVAL,
+        help='hours between full backups (default: {})'.format(
+            DAEMON_FULL_INTERVAL))
+    daemon_parser.add_argument(
+        '--incremental-interval',
+        type=float,
+        default=DAEMON_INCREMENTAL_INTERVAL,
+        help='hours between incremental backups (default: {})'.format(
+            DAEMON_INCREMENTAL_INTERVAL))
+    daemon_parser.add_argument(
+        '--no-watch',
+        dest='watch',
+        action='store_false',
+        default=True,
+        help='walk all directories for every backup instead of watching '
+             'them for changes with inotify')
+    daemon_parser.add_argument(
+        '--ignore-running',
+        action='store_true',
+        default=False,
+        help='take backups even if rundeckd is running')
+    daemon_parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help='number of threads used to compress the backup files')
+    daemon_parser.add_argument(
+        '--read-jobs',
+        type=int,
+        default=4,
+        help='number of threads used to walk directories and read files '
+             'ahead of the archive writer (default: 4)')
+    daemon_parser.add_argument(
+        '--compression',
+        choices=list(CODECS),
+        default='gzip',
+        help='compression codec for the backup files (default: gzip)')
+    daemon_parser.add_argument(
+        '--level',
+        type=int,
+        help='compression level, defaults to a codec specific value')
+    daemon_parser.add_argument(
+        '--hash',
+        action='store_true',
+        default=False,
+        help='record a checksum of every file in the manifests')
+    daemon_parser.add_argument(
+        '--no-checksums',
+        dest='checksums',
+        action='store_false',
+        default=True,
+        help='do not store file checksums in the backup files for verify')
+    _add_throttle_arguments(daemon_parser)
+    _add_filter_arguments(daemon_parser)
+
+    # Prune options
+    prune_parser = subparsers.add_parser(
+        'prune',
+        help='remove old backups, or unused chunks from a deduplicating '
+             'chunk store')
+    prune_target = prune_parser.add_mutually_exclusive_group(required=True)
+    prune_target.add_argument(
+        '--dest',
+        type=str,
+        help='directory of backup files to apply the --keep options to')
+    prune_target.add_argument(
+        '--repo',
+        type=str,
+        help='path of the deduplicating chunk store')
+    for period in ['daily', 'weekly', 'monthly']:
+        prune_parser.add_argument(
+            '--keep-' + period,
+            type=int,
+            default=0,
+            help='number of {} backups to keep'.format(period))
+    prune_parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        default=False,
+        help='only log what would be removed')
+    prune_parser.add_argument(
+        '--forget',
+        type=str,
+        nargs='*',
+        default=[],
+        help='ids of snapshots to remove before pruning')
 
     return parser.parse_args(args)
 
@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 
+import collections
+import gzip
+import hashlib
+import io
+import json
 import logging
+import random
 import unittest
 import os
 import glob
 import shutil
+import subprocess
+import sys
 import tarfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
 import keeper
-from keeper import Keeper
+from keeper import CHECKSUMS_MEMBER, Keeper
 
 # Enable verbose logs for tests
 logger = logging.getLogger()
@@ -30,6 +42,59 @@ class MockedKeeper(Keeper):
         pass
 
 
+class FakeS3Client:
+    """In memory stand-in for a boto3 S3 client"""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls["create_multipart_upload"] += 1
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        if PartNumber > 10000:
+            raise Exception("part number must be at most 10000")
+        with self.lock:
+            self.calls["upload_part"] += 1
+            self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(
+            parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def _missing(self):
+        error = Exception("not found")
+        error.response = {"Error": {"Code": "404"}}
+        return error
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self._missing()
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key, Range):
+        with self.lock:
+            self.calls["get_object"] += 1
+        start, end = Range[len("bytes="):].split("-")
+        data = self.objects[(Bucket, Key)][int(start):int(end) + 1]
+        return {"Body": io.BytesIO(data)}
+
+
 class TestKeeper(unittest.TestCase):
     """Tests for `keeper.py`"""
 
@@ -50,6 +115,22 @@ class TestKeeper(unittest.TestCase):
         """
         shutil.rmtree(path)
 
+    def _list_tree(self, path, skip=None):
+        """Returns (path, size, mtime) of everything below path"""
+        tree = []
+        for directory, subdirectories, names in os.walk(path):
+            if skip in subdirectories:
+                subdirectories.remove(skip)
+            for name in names:
+                status = os.stat(os.path.join(directory, name))
+                tree.append((os.path.join(directory, name), status.st_size,
+                             int(status.st_mtime)))
+            for name in subdirectories:
+                status = os.stat(os.path.join(directory, name))
+                tree.append((os.path.join(directory, name), 0,
+                             int(status.st_mtime)))
+        return sorted(tree)
+
     def _list_files_in_tar(self, path):
         """Returns list of all file paths inside a tar file"""
         with tarfile.open(path, 'r:gz') as archive:
@@ -84,6 +165,15 @@ class TestKeeper(unittest.TestCase):
         keeper = MockedKeeper()
         self.assertTrue(keeper._has_duplicate_or_overlap(overlapping_dirs))
 
+    def test_has_overlap_with_root(self):
+        """Test that / overlaps with every other path"""
+        overlapping_dirs = [
+            "/a",
+            "/"
+        ]
+        keeper = MockedKeeper()
+        self.assertTrue(keeper._has_duplicate_or_overlap(overlapping_dirs))
+
     def test_has_duplicate(self):
         """Test that duplicate check works"""
         duplicate_dirs = [
@@ -213,7 +303,7 @@ class TestKeeper(unittest.TestCase):
         # NOTE: I don't know why this is necessary
         files_expected_in_tar = [
             os.path.normpath(p) for p in files_expected_in_tar
-        ]
+        ] + [CHECKSUMS_MEMBER]
         files_in_tar = [
             os.path.normpath(p) for p in files_in_tar
         ]
@@ -292,7 +382,7 @@ class TestKeeper(unittest.TestCase):
         # NOTE: I don't know why this is necessary
         files_expected_in_tar = [
             os.path.normpath(p) for p in files_expected_in_tar
-        ]
+        ] + [CHECKSUMS_MEMBER]
         files_in_tar = [
             os.path.normpath(p) for p in files_in_tar
         ]
@@ -596,3 +686,1601 @@ class TestKeeper(unittest.TestCase):
 
         # Clean up directory
         self._purge_directory(base)
+
+    def test_parallel_compressor_writes_multi_member_gzip(self):
+        """Test that parallel compression produces independent members"""
+        data = os.urandom(64 * 1024) * 7 + b"tail"
+        buffer = io.BytesIO()
+        with keeper._ParallelCompressor(
+                buffer, jobs=4, block_size=64 * 1024) as compressor:
+            compressor.write(data)
+            self.assertEqual(compressor.tell(), len(data))
+
+        compressed = buffer.getvalue()
+        self.assertEqual(gzip.decompress(compressed), data)
+
+        # Count gzip members in the output
+        members = 0
+        while compressed:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            decompressor.decompress(compressed)
+            compressed = decompressor.unused_data
+            members += 1
+        self.assertEqual(members, 8)
+
+    def test_backup_with_jobs(self):
+        """Test that a backup compressed with several jobs can be restored"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_backup_jobs"
+        file_paths = [
+            base + "/data/a.txt",
+            base + "/data/b/c.txt"
+        ]
+        self._create_dir(base + "/data/b")
+        for path in file_paths:
+            with open(path, "w") as file_handle:
+                file_handle.write("lorem ipsum\n" * 1000)
+
+        keeper = Keeper(system_directories=[base + "/data"])
+        keeper.backup(
+            destination_path=base,
+            filename="jobs_test.tar.gz",
+            jobs=4
+        )
+
+        # The archive must be readable by plain tar as well
+        if shutil.which("tar"):
+            subprocess.check_call(
+                ["tar", "-tzf", base + "/jobs_test.tar.gz"],
+                stdout=subprocess.DEVNULL
+            )
+
+        self._purge_directory(base + "/data")
+        keeper.restore(base + "/jobs_test.tar.gz")
+        for path in file_paths:
+            with open(path, "r") as file_handle:
+                self.assertEqual(file_handle.read(), "lorem ipsum\n" * 1000)
+
+        self._purge_directory(base)
+
+    def test_backup_and_restore_with_each_codec(self):
+        """Test a backup round trip with every available codec"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_codecs"
+        for name, codec in keeper.CODECS.items():
+            if not codec.available:
+                continue
+            self._create_dir(base + "/data/sub")
+            with open(base + "/data/sub/file.txt", "w") as file_handle:
+                file_handle.write("lorem ipsum\n")
+
+            keeper_instance = Keeper(system_directories=[base + "/data"])
+            keeper_instance.backup(
+                destination_path=base,
+                filename="codec_test" + codec.extension,
+                jobs=2,
+                compression=name
+            )
+            with open(base + "/codec_test" + codec.extension, "rb") as f:
+                self.assertIs(keeper._detect_codec(f), codec)
+
+            self._purge_directory(base + "/data")
+            keeper_instance.restore(base + "/codec_test" + codec.extension)
+            with open(base + "/data/sub/file.txt", "r") as file_handle:
+                self.assertEqual(file_handle.read(), "lorem ipsum\n")
+            self._purge_directory(base)
+
+    def test_missing_codec_library_falls_back_to_gzip(self):
+        """Test that an unavailable codec falls back to a stdlib one"""
+        codec = keeper._ZstdCodec()
+        codec.available = False
+        original = keeper.CODECS["zstd"]
+        keeper.CODECS["zstd"] = codec
+        try:
+            self.assertEqual(keeper.get_codec("zstd").name, "gzip")
+        finally:
+            keeper.CODECS["zstd"] = original
+
+    def test_backup_file_name_uses_codec_extension(self):
+        """Test that the default file name matches the codec"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_python_unittest_codec_name"
+        self._create_dir(base + "/a")
+        with open(base + "/a/file.txt", "w") as file_handle:
+            file_handle.write("lorem ipsum\n")
+
+        args = keeper.parse_args([
+            '--dirs=' + base + '/a',
+            'backup',
+            '--dest', base,
+            '--compression', 'xz'
+        ])
+        keeper.main(args)
+
+        self.assertEqual(len(glob.glob(base + "/*.tar.xz")), 1)
+
+        self._purge_directory(base)
+
+    def test_incremental_backup_and_chain_restore(self):
+        """Test restoring a full backup followed by incremental backups"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_incremental"
+        data = base + "/data"
+        self._create_dir(data + "/logs")
+        for name in ["same.txt", "changed.txt", "deleted.txt"]:
+            with open(data + "/logs/" + name, "w") as file_handle:
+                file_handle.write("lorem ipsum\n")
+
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(destination_path=base, filename="full.tar.gz")
+
+        # Change the tree and take two incremental backups
+        with open(data + "/logs/changed.txt", "w") as file_handle:
+            file_handle.write("new version\n" * 2)
+        os.remove(data + "/logs/deleted.txt")
+        keeper_instance.backup(
+            destination_path=base,
+            filename="inc1.tar.gz",
+            base=base + "/full.tar.gz" + keeper.MANIFEST_SUFFIX
+        )
+        with open(data + "/logs/added.txt", "w") as file_handle:
+            file_handle.write("added\n")
+        keeper_instance.backup(
+            destination_path=base,
+            filename="inc2.tar.gz",
+            base=base + "/inc1.tar.gz" + keeper.MANIFEST_SUFFIX
+        )
+
+        # Only the new and changed files go into the incremental backups
+        files_in_inc1 = self._list_files_in_tar(base + "/inc1.tar.gz")
+        self.assertIn(
+            keeper._archive_name(data + "/logs/changed.txt"), files_in_inc1)
+        self.assertNotIn(
+            keeper._archive_name(data + "/logs/same.txt"), files_in_inc1)
+        header, records = keeper._load_manifest(
+            base + "/inc1.tar.gz" + keeper.MANIFEST_SUFFIX)
+        self.assertEqual(header["type"], "incremental")
+        self.assertEqual(header["base"], "full.tar.gz")
+        self.assertTrue(
+            records[keeper._archive_name(data + "/logs/deleted.txt")][
+                "deleted"])
+
+        self._purge_directory(data)
+        args = keeper.parse_args([
+            '--dirs=' + data,
+            'restore',
+            '--file', base + '/full.tar.gz',
+            '--file', base + '/inc1.tar.gz',
+            '--file', base + '/inc2.tar.gz'
+        ])
+        keeper.main(args)
+
+        self.assertEqual(
+            sorted(os.listdir(data + "/logs")),
+            ["added.txt", "changed.txt", "same.txt"]
+        )
+        with open(data + "/logs/changed.txt", "r") as file_handle:
+            self.assertEqual(file_handle.read(), "new version\n" * 2)
+
+        # Files an incremental backup only lists are not checked
+        os.remove(data + "/logs/added.txt")
+        keeper_instance.restore(base + "/inc2.tar.gz")
+        with open(data + "/logs/added.txt", "r") as file_handle:
+            self.assertEqual(file_handle.read(), "added\n")
+
+        self._purge_directory(base)
+
+    def test_restore_chain_must_be_in_order(self):
+        """Test that a broken incremental chain is refused"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_incremental_order"
+        data = base + "/data"
+        self._create_dir(data)
+        with open(data + "/file.txt", "w") as file_handle:
+            file_handle.write("lorem ipsum\n")
+
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(destination_path=base, filename="full.tar.gz")
+        keeper_instance.backup(
+            destination_path=base,
+            filename="inc.tar.gz",
+            base=base + "/full.tar.gz" + keeper.MANIFEST_SUFFIX
+        )
+
+        with self.assertRaises(Exception):
+            keeper_instance.restore_chain(
+                [base + "/inc.tar.gz", base + "/full.tar.gz"])
+
+        self._purge_directory(base)
+
+    def test_restore_without_manifest_does_not_overwrite(self):
+        """Test that files are checked while restoring without a manifest"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_restore_no_manifest"
+        self._create_dir(base + "/data")
+        with open(base + "/data/file.txt", "w") as file_handle:
+            file_handle.write("lorem ipsum\n")
+
+        keeper_instance = Keeper(system_directories=[base + "/data"])
+        keeper_instance.backup(destination_path=base, filename="test.tar.gz")
+        os.remove(base + "/test.tar.gz" + keeper.MANIFEST_SUFFIX)
+
+        with open(base + "/data/file.txt", "w") as file_handle:
+            file_handle.write("new version\n")
+        with self.assertRaises(Exception):
+            keeper_instance.restore(base + "/test.tar.gz")
+        with open(base + "/data/file.txt", "r") as file_handle:
+            self.assertEqual(file_handle.read(), "new version\n")
+
+        # Without conflicts the restore goes through
+        self._purge_directory(base + "/data")
+        keeper_instance.restore(base + "/test.tar.gz")
+        with open(base + "/data/file.txt", "r") as file_handle:
+            self.assertEqual(file_handle.read(), "lorem ipsum\n")
+
+        self._purge_directory(base)
+
+    def test_streamed_archive_does_not_keep_members(self):
+        """Test that iterating a streamed archive forgets old members"""
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as archive:
+            for index in range(10):
+                archive.addfile(tarfile.TarInfo("file{}".format(index)))
+        buffer.seek(0)
+
+        with tarfile.open(fileobj=buffer, mode="r|") as archive:
+            names = []
+            for tarinfo in keeper._iter_stream(archive):
+                names.append(tarinfo.name)
+                self.assertLessEqual(len(archive.members), 1)
+        self.assertEqual(len(names), 10)
+
+    def test_path_trie_matches_on_component_boundaries(self):
+        """Test that only members inside the directories are matched"""
+        trie = keeper._PathTrie([
+            "/var/lib/rundeck/data",
+            "/var/rundeck/projects/"
+        ])
+        self.assertTrue(trie.match("var/lib/rundeck/data"))
+        self.assertTrue(trie.match("var/lib/rundeck/data/db/file.h2"))
+        self.assertTrue(trie.match("var/rundeck/projects"))
+        self.assertTrue(trie.match("var/rundeck/projects/p1/etc"))
+        self.assertFalse(trie.match("var/lib/rundeck/data2/file"))
+        self.assertFalse(trie.match("var/lib/rundeck"))
+        self.assertFalse(trie.match("var/lib/rundeck/logs/file"))
+
+    def test_restore_skips_sibling_with_same_prefix(self):
+        """Test that restoring data does not restore data2"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_restore_sibling"
+        for name in ["data", "data2"]:
+            self._create_dir(base + "/" + name)
+            with open(base + "/" + name + "/file.txt", "w") as file_handle:
+                file_handle.write("lorem ipsum\n")
+
+        Keeper(system_directories=[base + "/data", base + "/data2"]).backup(
+            destination_path=base, filename="test.tar.gz")
+        self._purge_directory(base + "/data")
+        self._purge_directory(base + "/data2")
+
+        Keeper(system_directories=[base + "/data"]).restore(
+            base + "/test.tar.gz")
+        self.assertTrue(os.path.isfile(base + "/data/file.txt"))
+        self.assertFalse(os.path.exists(base + "/data2"))
+
+        self._purge_directory(base)
+
+    def test_restore_only_uses_index(self):
+        """Test restoring a single file through the backup index"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_restore_only"
+        data = base + "/data"
+        self._create_dir(data + "/logs")
+        contents = {}
+        for index in range(8):
+            path = data + "/logs/{}.rdlog".format(index)
+            contents[path] = os.urandom(300 * 1024)
+            with open(path, "wb") as file_handle:
+                file_handle.write(contents[path])
+
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(
+            destination_path=base, filename="test.tar.gz", jobs=2)
+
+        # The last file starts in a later block of the backup file
+        header, entries = keeper._read_index(
+            base + "/test.tar.gz" + keeper.INDEX_SUFFIX)
+        entries = dict((entry[0], entry) for entry in entries)
+        last = data + "/logs/7.rdlog"
+        self.assertGreater(entries[keeper._archive_name(last)][1], 0)
+
+        self._purge_directory(data)
+        keeper_instance.restore(base + "/test.tar.gz", only="*/7.rdlog")
+
+        self.assertEqual(os.listdir(data + "/logs"), ["7.rdlog"])
+        with open(last, "rb") as file_handle:
+            self.assertEqual(file_handle.read(), contents[last])
+
+        self._purge_directory(base)
+
+    def test_list_backup(self):
+        """Test listing a backup with and without its index"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_list"
+        self._create_dir(base + "/data/sub")
+        with open(base + "/data/sub/file.txt", "w") as file_handle:
+            file_handle.write("lorem ipsum\n")
+
+        Keeper(system_directories=[base + "/data"]).backup(
+            destination_path=base, filename="test.tar.gz")
+
+        expected = [
+            (keeper._archive_name(base + "/data/sub/file.txt"), 12)
+        ]
+        listed = [
+            (name, size) for name, size, mode, kind in
+            keeper.list_backup(base + "/test.tar.gz", only="*.txt")
+        ]
+        self.assertEqual(listed, expected)
+
+        os.remove(base + "/test.tar.gz" + keeper.INDEX_SUFFIX)
+        listed = [
+            (name, size) for name, size, mode, kind in
+            keeper.list_backup(base + "/test.tar.gz", only="*.txt")
+        ]
+        self.assertEqual(listed, expected)
+
+        self._purge_directory(base)
+
+    def test_content_defined_chunks_survive_insertions(self):
+        """Test that chunk boundaries follow content, not offsets"""
+        data = random.Random(0).randbytes(6 * 1024 * 1024)
+        chunks = list(keeper._iter_chunks(io.BytesIO(data)))
+        shifted = list(keeper._iter_chunks(io.BytesIO(b"insert" + data)))
+
+        self.assertEqual(b"".join(chunks), data)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), keeper.CHUNK_MAX_SIZE)
+        # Only the first chunk is affected by the insertion
+        self.assertEqual(
+            [hashlib.sha256(chunk).hexdigest() for chunk in chunks[1:]],
+            [hashlib.sha256(chunk).hexdigest() for chunk in shifted[1:]],
+        )
+
+    def test_chunk_store_backup_restore_and_prune(self):
+        """Test deduplicated snapshots, restore from one and pruning"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_chunk_store"
+        data = base + "/data"
+        repo = base + "/repo"
+        self._create_dir(data + "/projects")
+        for name in ["a.xml", "b.xml"]:
+            with open(data + "/projects/" + name, "w") as file_handle:
+                file_handle.write("<job>lorem ipsum</job>\n")
+
+        keeper_instance = Keeper(system_directories=[data])
+        first = keeper_instance.backup_to_store(repo, snapshot_id="first")
+        store = keeper.ChunkStore(repo)
+        # Identical files share their chunk
+        chunks = glob.glob(repo + "/chunks/*/*")
+        self.assertEqual(len(chunks), 1)
+
+        with open(data + "/projects/b.xml", "w") as file_handle:
+            file_handle.write("<job>changed</job>\n")
+        second = keeper_instance.backup_to_store(
+            repo, snapshot_id="second", jobs=2)
+        self.assertEqual(store.snapshots(), [first, second])
+        self.assertEqual(len(glob.glob(repo + "/chunks/*/*")), 2)
+
+        self._purge_directory(data)
+        keeper_instance.restore_snapshot(repo, first)
+        with open(data + "/projects/b.xml", "r") as file_handle:
+            self.assertEqual(file_handle.read(), "<job>lorem ipsum</job>\n")
+
+        # Restore refuses to overwrite files
+        with self.assertRaises(Exception):
+            keeper_instance.restore_snapshot(repo, second)
+
+        # Only the chunk unique to the second snapshot goes away
+        self.assertEqual(store.prune(forget=[second]), 1)
+        self.assertEqual(store.snapshots(), [first])
+
+        self._purge_directory(base)
+
+    def test_parallel_walk_matches_sequential_walk(self):
+        """Test that the parallel walk keeps the order of the plain walk"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_parallel_walk"
+        for index in range(5):
+            directory = base + "/logs/job{}/logs".format(index)
+            self._create_dir(directory)
+            for name in ["b.rdlog", "a.rdlog", "c.state.json"]:
+                with open(directory + "/" + name, "w") as file_handle:
+                    file_handle.write("lorem ipsum\n")
+        self._create_dir(base + "/data")
+
+        directories = [base + "/logs", base + "/data"]
+        expected = [
+            path for directory in directories
+            for path, status in keeper._walk(directory)
+        ]
+        with keeper.ThreadPoolExecutor(max_workers=4) as executor:
+            walked = [
+                path for path, status in
+                keeper._parallel_walk(directories, executor, ahead=2)
+            ]
+            items = [
+                (path, status, path.endswith("a.rdlog"))
+                for path, status in keeper._walk(base + "/logs")
+            ]
+            prefetched = list(keeper._prefetch(items, executor, depth=3))
+
+        self.assertEqual(walked, expected)
+        self.assertEqual([item for item, data in prefetched], items)
+        for (path, status, read), data in prefetched:
+            self.assertEqual(data, b"lorem ipsum\n" if read else None)
+
+        self._purge_directory(base)
+
+    def test_parallel_restore(self):
+        """Test restoring with several writer threads"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_parallel_restore"
+        data = base + "/data"
+        contents = {}
+        for index in range(40):
+            directory = data + "/logs/job{}".format(index % 4)
+            self._create_dir(directory)
+            path = directory + "/{}.rdlog".format(index)
+            contents[path] = os.urandom(index * 100)
+        contents[data + "/big.h2.db"] = os.urandom(
+            keeper.RESTORE_PARALLEL_SIZE + 1)
+        for path, content in contents.items():
+            with open(path, "wb") as file_handle:
+                file_handle.write(content)
+        os.chmod(data + "/logs/job1/1.rdlog", 0o600)
+        os.utime(data + "/logs/job2", (1000000000, 1000000000))
+
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(destination_path=base, filename="test.tar.gz")
+        self._purge_directory(data)
+        keeper_instance.restore(base + "/test.tar.gz", jobs=4)
+
+        for path, content in contents.items():
+            with open(path, "rb") as file_handle:
+                self.assertEqual(file_handle.read(), content)
+        self.assertEqual(
+            os.stat(data + "/logs/job1/1.rdlog").st_mode & 0o777, 0o600)
+        # Directory mtimes are set after their files were written
+        self.assertEqual(os.stat(data + "/logs/job2").st_mtime, 1000000000)
+
+        # Conflicts found on the worker threads still stop the restore
+        os.remove(base + "/test.tar.gz" + keeper.MANIFEST_SUFFIX)
+        os.remove(data + "/logs/job3/3.rdlog")
+        with self.assertRaises(Exception):
+            keeper_instance.restore(base + "/test.tar.gz", jobs=4)
+
+        self._purge_directory(base)
+
+    def test_progress_counts_and_eta(self):
+        """Test progress counters, ratio and per directory totals"""
+        progress = keeper._Progress(
+            "backup", total_files=4, total_bytes=4000, report=True,
+            interval=0)
+        with self.assertLogs(level="INFO") as logs:
+            progress.enter("/data")
+            progress.add(files=2, read=2000, written=500)
+            progress.enter("/logs")
+            progress.add(files=1, read=1000, written=500)
+            progress.finish()
+        self.assertIn("50% done, ETA", logs.output[0])
+        stats = progress.stats()
+        self.assertEqual(stats["files"], 3)
+        self.assertEqual(stats["bytes_read"], 3000)
+        self.assertEqual(stats["ratio"], 3.0)
+        self.assertEqual(stats["directories"]["/data"]["files"], 2)
+        self.assertEqual(stats["directories"]["/logs"]["bytes"], 1500)
+
+    def test_backup_and_restore_write_stats(self):
+        """Test --stats-json for backup and restore"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_stats"
+        dirs = [base + "/data", base + "/logs"]
+        for directory in dirs:
+            self._create_dir(directory)
+            with open(directory + "/file", "wb") as file_handle:
+                file_handle.write(b"x" * 10000)
+
+        keeper_instance = Keeper(system_directories=dirs)
+        keeper_instance.backup(
+            destination_path=base, filename="test.tar.gz", progress=True,
+            stats_path=base + "/backup.json")
+        with open(base + "/backup.json") as file_handle:
+            stats = json.load(file_handle)
+        self.assertEqual(stats["operation"], "backup")
+        self.assertEqual(stats["bytes_read"], 20000)
+        self.assertEqual(stats["bytes_written"],
+                         os.path.getsize(base + "/test.tar.gz"))
+        self.assertEqual(list(stats["directories"]), dirs)
+        self.assertEqual(keeper_instance.count, 4)
+
+        for directory in dirs:
+            self._purge_directory(directory)
+        keeper_instance.restore(base + "/test.tar.gz",
+                                stats_path=base + "/restore.json")
+        with open(base + "/restore.json") as file_handle:
+            stats = json.load(file_handle)
+        self.assertEqual(stats["files"], 4)
+        self.assertEqual(stats["bytes_written"], 20000)
+        self.assertEqual(stats["directories"][dirs[1]]["files"], 2)
+
+        self._purge_directory(base)
+
+    def test_find_existing_lists_each_directory_once(self):
+        """Test the overwrite check reports all conflicts"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_find_existing"
+        self._create_dir(base + "/data/sub")
+        for path in ["/data/a", "/data/sub/b", "/data/sub/c"]:
+            with open(base + path, "w") as file_handle:
+                file_handle.write("x")
+        names = [
+            base + "/data/a", base + "/data/new", base + "/data/sub",
+            base + "/data/sub/b", base + "/data/sub/c",
+            base + "/missing/x", base + "/missing/deeper/y",
+        ]
+        listed = []
+        original = os.scandir
+
+        def _scandir(path):
+            listed.append(path)
+            return original(path)
+
+        os.scandir = _scandir
+        try:
+            existing = keeper._find_existing(name[1:] for name in names)
+        finally:
+            os.scandir = original
+        self.assertEqual(existing, [
+            base + "/data/a", base + "/data/sub/b", base + "/data/sub/c"])
+        # The subtree below the missing directory is not listed
+        self.assertEqual(listed, [base + "/data", base + "/data/sub",
+                                  base + "/missing"])
+        self._purge_directory(base)
+
+    def test_restore_dry_run(self):
+        """Test that a dry run reports conflicts and writes nothing"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_restore_dry_run"
+        data = base + "/data"
+        self._create_dir(data)
+        for name in ["one", "two", "three"]:
+            with open(data + "/" + name, "w") as file_handle:
+                file_handle.write(name)
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(destination_path=base, filename="test.tar.gz")
+
+        # Without a manifest, the names come from the index
+        os.remove(base + "/test.tar.gz" + keeper.MANIFEST_SUFFIX)
+        with self.assertLogs(level="ERROR") as logs:
+            with self.assertRaises(Exception) as context:
+                keeper_instance.restore(base + "/test.tar.gz", dry_run=True)
+        self.assertEqual(len(logs.output), 3)
+        self.assertIn("3 existing files", str(context.exception))
+
+        self._purge_directory(data)
+        keeper_instance.restore(base + "/test.tar.gz", dry_run=True)
+        self.assertFalse(os.path.exists(data))
+        self._purge_directory(base)
+
+    def test_verify_backup(self):
+        """Test verify against embedded checksums and the live files"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_verify"
+        data = base + "/data"
+        self._create_dir(data)
+        contents = {"small": b"small", "big": os.urandom(
+            keeper.RESTORE_PARALLEL_SIZE + 1)}
+        for name, content in contents.items():
+            with open(data + "/" + name, "wb") as file_handle:
+                file_handle.write(content)
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(destination_path=base, filename="test.tar.gz")
+        backup = base + "/test.tar.gz"
+        self.assertEqual(keeper.verify_backup(backup, jobs=2), [])
+        self.assertEqual(
+            keeper.verify_backup(backup, against_live=True, jobs=2), [])
+
+        # Files changed or removed since the backup
+        with open(data + "/small", "wb") as file_handle:
+            file_handle.write(b"SMALL")
+        os.remove(data + "/big")
+        self.assertEqual(
+            keeper.verify_backup(backup, against_live=True, jobs=2),
+            ["missing on disk: " + data + "/big",
+             "changed on disk: " + data + "/small"])
+
+        # A file changed inside the backup file
+        with tarfile.open(backup) as source, \
+                tarfile.open(base + "/bad.tar.gz", "w:gz") as target:
+            for tarinfo in source.getmembers():
+                fileobj = source.extractfile(tarinfo)
+                if tarinfo.name.endswith("/small"):
+                    fileobj = io.BytesIO(b"SMALL")
+                target.addfile(tarinfo, fileobj)
+        self.assertEqual(
+            keeper.verify_backup(base + "/bad.tar.gz"),
+            ["checksum mismatch: " + data[1:] + "/small"])
+
+        # A truncated backup file
+        with open(backup, "rb") as file_handle:
+            truncated = file_handle.read()[:-100]
+        with open(base + "/truncated.tar.gz", "wb") as file_handle:
+            file_handle.write(truncated)
+        problems = keeper.verify_backup(base + "/truncated.tar.gz")
+        self.assertEqual(len(problems), 1)
+        self.assertIn("damaged", problems[0])
+        self._purge_directory(base)
+
+    def test_backup_to_pipe_and_restore_from_stdin(self):
+        """Test streaming a backup through pipes"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_stream"
+        data = base + "/data"
+        self._create_dir(data)
+        contents = {"small": b"small", "big": os.urandom(3 * 1024 * 1024)}
+        for name, content in contents.items():
+            with open(data + "/" + name, "wb") as file_handle:
+                file_handle.write(content)
+        keeper_instance = Keeper(system_directories=[data])
+
+        def _drain(descriptor, chunks):
+            with os.fdopen(descriptor, "rb") as pipe:
+                for chunk in iter(lambda: pipe.read(65536), b""):
+                    chunks.append(chunk)
+
+        chunks = []
+        read_end, write_end = os.pipe()
+        reader = threading.Thread(target=_drain, args=(read_end, chunks))
+        reader.start()
+        with os.fdopen(write_end, "wb") as pipe:
+            keeper_instance.backup(destination_path=None,
+                                   filename="test.tar.gz", fileobj=pipe)
+        reader.join()
+        # Nothing was written next to the data
+        self.assertEqual(os.listdir(base), ["data"])
+
+        self._purge_directory(data)
+        read_end, write_end = os.pipe()
+
+        def _feed():
+            with os.fdopen(write_end, "wb") as pipe:
+                for chunk in chunks:
+                    pipe.write(chunk)
+
+        writer = threading.Thread(target=_feed)
+        writer.start()
+        stdin = sys.stdin
+        sys.stdin = io.TextIOWrapper(os.fdopen(read_end, "rb"))
+        try:
+            keeper_instance.restore("-")
+        finally:
+            sys.stdin.close()
+            sys.stdin = stdin
+        writer.join()
+        for name, content in contents.items():
+            with open(data + "/" + name, "rb") as file_handle:
+                self.assertEqual(file_handle.read(), content)
+        self._purge_directory(base)
+
+    def test_backup_and_restore_with_s3_storage(self):
+        """Test multipart upload and ranged download of a backup"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_s3_storage"
+        data = base + "/data"
+        self._create_dir(data)
+        contents = {"small": b"small", "big": os.urandom(1024 * 1024)}
+        for name, content in contents.items():
+            with open(data + "/" + name, "wb") as file_handle:
+                file_handle.write(content)
+        client = FakeS3Client()
+        storage = keeper.S3Storage("bucket", "backups", client=client,
+                                   part_size=64 * 1024, jobs=4)
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup_remote(storage, "test.tar.gz")
+        self.assertEqual(sorted(key for bucket, key in client.objects), [
+            "backups/test.tar.gz",
+            "backups/test.tar.gz" + keeper.INDEX_SUFFIX,
+            "backups/test.tar.gz" + keeper.MANIFEST_SUFFIX,
+        ])
+        self.assertGreater(client.calls["upload_part"], 10)
+
+        # The manifest is fetched and stops the restore early
+        with self.assertRaises(Exception):
+            keeper_instance.restore_remote(storage, "test.tar.gz")
+        self.assertEqual(client.calls["get_object"], 1)
+
+        self._purge_directory(data)
+        keeper_instance.restore_remote(storage, "test.tar.gz", jobs=2)
+        for name, content in contents.items():
+            with open(data + "/" + name, "rb") as file_handle:
+                self.assertEqual(file_handle.read(), content)
+        self.assertGreater(client.calls["get_object"], 10)
+
+        # A failed backup leaves nothing behind
+        writer = storage.open_writer("failed.tar.gz")
+        with self.assertRaises(ValueError):
+            with writer:
+                writer.write(os.urandom(200 * 1024))
+                raise ValueError()
+        self.assertEqual(client.uploads, {})
+        self.assertNotIn(("bucket", "backups/failed.tar.gz"), client.objects)
+        self._purge_directory(base)
+
+    def test_s3_upload_grows_parts_past_the_part_limit(self):
+        """Test that a streamed upload fits in the parts S3 allows"""
+        storage = keeper.S3Storage("bucket", "", client=FakeS3Client(),
+                                  part_size=1, jobs=4)
+        # 31000 parts of the first size, 5000 once they grow
+        data = os.urandom(31000)
+        with storage.open_writer("big") as writer:
+            for start in range(0, len(data), 1000):
+                writer.write(data[start:start + 1000])
+        self.assertEqual(storage.client.objects[("bucket", "big")], data)
+        parts = storage.client.calls["upload_part"]
+        self.assertLess(parts, keeper.S3_MAX_PARTS)
+        # 1000 parts of 1 byte, 1000 of 2 bytes, and so on up to 16
+        self.assertEqual(parts, 5000)
+
+        # Without room to grow, the upload fails at the limit
+        max_part_size = keeper.S3_MAX_PART_SIZE
+        keeper.S3_MAX_PART_SIZE = 1
+        try:
+            with self.assertRaises(Exception):
+                with storage.open_writer("too-big") as writer:
+                    writer.write(data)
+        finally:
+            keeper.S3_MAX_PART_SIZE = max_part_size
+        self.assertEqual(storage.client.uploads, {})
+        self.assertEqual(storage.client.calls["upload_part"],
+                         parts + keeper.S3_MAX_PARTS)
+
+    def test_retention_keeps_periods_and_chains(self):
+        """Test which backups a retention policy keeps"""
+        entries = []
+        for day in range(1, 61):
+            created = datetime(2017, 1, 1, 12) + timedelta(days=day)
+            name = "full-{}".format(day)
+            entries.append((name, {"created": created.isoformat(),
+                                   "directories": ["/a"], "base": None}))
+        # An incremental backup of a full backup that is otherwise too old
+        entries.append(("incremental", {
+            "created": datetime(2017, 3, 5, 13).isoformat(),
+            "directories": ["/a"], "base": "full-2"}))
+        # Backups of other directories are kept on their own
+        entries.append(("partial", {
+            "created": datetime(2017, 1, 10).isoformat(),
+            "directories": ["/b"], "base": None}))
+        keep = keeper._retained(entries, daily=2, weekly=2, monthly=3)
+        self.assertEqual(keep, set([
+            # Newest of each of the last two days
+            "incremental", "full-60",
+            # Newest of the last two weeks, the first is the same day
+            "full-56",
+            # Newest of the last three months
+            "full-58", "full-30",
+            # Base of the incremental backup, and the partial backup
+            "full-2", "partial",
+        ]))
+        with self.assertRaises(Exception):
+            keeper._retained(entries)
+
+    def test_backup_catalog_and_prune(self):
+        """Test that backups are cataloged and pruned from the catalog"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_catalog"
+        data = base + "/data"
+        dest = base + "/backups"
+        self._create_dir(data)
+        with open(data + "/file", "w") as file_handle:
+            file_handle.write("data")
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(destination_path=dest, filename="full.tar.gz")
+        keeper_instance.backup(
+            destination_path=dest, filename="incremental.tar.gz",
+            base=dest + "/full.tar.gz" + keeper.MANIFEST_SUFFIX)
+        catalog = keeper.Catalog(dest)
+        entries = catalog.entries()
+        self.assertEqual(
+            [(entry["archive"], entry["type"], entry["base"], entry["partial"])
+             for entry in entries],
+            [("full.tar.gz", "full", None, True),
+             ("incremental.tar.gz", "incremental", "full.tar.gz", True)])
+        self.assertEqual(entries[0]["size"],
+                         os.path.getsize(dest + "/full.tar.gz"))
+
+        # Old backups, known only from the catalog
+        for day in range(1, 4):
+            name = "old-{}.tar.gz".format(day)
+            open(dest + "/" + name, "w").close()
+            catalog.add({"archive": name, "directories": [data],
+                         "created": datetime(2017, 1, day).isoformat(),
+                         "size": 0, "type": "full", "base": None,
+                         "partial": True})
+        self.assertEqual(len(catalog.prune(daily=1, dry_run=True)), 3)
+        self.assertEqual(len(catalog.entries()), 5)
+        removed = catalog.prune(daily=1)
+        self.assertEqual(sorted(removed), [
+            "old-1.tar.gz", "old-2.tar.gz", "old-3.tar.gz"])
+        self.assertEqual(sorted(os.listdir(dest)), [
+            "full.tar.gz", "full.tar.gz" + keeper.INDEX_SUFFIX,
+            "full.tar.gz" + keeper.MANIFEST_SUFFIX,
+            "incremental.tar.gz", "incremental.tar.gz" + keeper.INDEX_SUFFIX,
+            "incremental.tar.gz" + keeper.MANIFEST_SUFFIX,
+            keeper.CATALOG_NAME, keeper.CATALOG_NAME + ".lock"])
+
+        # A held lock is waited for, a lock file alone is not
+        locked = threading.Event()
+
+        def _hold():
+            with catalog.lock():
+                locked.set()
+                time.sleep(0.3)
+
+        holder = threading.Thread(target=_hold)
+        holder.start()
+        locked.wait()
+        start = time.monotonic()
+        catalog.add(dict(entries[0], archive="waited.tar.gz"))
+        self.assertGreater(time.monotonic() - start, 0.2)
+        holder.join()
+        self.assertTrue(os.path.exists(catalog.catalog_path + ".lock"))
+        catalog.add(dict(entries[0], archive="unlocked.tar.gz"))
+        self.assertEqual(len(catalog.entries()), 4)
+
+        # Without a catalog, it is rebuilt from the manifests
+        os.remove(dest + "/" + keeper.CATALOG_NAME)
+        self.assertEqual(catalog.entries(), entries)
+        self._purge_directory(base)
+
+    def test_sparse_file_backup_and_restore(self):
+        """Test that holes are neither archived nor written on restore"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_sparse"
+        data = base + "/data"
+        # Long and non-ASCII names need a pax path header
+        for name in ["db", "grailsd\u00e9.db", "d" * 150 + "/sparse.db"]:
+            self._create_dir(os.path.dirname(data + "/" + name))
+            size = 32 * 1024 * 1024
+            with open(data + "/" + name, "wb") as file_handle:
+                file_handle.truncate(size)
+                file_handle.seek(1024 * 1024)
+                file_handle.write(b"page" * 100000)
+            if os.stat(data + "/" + name).st_blocks * 512 >= size:
+                self._purge_directory(base)
+                self.skipTest("file system does not support holes")
+            with open(data + "/" + name, "rb") as file_handle:
+                content = file_handle.read()
+            keeper_instance = Keeper(system_directories=[data])
+            keeper_instance.backup(
+                destination_path=base, filename="sparse.tar.gz")
+            self.assertLess(
+                os.path.getsize(base + "/sparse.tar.gz"), 64 * 1024)
+            self.assertEqual(
+                keeper.verify_backup(base + "/sparse.tar.gz"), [])
+            with tarfile.open(base + "/sparse.tar.gz") as archive:
+                tarinfo = archive.getmember(data.lstrip("/") + "/" + name)
+                self.assertTrue(tarinfo.issparse())
+                self.assertEqual(tarinfo.size, size)
+
+            shutil.rmtree(data)
+            keeper_instance.restore(base + "/sparse.tar.gz")
+            with open(data + "/" + name, "rb") as file_handle:
+                self.assertEqual(file_handle.read(), content)
+            self.assertLess(
+                os.stat(data + "/" + name).st_blocks * 512, size)
+            shutil.rmtree(data)
+            os.remove(base + "/sparse.tar.gz")
+        self._purge_directory(base)
+
+    def test_duplicate_files_stored_as_hard_links(self):
+        """Test that same inode and same content files are archived once"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_dedup"
+        data = base + "/data"
+        self._create_dir(data + "/project")
+        content = os.urandom(64 * 1024)
+        for name in ["a.xml", "project/b.xml"]:
+            with open(data + "/" + name, "wb") as file_handle:
+                file_handle.write(content)
+        os.link(data + "/a.xml", data + "/linked.xml")
+        with open(data + "/small", "w") as file_handle:
+            file_handle.write("small")
+        shutil.copy(data + "/small", data + "/small-copy")
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(destination_path=base, filename="dedup.tar.gz")
+        self.assertLess(os.path.getsize(base + "/dedup.tar.gz"),
+                        len(content) + 4096)
+        self.assertEqual(keeper.verify_backup(base + "/dedup.tar.gz"), [])
+        name = data.lstrip("/")
+        with tarfile.open(base + "/dedup.tar.gz") as archive:
+            links = dict((tarinfo.name, tarinfo.linkname)
+                         for tarinfo in archive if tarinfo.islnk())
+        self.assertEqual(links, {
+            name + "/linked.xml": name + "/a.xml",
+            name + "/project/b.xml": name + "/a.xml",
+        })
+
+        # Links are checked against the live files too
+        self.assertEqual(keeper.verify_backup(
+            base + "/dedup.tar.gz", against_live=True), [])
+        with open(data + "/project/b.xml", "wb") as file_handle:
+            file_handle.write(os.urandom(len(content)))
+        self.assertEqual(
+            keeper.verify_backup(base + "/dedup.tar.gz", against_live=True),
+            ["changed on disk: " + data + "/project/b.xml"])
+
+        # Restored as separate copies by default
+        shutil.rmtree(data)
+        keeper_instance.restore(base + "/dedup.tar.gz")
+        for path in ["/linked.xml", "/project/b.xml"]:
+            with open(data + path, "rb") as file_handle:
+                self.assertEqual(file_handle.read(), content)
+            self.assertEqual(os.stat(data + path).st_nlink, 1)
+
+        # Or as hard links
+        shutil.rmtree(data)
+        keeper_instance.restore(base + "/dedup.tar.gz", hardlinks=True)
+        self.assertEqual(os.stat(data + "/a.xml").st_nlink, 3)
+
+        # A link whose file is not restored is read through the index
+        shutil.rmtree(data)
+        keeper_instance.restore(base + "/dedup.tar.gz", only="*/b.xml")
+        self.assertEqual(os.listdir(data), ["project"])
+        with open(data + "/project/b.xml", "rb") as file_handle:
+            self.assertEqual(file_handle.read(), content)
+
+        # Or, when streamed, written from the file as it goes past
+        shutil.rmtree(data)
+        with open(base + "/dedup.tar.gz", "rb") as fileobj:
+            keeper_instance.restore(base + "/dedup.tar.gz", only="*/b.xml",
+                                    fileobj=fileobj)
+        self.assertEqual(os.listdir(data), ["project"])
+        with open(data + "/project/b.xml", "rb") as file_handle:
+            self.assertEqual(file_handle.read(), content)
+        self._purge_directory(base)
+
+    def test_duplicates_in_other_directories_are_archived(self):
+        """Test that only some directories can be restored from a stream"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_dedup_directories"
+        dirs = [base + "/one", base + "/two"]
+        content = os.urandom(64 * 1024)
+        for directory in dirs:
+            self._create_dir(directory)
+            with open(directory + "/file", "wb") as file_handle:
+                file_handle.write(content)
+        Keeper(system_directories=dirs).backup(
+            destination_path=base, filename="dedup.tar.gz")
+        with tarfile.open(base + "/dedup.tar.gz") as archive:
+            self.assertFalse([tarinfo for tarinfo in archive
+                              if tarinfo.islnk()])
+
+        shutil.rmtree(dirs[1])
+        with open(base + "/dedup.tar.gz", "rb") as fileobj:
+            Keeper(system_directories=[dirs[1]]).restore(
+                base + "/dedup.tar.gz", fileobj=fileobj)
+        with open(dirs[1] + "/file", "rb") as file_handle:
+            self.assertEqual(file_handle.read(), content)
+        self._purge_directory(base)
+
+    def test_sharded_backup_and_restore(self):
+        """Test one backup file per directory, or per chunk of one"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_shards"
+        dirs = [base + "/logs", base + "/keys"]
+        for index in range(4):
+            self._create_dir(dirs[0] + "/job{}".format(index))
+            with open(dirs[0] + "/job{}/log".format(index),
+                      "wb") as file_handle:
+                file_handle.write(os.urandom(40000))
+        self._create_dir(dirs[1])
+        with open(dirs[1] + "/key", "w") as file_handle:
+            file_handle.write("key")
+        expected = self._list_tree(base)
+
+        keeper_instance = Keeper(system_directories=dirs)
+        path = keeper_instance.backup_sharded(
+            base + "/backups", "sharded", shard_size=100000)
+        shards = keeper._read_shards(path)["shards"]
+        self.assertEqual(
+            [(shard["directory"], shard["chunk"]) for shard in shards],
+            [(dirs[0], 0), (dirs[0], 1), (dirs[1], 0)])
+        self.assertEqual(sum(shard["files"] for shard in shards), 11)
+
+        for directory in dirs:
+            shutil.rmtree(directory)
+        keeper_instance.restore_sharded(path)
+        self.assertEqual(self._list_tree(base, skip="backups"), expected)
+
+        # One shard alone
+        shutil.rmtree(dirs[1])
+        with self.assertRaises(Exception):
+            keeper_instance.restore_sharded(path)
+        keeper_instance.restore_sharded(path, shard=shards[2]["archive"])
+        self.assertEqual(self._list_tree(base, skip="backups"), expected)
+        self._purge_directory(base)
+
+    def test_sharded_backup_catalog_filter_and_changes(self):
+        """Test that shards are filtered, cataloged and pruned together"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_shards_catalog"
+        logs = base + "/logs"
+        dest = base + "/backups"
+        for index in range(4):
+            self._create_dir(logs + "/job{}".format(index))
+            with open(logs + "/job{}/log".format(index), "wb") as file_handle:
+                file_handle.write(os.urandom(40000))
+        self._create_dir(logs + "/cache")
+        with open(logs + "/cache/big", "wb") as file_handle:
+            file_handle.write(os.urandom(200000))
+        keeper_instance = Keeper(system_directories=[logs])
+        walk_filter = keeper.WalkFilter(exclude=["*/cache"])
+        path = keeper_instance.backup_sharded(
+            dest, "first", shard_size=100000, walk_filter=walk_filter)
+        shards = keeper._read_shards(path)["shards"]
+        self.assertEqual(len(shards), 2)
+        for shard in shards:
+            with tarfile.open(path + "/" + shard["archive"]) as archive:
+                self.assertFalse([name for name in archive.getnames()
+                                  if "cache" in name])
+        entries = keeper.Catalog(dest).entries()
+        self.assertEqual([(entry["archive"], entry["sharded"])
+                          for entry in entries], [("first", True)])
+        self.assertEqual(entries[0]["size"],
+                         sum(shard["size"] for shard in shards))
+
+        # Entries created in a split directory after planning are in the
+        # shard of the directory
+        plan_chunks = keeper._plan_chunks
+
+        def _plan_then_create(*args):
+            chunks = plan_chunks(*args)
+            self._create_dir(logs + "/job9")
+            for name in ["new.log", "job9/log", "cache/new"]:
+                with open(logs + "/" + name, "w") as file_handle:
+                    file_handle.write("new")
+            return chunks
+
+        keeper._plan_chunks = _plan_then_create
+        try:
+            path = keeper_instance.backup_sharded(
+                dest, "second", shard_size=100000, walk_filter=walk_filter)
+        finally:
+            keeper._plan_chunks = plan_chunks
+        shards = keeper._read_shards(path)["shards"]
+        self.assertEqual(shards[0]["files"], 5 + 3)
+        with tarfile.open(path + "/" + shards[0]["archive"]) as archive:
+            names = archive.getnames()
+        name = logs.lstrip("/")
+        for member in ["new.log", "job9", "job9/log"]:
+            self.assertIn(name + "/" + member, names)
+        self.assertNotIn(name + "/cache/new", names)
+        for name in ["new.log", "job9/log", "cache/new"]:
+            os.remove(logs + "/" + name)
+        os.rmdir(logs + "/job9")
+
+        # Pruning removes all shards of a backup
+        keeper_instance.backup_sharded(
+            dest, "third", shard_size=100000, walk_filter=walk_filter)
+        self.assertEqual(keeper.Catalog(dest).prune(daily=1),
+                         ["first", "second"])
+        self.assertFalse(os.path.exists(dest + "/first"))
+        self.assertTrue(os.path.isdir(dest + "/third"))
+        os.remove(dest + "/" + keeper.CATALOG_NAME)
+        self.assertEqual([entry["archive"] for entry in
+                          keeper.Catalog(dest).entries()], ["third"])
+        self._purge_directory(base)
+
+    def test_resume_interrupted_backup_and_restore(self):
+        """Test that backup and restore continue from their checkpoints"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_resume"
+        data = base + "/data"
+        dest = base + "/backups"
+        # More files than are read ahead, so some are archived
+        for index in range(keeper.PREFETCH_DEPTH + 100):
+            self._create_dir(data + "/dir{}".format(index % 10))
+            with open(data + "/dir{}/file{}".format(index % 10, index),
+                      "wb") as file_handle:
+                file_handle.write(os.urandom(1000))
+        expected = self._list_tree(base)
+        keeper_instance = Keeper(system_directories=[data])
+
+        def _interrupted(roots, executor):
+            walk = keeper._parallel_walk(roots, executor)
+            for count, entry in enumerate(walk):
+                if count == keeper.PREFETCH_DEPTH + 50:
+                    raise Exception("interrupted")
+                yield entry
+
+        with self.assertRaises(Exception):
+            keeper_instance.backup(
+                destination_path=dest, filename="backup.tar.gz",
+                walk=_interrupted, checkpoint_size=20000)
+        self.assertTrue(os.path.isfile(
+            dest + "/backup.tar.gz" + keeper.JOURNAL_SUFFIX))
+        keeper_instance.backup(
+            destination_path=dest, filename="backup.tar.gz", resume=True,
+            checkpoint_size=20000)
+        self.assertEqual(sorted(os.listdir(dest)), [
+            "backup.tar.gz", "backup.tar.gz.index",
+            "backup.tar.gz.manifest", "keeper-catalog.json",
+            "keeper-catalog.json.lock"])
+        self.assertEqual(keeper.verify_backup(dest + "/backup.tar.gz"), [])
+
+        shutil.rmtree(data)
+        set_attributes = keeper._set_attributes
+        calls = []
+
+        def _failing(archive, tarinfo, target):
+            calls.append(target)
+            if len(calls) == 120:
+                raise Exception("interrupted")
+            set_attributes(archive, tarinfo, target)
+
+        keeper.RESTORE_CHECKPOINT_FILES = 50
+        keeper._set_attributes = _failing
+        try:
+            with self.assertRaises(Exception):
+                keeper_instance.restore(dest + "/backup.tar.gz", resume=True)
+        finally:
+            keeper._set_attributes = set_attributes
+            keeper.RESTORE_CHECKPOINT_FILES = 1000
+        self.assertTrue(os.path.isfile(
+            dest + "/backup.tar.gz" + keeper.RESTORE_JOURNAL_SUFFIX))
+        with self.assertRaises(Exception):
+            keeper_instance.restore(dest + "/backup.tar.gz")
+        keeper_instance.restore(dest + "/backup.tar.gz", resume=True)
+        self.assertFalse(os.path.exists(
+            dest + "/backup.tar.gz" + keeper.RESTORE_JOURNAL_SUFFIX))
+        self.assertEqual(self._list_tree(base, skip="backups"), expected)
+        self._purge_directory(base)
+
+    def test_throttled_backup(self):
+        """Test that a backup keeps to the read rate it is given"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_throttle"
+        self._create_dir(base + "/data")
+        with open(base + "/data/file", "wb") as file_handle:
+            file_handle.write(os.urandom(300000))
+        throttle = keeper.IOThrottle(max_read_rate=200000)
+        start = time.monotonic()
+        Keeper(system_directories=[base + "/data"]).backup(
+            destination_path=base + "/backups", filename="backup.tar.gz",
+            throttle=throttle)
+        # One second worth passes at once, the rest at the rate
+        self.assertGreater(time.monotonic() - start, 0.4)
+        self.assertGreater(throttle.waited, 0.4)
+        self._purge_directory(base)
+
+    def test_throttled_hashing(self):
+        """Test that files hashed for dedup or --hash are read at the rate"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_throttle_hash"
+        self._create_dir(base + "/data")
+        # Too large to be read ahead, so hashing reads them again
+        content = os.urandom(keeper.PREFETCH_SIZE + 40000)
+        for name in ["a", "b"]:
+            with open(base + "/data/" + name, "wb") as file_handle:
+                file_handle.write(content)
+        for options in [{"dedup": True},
+                        {"dedup": False, "hash_files": True}]:
+            # b is read twice, or both files are, and one second worth
+            # passes at once
+            throttle = keeper.IOThrottle(max_read_rate=len(content))
+            Keeper(system_directories=[base + "/data"]).backup(
+                destination_path=base + "/backups", filename="backup.tar.gz",
+                throttle=throttle, **options)
+            self.assertGreater(throttle.waited, 0.8)
+        self._purge_directory(base)
+
+    def test_throttle_backs_off_on_disk_latency(self):
+        """Test that the read rate follows the disk latency"""
+        class _Disks:
+            latency = 100
+
+            def sample(self):
+                return self.latency
+
+        throttle = keeper.IOThrottle(
+            max_read_rate=8 * 1024 * 1024, max_latency=20)
+        throttle.disks = _Disks()
+        throttle._sampled -= keeper.LATENCY_INTERVAL
+        throttle._adapt(0)
+        self.assertEqual(throttle.reads.rate, keeper.MIN_READ_RATE)
+        self.assertEqual(throttle.backoffs, 1)
+        throttle.disks.latency = 5
+        rates = []
+        for _ in range(20):
+            throttle._sampled -= keeper.LATENCY_INTERVAL
+            throttle._adapt(0)
+            rates.append(throttle.reads.rate)
+        self.assertEqual(rates, sorted(rates))
+        self.assertEqual(rates[-1], 8 * 1024 * 1024)
+
+    def test_walk_filter(self):
+        """Test that filtered paths are left out of a backup"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_walk_filter"
+        data = base + "/data"
+        logs = base + "/logs"
+        self._create_dir(data + "/cache/deep")
+        self._create_dir(logs + "/project")
+        for path, size in [(data + "/keep.txt", 10),
+                           (data + "/cache/deep/file", 10),
+                           (data + "/large.db", 200000),
+                           (logs + "/project/old.rdlog", 10),
+                           (logs + "/project/new.rdlog", 10)]:
+            with open(path, "wb") as file_handle:
+                file_handle.write(os.urandom(size))
+        month = 31 * 24 * 3600
+        os.utime(logs + "/project/old.rdlog",
+                 (time.time() - month, time.time() - month))
+        walk_filter = keeper.WalkFilter(
+            exclude=["*/cache"], max_size=100000, max_age=month - 60,
+            logs=[logs])
+        Keeper(system_directories=[data, logs]).backup(
+            destination_path=base + "/backups", filename="backup.tar.gz",
+            walk_filter=walk_filter)
+        names = [
+            ("/" + name)[len(base):] for name in
+            self._list_files_in_tar(base + "/backups/backup.tar.gz")
+            if name != CHECKSUMS_MEMBER
+        ]
+        self.assertEqual(sorted(names), [
+            "/data", "/data/keep.txt", "/logs", "/logs/project",
+            "/logs/project/new.rdlog"])
+        # Excluded directories are not even listed
+        self.assertEqual(
+            keeper._scan_directory(data, walk_filter),
+            [(data + "/keep.txt", os.stat(data + "/keep.txt"))])
+        self._purge_directory(base)
+
+    def test_cold_tier(self):
+        """Test that old logs go to cold backup files written once"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_cold_tier"
+        logs = base + "/logs"
+        dest = base + "/backups"
+        self._create_dir(logs + "/project")
+        for name in ["first.rdlog", "second.rdlog"]:
+            with open(logs + "/project/" + name, "w") as file_handle:
+                file_handle.write(name)
+        day = 24 * 3600
+        os.utime(logs + "/project/first.rdlog",
+                 (time.time() - 10 * day, time.time() - 10 * day))
+        keeper_instance = Keeper(system_directories=[logs])
+        first = keeper_instance.backup_cold(dest, 7 * day, logs_directory=logs)
+        self.assertTrue(first.endswith(".tar.xz"))
+        self.assertIn(logs[1:] + "/project/first.rdlog",
+                      tarfile.open(first).getnames())
+        self.assertNotIn(logs[1:] + "/project/second.rdlog",
+                         tarfile.open(first).getnames())
+
+        os.utime(logs + "/project/second.rdlog",
+                 (time.time() - 8 * day, time.time() - 8 * day))
+        modified = os.path.getmtime(first)
+        second = keeper_instance.backup_cold(
+            dest, 7 * day, logs_directory=logs)
+        self.assertEqual(
+            [name for name in tarfile.open(second).getnames()
+             if name != CHECKSUMS_MEMBER],
+            [logs[1:] + "/project/second.rdlog"])
+        self.assertEqual(os.path.getmtime(first), modified)
+        self.assertEqual(
+            [entry["type"] for entry in keeper.Catalog(
+                dest + "/" + keeper.COLD_DIRECTORY).entries()],
+            ["full", "incremental"])
+        self._purge_directory(base)
+
+    def test_daemon_schedule(self):
+        """Test that the daemon takes full and incremental backups in turn"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_daemon_schedule"
+        data = base + "/data"
+        dest = base + "/backups"
+        self._create_dir(data)
+        with open(data + "/file", "w") as file_handle:
+            file_handle.write("data")
+        daemon = keeper.Daemon(
+            Keeper(system_directories=[data]), dest,
+            full_interval=24, incremental_interval=1, watch=False)
+        kind, when = daemon.due()
+        self.assertEqual(kind, "full")
+        self.assertLessEqual(when, datetime.now())
+        full = daemon.run_once(kind)
+        kind, when = daemon.due()
+        self.assertEqual(kind, "incremental")
+        self.assertGreater(when, datetime.now() + timedelta(minutes=59))
+        incremental = daemon.run_once(kind)
+        self.assertIn("incremental-partial-", incremental)
+        entries = keeper.Catalog(dest).entries()
+        self.assertEqual([(entry["type"], entry["base"]) for entry in entries],
+                         [("full", None), ("incremental", full)])
+
+        # Stopping ends run() before the next backup is due
+        daemon.stop()
+        daemon.run()
+        self.assertEqual(len(keeper.Catalog(dest).entries()), 2)
+        self._purge_directory(base)
+
+    def test_daemon_incremental_from_watched_changes(self):
+        """Test that incremental backups only stat what inotify reported"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_daemon_watch"
+        data = base + "/data"
+        dest = base + "/backups"
+        self._create_dir(data + "/old")
+        for name in ["same", "changed", "removed"]:
+            with open(data + "/old/" + name, "w") as file_handle:
+                file_handle.write(name)
+        daemon = keeper.Daemon(Keeper(system_directories=[data]), dest)
+        if daemon.cache.watcher is None:
+            self.skipTest("inotify is not available")
+        daemon.run_once("full")
+
+        with open(data + "/old/changed", "a") as file_handle:
+            file_handle.write(" again")
+        os.remove(data + "/old/removed")
+        self._create_dir(data + "/new/sub")
+        with open(data + "/new/sub/file", "w") as file_handle:
+            file_handle.write("new")
+        # Wait for the events to be read
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with daemon.cache.watcher._lock:
+                if data + "/new" in daemon.cache.watcher._created and \
+                        data + "/old/removed" in \
+                        daemon.cache.watcher._changed:
+                    break
+            time.sleep(0.05)
+        filename = daemon.run_once("incremental")
+        self.assertEqual(daemon.cache.full_walks, 1)
+        header, records = keeper._read_manifest(
+            dest + "/" + filename + keeper.MANIFEST_SUFFIX)
+        stored = dict((record["path"], record.get("stored", False))
+                      for record in records)
+        name = data.lstrip("/")
+        self.assertEqual(stored, {
+            name: True,
+            name + "/old": True,
+            name + "/old/same": False,
+            name + "/old/changed": True,
+            name + "/old/removed": False,
+            name + "/new": True,
+            name + "/new/sub": True,
+            name + "/new/sub/file": True,
+        })
+        daemon.cache.close()
+        self._purge_directory(base)
+
+    def test_daemon_leaves_out_filtered_paths(self):
+        """Test that files created in excluded directories are left out"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_daemon_filter"
+        data = base + "/data"
+        dest = base + "/backups"
+        self._create_dir(data + "/cache")
+        for name in ["keep", "cache/old"]:
+            with open(data + "/" + name, "w") as file_handle:
+                file_handle.write(name)
+        walk_filter = keeper.WalkFilter(exclude=["*/cache"])
+        daemon = keeper.Daemon(Keeper(system_directories=[data]), dest,
+                               walk_filter=walk_filter)
+        if daemon.cache.watcher is None:
+            self.skipTest("inotify is not available")
+        daemon.run_once("full")
+        self.assertEqual(list(daemon.cache.entries), [data, data + "/keep"])
+        self.assertNotIn(data + "/cache",
+                         daemon.cache.watcher._watches.values())
+
+        for name in ["cache/new", "new/cache/file", "new/file"]:
+            self._create_dir(os.path.dirname(data + "/" + name))
+            with open(data + "/" + name, "w") as file_handle:
+                file_handle.write(name)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            with daemon.cache.watcher._lock:
+                if data + "/new" in daemon.cache.watcher._created:
+                    break
+            time.sleep(0.05)
+        filename = daemon.run_once("incremental")
+        self.assertEqual(daemon.cache.full_walks, 1)
+        header, records = keeper._read_manifest(
+            dest + "/" + filename + keeper.MANIFEST_SUFFIX)
+        name = data.lstrip("/")
+        self.assertEqual(
+            sorted(record["path"] for record in records),
+            [name, name + "/keep", name + "/new", name + "/new/file"])
+        self.assertNotIn(data + "/new/cache",
+                         daemon.cache.watcher._watches.values())
+        daemon.cache.close()
+
+        # Any walk order, as the directories above a file are matched
+        def _unordered(roots, executor):
+            for path in [data, data + "/cache", data + "/keep",
+                         data + "/cache/old"]:
+                yield path, os.stat(path)
+
+        keeper_instance = Keeper(system_directories=[data])
+        keeper_instance.backup(
+            destination_path=dest, filename="unordered.tar.gz",
+            walk=_unordered, walk_filter=walk_filter)
+        self.assertEqual(
+            self._list_files_in_tar(dest + "/unordered.tar.gz"),
+            [name, name + "/keep", keeper.CHECKSUMS_MEMBER])
+        self._purge_directory(base)
+
+    def test_online_backup_from_snapshot(self):
+        """Test backing up from hard link and reflink snapshots"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_online"
+        data = base + "/rundeck/data"
+        self._create_dir(data + "/sub")
+        with open(data + "/sub/db", "wb") as file_handle:
+            file_handle.write(b"database")
+        with open(data + "/log", "wb") as file_handle:
+            file_handle.write(b"log")
+        os.symlink("sub/db", data + "/link")
+        with open(base + "/probe", "w") as file_handle:
+            file_handle.write("probe")
+        reflinks = keeper._reflink(base + "/probe", base + "/probe.clone",
+                                   fallback=False)
+        os.remove(base + "/probe")
+
+        calls = []
+
+        class OnlineKeeper(Keeper):
+            def _rundeck_is_running(self):
+                return True
+
+            def _rundeck_service(self, action):
+                calls.append((action, os.listdir(base + "/rundeck")))
+
+        keeper_instance = OnlineKeeper(system_directories=[data],
+                                       ignore_running=True)
+        copied = keeper.SNAPSHOT_COPIED
+        keeper.SNAPSHOT_COPIED = [data + "/sub"]
+        try:
+            for method in ["hardlink", "reflink"]:
+                del calls[:]
+                if method == "reflink" and not reflinks:
+                    # Refused before copying everything with rundeckd down
+                    with self.assertRaises(Exception):
+                        with keeper_instance.snapshot(method):
+                            pass
+                    self.assertEqual([action for action, _ in calls],
+                                     ["stop", "start"])
+                    self.assertEqual(os.listdir(base + "/rundeck"), ["data"])
+                    continue
+                with keeper_instance.snapshot(method) as sources:
+                    snapshot = sources[data]
+                    # rundeckd runs again before anything is archived
+                    self.assertEqual([action for action, _ in calls],
+                                     ["stop", "start"])
+                    self.assertEqual(calls[0][1], ["data"])
+                    if method == "hardlink":
+                        # The database is copied, the rest is linked
+                        self.assertEqual(os.stat(snapshot + "/log").st_ino,
+                                         os.stat(data + "/log").st_ino)
+                        self.assertNotEqual(
+                            os.stat(snapshot + "/sub/db").st_ino,
+                            os.stat(data + "/sub/db").st_ino)
+                    # Changes after the snapshot are not backed up
+                    with open(data + "/new", "w") as file_handle:
+                        file_handle.write("new")
+                    with open(data + "/sub/db", "r+b") as file_handle:
+                        file_handle.write(b"DATABASE")
+                    keeper_instance.backup(
+                        destination_path=base, filename=method + ".tar.gz",
+                        sources=sources)
+                os.remove(data + "/new")
+                with open(data + "/sub/db", "wb") as file_handle:
+                    file_handle.write(b"database")
+                self.assertFalse(os.path.exists(snapshot))
+                self.assertEqual(os.listdir(base + "/rundeck"), ["data"])
+                path = base + "/" + method + ".tar.gz"
+                names = self._list_files_in_tar(path)
+                self.assertEqual(sorted(names), sorted([
+                    data[1:], data[1:] + "/link", data[1:] + "/log",
+                    data[1:] + "/sub", data[1:] + "/sub/db",
+                    CHECKSUMS_MEMBER]))
+                with tarfile.open(path) as archive:
+                    self.assertEqual(archive.extractfile(
+                        data[1:] + "/sub/db").read(), b"database")
+                self.assertEqual(keeper.verify_backup(path), [])
+        finally:
+            keeper.SNAPSHOT_COPIED = copied
+            self._purge_directory(base)
+
+    def test_rundeck_service_uses_systemd(self):
+        """Test that rundeckd is stopped through systemd when it runs"""
+        has_systemd = keeper._has_systemd
+        try:
+            keeper._has_systemd = lambda: True
+            self.assertEqual(keeper._rundeck_service_command("stop"),
+                             ["systemctl", "stop", "rundeckd"])
+            keeper._has_systemd = lambda: False
+            self.assertEqual(keeper._rundeck_service_command("stop"),
+                             ["service", "rundeckd", "stop"])
+        finally:
+            keeper._has_systemd = has_systemd
+
+    def test_rundeck_status_from_pidfile(self):
+        """Test finding rundeckd through its pidfile and /proc"""
+        cwd = os.getcwd()
+        base = cwd + "/tmp/keeper_test_pidfile"
+        self._create_dir(base)
+        # A process that looks like the rundeck java process
+        os.symlink(sys.executable, base + "/java")
+        process = subprocess.Popen([
+            base + "/java", "-c", "import time; time.sleep(60)",
+            "-Drundeck.server.configDir=/etc/rundeck"])
+        # Its command line shows in /proc only once it started
+        deadline = time.monotonic() + 10
+        while not keeper._is_rundeck_process(process.pid) and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        pidfiles = keeper.RUNDECK_PIDFILES
+        keeper.RUNDECK_PIDFILES = [base + "/missing.pid", base + "/run.pid"]
+        try:
+            self.assertIsNone(keeper._status_from_pidfile())
+            with open(base + "/run.pid", "w") as file_handle:
+                file_handle.write("{}\n".format(process.pid))
+            self.assertTrue(keeper._status_from_pidfile())
+            self.assertTrue(keeper._status_from_processes())
+            # A stale pidfile leaves the answer to the other detectors
+            process.kill()
+            process.wait()
+            self.assertIsNone(keeper._status_from_pidfile())
+            with open(base + "/run.pid", "w") as file_handle:
+                file_handle.write("{}\n".format(os.getpid()))
+            self.assertIsNone(keeper._status_from_pidfile())
+            detectors = keeper.RUNDECK_DETECTORS
+            keeper.RUNDECK_DETECTORS = [keeper._status_from_pidfile,
+                                        lambda: True]
+            try:
+                self.assertTrue(keeper._detect_rundeck())
+            finally:
+                keeper.RUNDECK_DETECTORS = detectors
+        finally:
+            keeper.RUNDECK_PIDFILES = pidfiles
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            self._purge_directory(base)
+
+    def test_rundeck_status_is_cached(self):
+        """Test that the rundeckd status is only checked once per TTL"""
+        calls = []
+
+        def detector():
+            calls.append(1)
+            return len(calls) > 1
+
+        detectors = keeper.RUNDECK_DETECTORS
+        keeper.RUNDECK_DETECTORS = [lambda: None, detector]
+        keeper._forget_rundeck_status()
+        try:
+            self.assertFalse(keeper.rundeck_is_running())
+            self.assertFalse(keeper.rundeck_is_running())
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(keeper.rundeck_is_running(ttl=0))
+            keeper._forget_rundeck_status()
+            self.assertTrue(keeper.rundeck_is_running())
+            self.assertEqual(len(calls), 3)
+        finally:
+            keeper.RUNDECK_DETECTORS = detectors
+            keeper._forget_rundeck_status()